@@ -0,0 +1,106 @@
+#!/bin/python
+# Micro-benchmark of the CRC and frame packaging against the original nibble-at-a-time code.
+#
+# Before timing anything the new implementation is checked byte-for-byte against the legacy one
+# (every frame documented in Protocol.md plus a batch of random payloads).
+#
+#   python benchmarks/bench_crc.py
+import argparse
+import json
+import random
+import timeit
+
+from voltronic_wifi_bridge import voltronic_tools
+from captured_frames import PROTOCOL_FRAMES, RESPONSES
+
+QPIGS_RESPONSE = RESPONSES[b"QPIGS"]
+
+
+def legacy_cal_crc_half(message, length=None, string_is_hex=False):
+    crc_ta= [
+        0x0000,0x1021,0x2042,0x3063,0x4084,0x50a5,0x60c6,0x70e7,
+        0x8108,0x9129,0xa14a,0xb16b,0xc18c,0xd1ad,0xe1ce,0xf1ef
+    ]
+
+    crc = 0
+
+    for b in bytearray(message):
+        da = crc.to_bytes(2)[0] >> 4
+        crc = crc << 4
+        crc = crc ^ crc_ta[da^(b>>4)]
+
+        crc = crc & 0xFFFF
+        da = crc.to_bytes(2)[0] >> 4
+        crc = crc << 4
+        crc = crc ^ crc_ta[da^(b & 0x0f)]
+
+        crc = crc & 0xFFFF
+
+    crcbytes = crc.to_bytes(2)
+    for index in [0, 1]:
+        if crcbytes[index] in [0x28, 0x0d, 0x0a]:
+            crc += (0x100 ** (1-index))
+    crcbytes = crc.to_bytes(2)
+    return crcbytes
+
+
+def legacy_package(counter, preamble, msg):
+    packaged_msg = b''
+    crc = legacy_cal_crc_half(msg)
+    counter = counter & 0xFFFF
+    packaged_msg = counter.to_bytes(2)
+    packaged_msg += b'\x00\x01'
+    packaged_msg += (len(msg)+5).to_bytes(2)
+    packaged_msg += preamble
+    packaged_msg += msg
+    packaged_msg += crc
+    packaged_msg += b"\x0d"
+    return packaged_msg
+
+
+def verify(samples):
+    for frame in PROTOCOL_FRAMES:
+        counter = int.from_bytes(frame[0:2], "big")
+        packaged = voltronic_tools.package_frame(counter, frame[6:8], frame[8:-3])
+        if packaged != frame or legacy_package(counter, frame[6:8], frame[8:-3]) != frame:
+            raise Exception("packaging mismatch for captured frame {}".format(frame.hex()))
+    rng = random.Random(1)
+    for _ in range(samples):
+        message = bytes(rng.randrange(256) for _ in range(rng.randrange(0, 120)))
+        if voltronic_tools.cal_crc_half(message) != legacy_cal_crc_half(message):
+            raise Exception("crc mismatch for {}".format(message.hex()))
+        counter = rng.randrange(0x10000)
+        preamble = rng.choice([b'\xff\x04', b'\x01\x04'])
+        if voltronic_tools.package_frame(counter, preamble, message) != legacy_package(counter, preamble, message):
+            raise Exception("packaging mismatch for {}".format(message.hex()))
+    return
+
+
+def best_of(statement, number, repeat=5):
+    return min(timeit.repeat(statement, number=number, repeat=repeat)) / number
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--number", type=int, default=20000, help="iterations per timing run")
+    parser.add_argument("--verify-samples", type=int, default=20000, help="random payloads compared against the legacy code")
+    args = parser.parse_args()
+
+    verify(args.verify_samples)
+
+    results = {
+        "crc_qpigs_response_legacy_us": best_of(lambda: legacy_cal_crc_half(QPIGS_RESPONSE), args.number // 10),
+        "crc_qpigs_response_us": best_of(lambda: voltronic_tools.cal_crc_half(QPIGS_RESPONSE), args.number // 10),
+        "package_qpigs_legacy_us": best_of(lambda: legacy_package(1234, b'\xff\x04', b"QPIGS"), args.number),
+        "package_qpigs_us": best_of(lambda: voltronic_tools.package_frame(1234, b'\xff\x04', b"QPIGS"), args.number),
+    }
+    for key in list(results.keys()):
+        results[key] = round(results[key] * 1e6, 3)
+    results["crc_speedup"] = round(results["crc_qpigs_response_legacy_us"] / results["crc_qpigs_response_us"], 1)
+    results["package_speedup"] = round(results["package_qpigs_legacy_us"] / results["package_qpigs_us"], 1)
+    print(json.dumps(results, indent=2))
+    return
+
+
+if __name__ == "__main__":
+    main()
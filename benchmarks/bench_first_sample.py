@@ -0,0 +1,113 @@
+#!/bin/python
+# Time from an inverter connecting to its first telemetry sample, with and without --identity-cache.
+#
+# A bridge runs in this process and a simulated inverter connects to it, is timed until the
+# bridge publishes its first QPIGS field, then disconnects and connects again --reconnects times.
+# Without the cache every connection goes through the QPI / QID / QVFW handshake; with it the
+# first connection does and the reconnects start polling straight away, checked by one QID.  What
+# remains after the handshake is the scheduler's spread of each inverter's first polls over the
+# first few seconds.
+#
+#   python benchmarks/bench_first_sample.py --mode asyncio --reconnects 3
+import argparse
+import asyncio
+import json
+import os
+import statistics
+import tempfile
+import time
+
+from voltronic_wifi_bridge import voltronic_server
+from voltronic_wifi_bridge import voltronic_async_server
+from voltronic_wifi_bridge import voltronic_simulator
+from voltronic_wifi_bridge import voltronic_identity
+
+
+class FirstSampleMQTT():
+    # stands in for MQTTClient and notes when the first QPIGS field arrives
+    def __init__(self):
+        self.first_sample = None
+        return
+
+    def publish_message(self, topicpart, message, retain=False):
+        if topicpart.endswith("/grid_voltage") and self.first_sample is None:
+            self.first_sample = time.perf_counter()
+        return
+
+    def register_message_callback(self, callback, topicmatch):
+        return
+
+    def unregister_message_callback(self, callback, topicmatch):
+        return
+
+
+async def time_connections(args, port, cache_path):
+    options = {}
+    cache = None
+    if cache_path is not None:
+        cache = voltronic_identity.IdentityCache(cache_path, flush_interval=0)
+        options["identity_cache"] = cache
+    if args.mode == "asyncio":
+        bridge = voltronic_async_server.AsyncVoltronicServer(port, **options)
+    else:
+        bridge = voltronic_server.VoltronicServer(port, **options)
+    mqtt = FirstSampleMQTT()
+    bridge.register_mqtt(mqtt)
+    bridge.start()
+    await asyncio.sleep(0.5)
+
+    times = []
+    try:
+        for _ in range(args.reconnects + 1):
+            mqtt.first_sample = None
+            inverter = voltronic_simulator.SimulatedInverter("127.0.0.1", port, "96332309100452", latency=args.latency, reconnect_delay=1)
+            started = time.perf_counter()
+            task = asyncio.ensure_future(inverter.run())
+            while mqtt.first_sample is None and time.perf_counter() - started < args.timeout:
+                await asyncio.sleep(0.01)
+            if mqtt.first_sample is None:
+                raise Exception("no sample within {} seconds".format(args.timeout))
+            times.append(mqtt.first_sample - started)
+            inverter.stop()
+            task.cancel()
+            # let the bridge notice the disconnect before the next connection
+            await asyncio.sleep(1)
+    finally:
+        bridge.exit()
+        await asyncio.get_running_loop().run_in_executor(None, bridge.join)
+        if cache is not None:
+            cache.close()
+    return times
+
+
+def summarise(times):
+    reconnects = times[1:]
+    return {
+        "first_connect_s": round(times[0], 3),
+        "reconnect_s": [round(value, 3) for value in reconnects],
+        "reconnect_s_mean": round(statistics.mean(reconnects), 3) if len(reconnects) > 0 else None,
+        "reconnect_s_max": round(max(reconnects), 3) if len(reconnects) > 0 else None,
+    }
+
+
+async def run(args):
+    with tempfile.TemporaryDirectory() as directory:
+        without = await time_connections(args, args.port, None)
+        with_cache = await time_connections(args, args.port + 1, os.path.join(directory, "identity.json"))
+    return {"mode": args.mode, "without_cache": summarise(without), "with_cache": summarise(with_cache)}
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--mode", choices=["threaded", "asyncio"], default="threaded")
+    parser.add_argument("--reconnects", type=int, default=3, help="connections timed after the first one")
+    parser.add_argument("--port", type=int, default=3540, help="port for the bridge without the cache, the next one is used for the bridge with it")
+    parser.add_argument("--latency", type=float, default=0.05, help="simulated inverter response time")
+    parser.add_argument("--timeout", type=float, default=60, help="give up waiting for a sample after this long")
+    args = parser.parse_args()
+    print(json.dumps(asyncio.run(run(args)), indent=2))
+    return
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,146 @@
+#!/bin/python
+# Fuzz and benchmark the receive framing (voltronic_tools.FrameBuffer).
+#
+# The fuzz pass splits a captured response stream at random points, injects junk between frames
+# and flips bytes inside frames, then checks that
+#  - every frame that wasn't touched still comes out intact,
+#  - nothing that passes the CRC is a frame we didn't send,
+#  - the buffer never grows past its capacity.
+# The benchmark compares frames per second against the original reslicing _recv_message.
+#
+#   python benchmarks/bench_framing.py
+import argparse
+import json
+import random
+import time
+
+from voltronic_wifi_bridge import voltronic_tools
+from captured_frames import response_stream
+
+
+def legacy_framer(stream, chunk_size):
+    # the original VoltronicConnection._recv_message loop, which can't recover from corruption
+    recv_buffer = bytearray()
+    count = 0
+    for offset in range(0, len(stream), chunk_size):
+        recv_buffer.extend(stream[offset:offset + chunk_size])
+        while len(recv_buffer) > 10 and recv_buffer[2:4] == b'\x00\x01' and (recv_buffer[6:8] == b'\xff\x04' or recv_buffer[6:8] == b'\x01\x04'):
+            expected_length = (int.from_bytes(recv_buffer[4:6], "big") + 6)
+            if len(recv_buffer) < expected_length:
+                break
+            msg = recv_buffer[0:expected_length]
+            msg[8:-3]
+            recv_buffer = recv_buffer[expected_length:]
+            count += 1
+    return count
+
+
+def frame_buffer_framer(stream, chunk_size):
+    frames = voltronic_tools.FrameBuffer(capacity=max(8192, 2 * chunk_size))
+    view = memoryview(stream)
+    count = 0
+    for offset in range(0, len(stream), chunk_size):
+        frames.feed(view[offset:offset + chunk_size])
+        frame = frames.next_frame()
+        while frame is not None:
+            frame[8:-3]
+            count += 1
+            frame = frames.next_frame()
+    return count
+
+
+def fuzz_once(rng, frames, corrupt_frames, capacity):
+    pieces = []
+    intact = []
+    for frame in frames:
+        if rng.random() < 0.1:
+            pieces.append(bytes(rng.randrange(256) for _ in range(rng.randrange(1, 40))))
+        if corrupt_frames and rng.random() < 0.05:
+            damaged = bytearray(frame)
+            damaged[rng.randrange(len(damaged))] ^= 1 << rng.randrange(8)
+            pieces.append(bytes(damaged))
+        else:
+            pieces.append(frame)
+            intact.append(frame)
+    stream = b"".join(pieces)
+
+    buffer = voltronic_tools.FrameBuffer(capacity=capacity)
+    received = []
+    offset = 0
+    while offset < len(stream):
+        size = rng.randrange(1, 300)
+        buffer.feed(stream[offset:offset + size])
+        offset += size
+        if len(buffer) > capacity:
+            raise Exception("frame buffer grew to {} past its capacity {}".format(len(buffer), capacity))
+        frame = buffer.next_frame()
+        while frame is not None:
+            received.append(bytes(frame))
+            frame = buffer.next_frame()
+
+    # the counter isn't covered by the crc, so a flipped counter bit legitimately gets through
+    originals = set(frame[2:] for frame in frames)
+    for frame in received:
+        if voltronic_tools.cal_crc_half(frame[8:-3]) == frame[-3:-1] and frame[2:] not in originals:
+            raise Exception("framer produced a frame that was never sent: {}".format(frame))
+    received = set(received)
+    recovered = sum(1 for frame in intact if frame in received)
+    return len(intact), recovered, buffer.bytes_discarded, buffer.resync_events
+
+
+def fuzz(iterations, seed):
+    rng = random.Random(seed)
+    frames = response_stream(20)
+    results = {}
+    for corrupt_frames in [False, True]:
+        expected = recovered = discarded = resyncs = 0
+        for _ in range(iterations):
+            e, r, d, s = fuzz_once(rng, frames, corrupt_frames, capacity=rng.choice([512, 1024, 8192]))
+            expected += e
+            recovered += r
+            discarded += d
+            resyncs += s
+        if not corrupt_frames and recovered != expected:
+            raise Exception("lost {} intact frames with junk between frames".format(expected - recovered))
+        results["junk_and_bitflips" if corrupt_frames else "junk_only"] = {
+            "intact_frames": expected,
+            "recovered": recovered,
+            "bytes_discarded": discarded,
+            "resync_events": resyncs,
+        }
+    return results
+
+
+def bench(framer, stream, chunk_size, expected, repeat=5):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        count = framer(stream, chunk_size)
+        elapsed = time.perf_counter() - start
+        if count != expected:
+            raise Exception("{} found {} of {} frames".format(framer.__name__, count, expected))
+        best = elapsed if best is None else min(best, elapsed)
+    return count / best
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--fuzz-iterations", type=int, default=300)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--cycles", type=int, default=2000, help="poll cycles in the benchmark stream")
+    parser.add_argument("--chunk-size", type=int, default=1460, help="bytes per simulated recv")
+    args = parser.parse_args()
+
+    results = {"fuzz": fuzz(args.fuzz_iterations, args.seed)}
+
+    frames = response_stream(args.cycles)
+    stream = b"".join(frames)
+    results["legacy_frames_per_second"] = round(bench(legacy_framer, stream, args.chunk_size, len(frames)))
+    results["frame_buffer_frames_per_second"] = round(bench(frame_buffer_framer, stream, args.chunk_size, len(frames)))
+    results["speedup"] = round(results["frame_buffer_frames_per_second"] / results["legacy_frames_per_second"], 2)
+    print(json.dumps(results, indent=2))
+    return
+
+
+if __name__ == "__main__":
+    main()
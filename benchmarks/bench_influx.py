@@ -0,0 +1,120 @@
+#!/bin/python
+# Points per second through the InfluxDB exporter, against a local stand-in for InfluxDB.
+#
+# The stand-in speaks just enough HTTP/1.1 (keep-alive, gzip bodies) to count the lines written,
+# and answers the first --fail-first writes with 503 so the retry path is covered too.  Records
+# come from the captured QPIGS/QPIGS2/QPIRI/QPIWS responses, spread over --inverters serials.
+#
+#   python benchmarks/bench_influx.py --points 200000 --version 2
+import argparse
+import gzip
+import http.server
+import json
+import threading
+import time
+
+from voltronic_wifi_bridge import voltronic_influx
+from voltronic_wifi_bridge import voltronic_schemas
+from captured_frames import RESPONSES
+
+
+class StandIn():
+    def __init__(self, fail_first):
+        self.lock = threading.Lock()
+        self.lines = 0
+        self.requests = 0
+        self.bytes = 0
+        self.connections = 0
+        self.fail_first = fail_first
+        stand_in = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def setup(self):
+                http.server.BaseHTTPRequestHandler.setup(self)
+                with stand_in.lock:
+                    stand_in.connections += 1
+                return
+
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers["Content-Length"]))
+                with stand_in.lock:
+                    stand_in.requests += 1
+                    failing = stand_in.requests <= stand_in.fail_first
+                if failing:
+                    self.send_response(503)
+                else:
+                    if self.headers.get("Content-Encoding") == "gzip":
+                        text = gzip.decompress(body)
+                    else:
+                        text = body
+                    with stand_in.lock:
+                        stand_in.lines += text.count(b"\n") + 1
+                        stand_in.bytes += len(body)
+                    self.send_response(204)
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+
+            def log_message(self, format, *args):
+                return
+
+        self.server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.port = self.server.server_address[1]
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--points", type=int, default=100000)
+    parser.add_argument("--inverters", type=int, default=100)
+    parser.add_argument("--batch-size", type=int, default=5000)
+    parser.add_argument("--version", type=int, choices=[1, 2], default=1)
+    parser.add_argument("--fail-first", type=int, default=2, help="writes answered with 503 before the stand-in starts accepting")
+    args = parser.parse_args()
+
+    stand_in = StandIn(args.fail_first)
+    exporter = voltronic_influx.InfluxExporter("http://127.0.0.1:{}".format(stand_in.port), version=args.version, org="org", bucket="bucket",
+                                               token="token", batch_size=args.batch_size, flush_interval=0.5, max_buffered=args.points)
+    records = []
+    for command in [b"QPIGS", b"QPIGS2", b"QPIRI", b"QPIWS"]:
+        records.append(voltronic_schemas.get_schema(command).parse(RESPONSES[command]))
+    serials = ["{:014d}".format(index) for index in range(args.inverters)]
+
+    # formatting alone, before anything is sent
+    start = time.perf_counter()
+    now = time.time()
+    for index in range(args.points):
+        exporter.handle_record(serials[index % len(serials)], records[index % len(records)], now)
+    format_seconds = time.perf_counter() - start
+    raw_bytes = sum(len(line) + 1 for line in exporter._buffer)
+
+    # then sending, including the retries from the failed writes
+    start = time.perf_counter()
+    exporter.start()
+    deadline = time.time() + 60
+    while stand_in.lines < args.points and time.time() < deadline:
+        time.sleep(0.01)
+    send_seconds = time.perf_counter() - start
+    exporter.exit()
+    exporter.join()
+
+    if stand_in.lines != args.points:
+        raise Exception("stand-in received {} points, expected {}".format(stand_in.lines, args.points))
+    print(json.dumps({
+        "points": args.points,
+        "format_points_per_second": round(args.points / format_seconds),
+        "send_points_per_second": round(args.points / send_seconds),
+        "end_to_end_points_per_second": round(args.points / (format_seconds + send_seconds)),
+        "requests": stand_in.requests,
+        "connections": stand_in.connections,
+        "bytes_on_wire": stand_in.bytes,
+        "compression_ratio": round(raw_bytes / stand_in.bytes, 1),
+    }, indent=2))
+    return
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,162 @@
+#!/bin/python
+# Parse throughput of the compiled response schemas against the original per-class parsers.
+#
+# The legacy parsers are copied from the Query*.process_response methods as they were before the
+# schema registry (dict literal plus pprint per poll); pprint output goes to /dev/null.  The
+# schema results are also checked against the legacy dicts so the two can't drift apart.
+#
+#   python benchmarks/bench_parsing.py
+import argparse
+import contextlib
+import json
+import os
+import pprint
+import time
+
+from voltronic_wifi_bridge import voltronic_schemas
+from captured_frames import RESPONSES
+
+
+def legacy_qpigs(msg):
+    values_array = msg[1:].decode('ascii').split(" ")
+    values = {
+        "grid_voltage": float(values_array[0]),
+        "grid_frequency": float(values_array[1]),
+        "output_voltage": float(values_array[2]),
+        "output_frequency": float(values_array[3]),
+        "output_va": float(values_array[4]),
+        "output_w": float(values_array[5]),
+        "output_load_percent": float(values_array[6]),
+        "bus_voltage": float(values_array[7]),
+        "battery_voltage": float(values_array[8]),
+        "battery_charging_current": float(values_array[9]),
+        "battery_SOC": float(values_array[10]),
+        "inverter_heatsink_temp": float(values_array[11]),
+        "pv1_input_current": float(values_array[12]),
+        "pv1_input_voltage": float(values_array[13]),
+        "battery_voltage_scc_1": values_array[14],
+        "battery_discharging_current": float(values_array[15]),
+        "qpigs_device_status_bitmap": values_array[16],
+        "17": values_array[17],
+        "18": values_array[18],
+        "pv1_input_power": float(values_array[19]),
+        "qpigs_device_status_bitmap_2": values_array[20],
+    }
+    pprint.pprint(values)
+    return values
+
+
+def legacy_qpiri(msg):
+    values_array = msg[1:].decode('ascii').split(" ")
+    values = {
+        "grid_rating_voltage": values_array[0],
+        "grid_rating_current_maybe": values_array[1],
+        "output_rating_voltage": values_array[2],
+        "output_rating_frequency": values_array[3],
+        "output_rating_current_maybe": values_array[4],
+        "output_rating_va": values_array[5],
+        "output_rating_w": values_array[6],
+        "battery_rating_voltage": values_array[7],
+        "battery_recharge_voltage": float(values_array[8]),
+        "battery_under_voltage": float(values_array[9]),
+        "battery_bulk_voltage": float(values_array[10]),
+        "battery_float_voltage": float(values_array[11]),
+        "battery_type": values_array[12],
+        "max_ac_charging_current": float(values_array[13]),
+        "current_max_charging_current": float(values_array[14]),
+        "input_voltage_range": values_array[15],
+        "output_source_priority": voltronic_schemas.OUTPUT_SOURCE_PRIORITY[values_array[16]],
+        "charger_source_priority": voltronic_schemas.CHARGER_SOURCE_PRIORITY[values_array[17]],
+        "parrallel_max_num": values_array[18],
+        "machine_type": values_array[19],
+        "topology": values_array[20],
+        "output_mode": values_array[21],
+        "battery_redischarge_voltage": values_array[22],
+        "pv_ok_condition_for_parallel": values_array[23],
+        "pv_power_balance": values_array[24],
+        "25": values_array[25],
+        "26": values_array[26],
+        "27": values_array[27],
+    }
+    pprint.pprint(values)
+    return values
+
+
+# the original code spelled these out as dict literals
+QPIWS_BITS = [(field.name, field.index) for field in voltronic_schemas.get_schema(b"QPIWS").fields]
+QFLAG_MAPPING = {field.index: field.name for field in voltronic_schemas.get_schema(b"QFLAG").fields}
+
+
+def legacy_qpiws(msg):
+    bits = ["1" == val for val in msg[1:].decode('ascii')]
+    bits.insert(0, None)
+    return {name: bits[index] for name, index in QPIWS_BITS}
+
+
+def legacy_qflag(msg):
+    mapping = QFLAG_MAPPING
+    mqtt_outputs = {}
+    enabled = msg[1:].decode('ascii').split("E", 1)[1].split("D", 1)[0]
+    disabled = msg[1:].decode('ascii').split("E", 1)[1].split("D", 1)[1]
+    for code, topic in mapping.items():
+        if code in enabled:
+            mqtt_outputs[topic] = True
+        elif code in disabled:
+            mqtt_outputs[topic] = False
+    return mqtt_outputs
+
+
+def schema_parser(command):
+    schema = voltronic_schemas.get_schema(command)
+    record = schema.new_record()
+
+    def parse(msg):
+        return schema.parse_into(msg, record)
+    return parse
+
+
+def verify():
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        for command, legacy in [(b"QPIGS", legacy_qpigs), (b"QPIRI", legacy_qpiri)]:
+            record = voltronic_schemas.get_schema(command).parse(RESPONSES[command])
+            if dict(record.items()) != legacy(RESPONSES[command]):
+                raise Exception("schema for {} disagrees with the legacy parser".format(command))
+    record = voltronic_schemas.get_schema(b"QPIWS").parse(RESPONSES[b"QPIWS"])
+    if dict(record.items()) != legacy_qpiws(RESPONSES[b"QPIWS"]):
+        raise Exception("schema for QPIWS disagrees with the legacy parser")
+    record = voltronic_schemas.get_schema(b"QFLAG").parse(RESPONSES[b"QFLAG"])
+    if {k: v for k, v in record.items() if v is not None} != legacy_qflag(RESPONSES[b"QFLAG"]):
+        raise Exception("schema for QFLAG disagrees with the legacy parser")
+    return
+
+
+def rate(function, msg, number):
+    best = None
+    for _ in range(5):
+        start = time.perf_counter()
+        for _ in range(number):
+            function(msg)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return round(number / best)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--number", type=int, default=5000, help="parses per timing run")
+    args = parser.parse_args()
+
+    verify()
+    results = {}
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        for command, legacy in [(b"QPIGS", legacy_qpigs), (b"QPIRI", legacy_qpiri), (b"QPIWS", legacy_qpiws), (b"QFLAG", legacy_qflag)]:
+            name = command.decode('ascii').lower()
+            results[name + "_legacy_per_second"] = rate(legacy, RESPONSES[command], args.number)
+            results[name + "_schema_per_second"] = rate(schema_parser(command), RESPONSES[command], args.number)
+            results[name + "_speedup"] = round(results[name + "_schema_per_second"] / results[name + "_legacy_per_second"], 1)
+    print(json.dumps(results, indent=2))
+    return
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,156 @@
+#!/bin/python
+# Latency the --upstream passthrough adds, with a stand-in for the vendor's server.
+#
+# A bridge (threaded or asyncio) runs in this process with a simulated inverter connected to it
+# and a stand-in upstream server that it connects out to.  The stand-in sends the inverter a
+# query every --interval seconds, the way the phone app's polling does, and checks each answer
+# comes back under its own counter.  The bridge keeps polling on its own at the same time, so the
+# round trip includes waiting behind the bridge's query when they collide.  The added latency is
+# the round trip less the simulated inverter's own --latency.
+#
+#   python benchmarks/bench_proxy.py --mode asyncio --seconds 30
+import argparse
+import asyncio
+import json
+import statistics
+import time
+
+from voltronic_wifi_bridge import voltronic_server
+from voltronic_wifi_bridge import voltronic_async_server
+from voltronic_wifi_bridge import voltronic_proxy
+from voltronic_wifi_bridge import voltronic_simulator
+from voltronic_wifi_bridge import voltronic_tools
+
+
+class CountingMQTT():
+    # stands in for MQTTClient and counts the bridge's own QPIGS samples
+    def __init__(self):
+        self.samples = 0
+        return
+
+    def publish_message(self, topicpart, message, retain=False):
+        if topicpart.endswith("/grid_voltage"):
+            self.samples += 1
+        return
+
+    def register_message_callback(self, callback, topicmatch):
+        return
+
+    def unregister_message_callback(self, callback, topicmatch):
+        return
+
+
+class StandInUpstream():
+    def __init__(self, interval, command):
+        self._interval = interval
+        self._command = command
+        self.connections = 0
+        self.sent = 0
+        self.answered = 0
+        self.mismatched = 0
+        self.round_trips = []
+        return
+
+    async def handle(self, reader, writer):
+        self.connections += 1
+        frames = voltronic_tools.FrameBuffer()
+        counter = 0x4400
+        try:
+            while True:
+                counter = (counter + 1) & 0xFFFF
+                writer.write(voltronic_tools.package_frame(counter, b'\xff\x04', self._command))
+                sent_at = time.perf_counter()
+                self.sent += 1
+                deadline = sent_at + 5
+                frame = None
+                while frame is None and time.perf_counter() < deadline:
+                    try:
+                        data = await asyncio.wait_for(reader.read(2000), timeout=deadline - time.perf_counter())
+                    except asyncio.TimeoutError:
+                        break
+                    if not data:
+                        return
+                    frames.feed(data)
+                    frame = frames.next_frame()
+                if frame is not None:
+                    self.round_trips.append(time.perf_counter() - sent_at)
+                    if int.from_bytes(frame[0:2], "big") == counter and voltronic_tools.cal_crc_half(frame[8:-3]) == frame[-3:-1]:
+                        self.answered += 1
+                    else:
+                        self.mismatched += 1
+                await asyncio.sleep(self._interval)
+        except (ConnectionError, asyncio.CancelledError):
+            pass
+        finally:
+            writer.close()
+        return
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+async def run(args):
+    stand_in = StandInUpstream(args.interval, args.command.encode('ascii'))
+    upstream = await asyncio.start_server(stand_in.handle, "127.0.0.1", 0)
+    upstream_port = upstream.sockets[0].getsockname()[1]
+
+    resolver = voltronic_proxy.UpstreamResolver(("127.0.0.1", upstream_port))
+    resolver.resolve()
+    options = {"upstream": resolver, "poll_intervals": {"QPIGS": args.poll_interval}}
+    if args.mode == "asyncio":
+        bridge = voltronic_async_server.AsyncVoltronicServer(args.port, **options)
+    else:
+        bridge = voltronic_server.VoltronicServer(args.port, **options)
+    mqtt = CountingMQTT()
+    bridge.register_mqtt(mqtt)
+    bridge.start()
+    await asyncio.sleep(0.5)
+
+    inverter = voltronic_simulator.SimulatedInverter("127.0.0.1", args.port, "96332309100452", latency=args.latency, reconnect_delay=1)
+    task = asyncio.ensure_future(inverter.run())
+    await asyncio.sleep(args.seconds)
+
+    inverter.stop()
+    task.cancel()
+    bridge.exit()
+    await asyncio.get_running_loop().run_in_executor(None, bridge.join)
+    upstream.close()
+
+    if len(stand_in.round_trips) == 0:
+        raise Exception("no answers came back through the bridge")
+    added = [max(0, rtt - args.latency) for rtt in stand_in.round_trips]
+    return {
+        "mode": args.mode,
+        "upstream_connections": stand_in.connections,
+        "upstream_sent": stand_in.sent,
+        "upstream_answered": stand_in.answered,
+        "upstream_mismatched": stand_in.mismatched,
+        "bridge_samples": mqtt.samples,
+        "inverter_received": inverter.counters["received"],
+        "round_trip_ms_p50": round(percentile(stand_in.round_trips, 0.5) * 1000, 2),
+        "round_trip_ms_p99": round(percentile(stand_in.round_trips, 0.99) * 1000, 2),
+        "added_ms_p50": round(percentile(added, 0.5) * 1000, 2),
+        "added_ms_p90": round(percentile(added, 0.9) * 1000, 2),
+        "added_ms_p99": round(percentile(added, 0.99) * 1000, 2),
+        "added_ms_mean": round(statistics.mean(added) * 1000, 2),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--mode", choices=["threaded", "asyncio"], default="threaded")
+    parser.add_argument("--seconds", type=float, default=30, help="how long to run; the bridge's own polls start after its ~15 second handshake")
+    parser.add_argument("--port", type=int, default=3530, help="port for the bridge under test")
+    parser.add_argument("--latency", type=float, default=0.02, help="simulated inverter response time")
+    parser.add_argument("--interval", type=float, default=0.25, help="seconds between the stand-in upstream's queries")
+    parser.add_argument("--command", default="QPIGS", help="what the stand-in upstream asks for")
+    parser.add_argument("--poll-interval", type=float, default=1, help="the bridge's own QPIGS interval")
+    args = parser.parse_args()
+    print(json.dumps(asyncio.run(run(args)), indent=2))
+    return
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,190 @@
+#!/bin/python
+# Compare the threaded and asyncio inverter servers under a fleet of idle inverter connections.
+#
+# The server under test runs in a child process so only its CPU time is measured.  Each fake
+# inverter answers every query the way voltronic_simulator's inverters do, straight away and
+# without latency, so the numbers cover the steady state polling cost of a connected fleet.
+# "connections" counts the sessions still open at the end of the measured window and "dropped"
+# the ones the server closed before then.
+#
+#   python benchmarks/bench_server.py --connections 2000 --idle-seconds 30
+#
+# Linux only (CPU, thread and memory figures are read from /proc).
+import argparse
+import asyncio
+import json
+import os
+import resource
+import socket
+import subprocess
+import sys
+import time
+
+from voltronic_wifi_bridge import voltronic_tools
+from voltronic_wifi_bridge import voltronic_simulator
+
+
+class NullMQTT():
+    # stands in for MQTTClient so the server can publish without a broker
+    def publish_message(self, topicpart, message, retain=False):
+        return
+
+    def register_message_callback(self, callback, topicmatch):
+        return
+
+    def unregister_message_callback(self, callback, topicmatch):
+        return
+
+
+def serve(mode, port):
+    from voltronic_wifi_bridge import voltronic_server
+    from voltronic_wifi_bridge import voltronic_async_server
+    if mode == "asyncio":
+        server = voltronic_async_server.AsyncVoltronicServer(port)
+    else:
+        server = voltronic_server.VoltronicServer(port)
+    server.register_mqtt(NullMQTT())
+    server.start()
+    server.join()
+    return
+
+
+def build_response(header, payload):
+    crc = voltronic_tools.cal_crc_half(payload)
+    return header[0:4] + (len(payload) + 5).to_bytes(2, "big") + header[6:8] + payload + crc + b"\x0d"
+
+
+async def fake_inverter(port, serial, opened, live):
+    # only its answers are used, the connection is handled here without the simulator's latency
+    inverter = voltronic_simulator.SimulatedInverter("127.0.0.1", port, serial)
+    reader, writer = await asyncio.open_connection("127.0.0.1", port)
+    opened.append(serial)
+    live.add(serial)
+    buffer = bytearray()
+    try:
+        while True:
+            data = await reader.read(2000)
+            if not data:
+                break
+            buffer.extend(data)
+            while len(buffer) > 8:
+                length = int.from_bytes(buffer[4:6], "big") + 6
+                if len(buffer) < length:
+                    break
+                frame = bytes(buffer[0:length])
+                del buffer[0:length]
+                writer.write(build_response(frame[0:8], inverter.respond(frame[8:-3])))
+    except (ConnectionError, asyncio.CancelledError):
+        pass
+    finally:
+        live.discard(serial)
+        writer.close()
+    return
+
+
+def read_proc_stats(pid):
+    with open("/proc/{}/stat".format(pid)) as f:
+        fields = f.read().rsplit(")", 1)[1].split()
+    ticks = os.sysconf("SC_CLK_TCK")
+    cpu = (int(fields[11]) + int(fields[12])) / ticks
+    threads = 0
+    rss_kb = 0
+    with open("/proc/{}/status".format(pid)) as f:
+        for line in f:
+            if line.startswith("Threads:"):
+                threads = int(line.split()[1])
+            elif line.startswith("VmRSS:"):
+                rss_kb = int(line.split()[1])
+    return cpu, threads, rss_kb
+
+
+def wait_for_port(port, timeout=10):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=1).close()
+            return True
+        except OSError:
+            time.sleep(0.1)
+    return False
+
+
+async def run_fleet(port, connections, settle_seconds, idle_seconds, pid):
+    opened = []
+    live = set()
+    tasks = []
+    for index in range(connections):
+        tasks.append(asyncio.ensure_future(fake_inverter(port, "%014i" % index, opened, live)))
+        if index % 100 == 99:
+            # don't overflow the listen backlog
+            await asyncio.sleep(0.05)
+    await asyncio.sleep(settle_seconds)
+    cpu_start, _, _ = read_proc_stats(pid)
+    wall_start = time.time()
+    await asyncio.sleep(idle_seconds)
+    cpu_end, threads, rss_kb = read_proc_stats(pid)
+    wall = time.time() - wall_start
+    still_open = len(live)
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    cpu_fraction = (cpu_end - cpu_start) / wall
+    return {
+        "connections": still_open,
+        "dropped": len(opened) - still_open,
+        "cpu_percent": round(cpu_fraction * 100, 2),
+        "connections_per_core": round(still_open / cpu_fraction) if cpu_fraction > 0 else None,
+        "threads": threads,
+        "rss_mb": round(rss_kb / 1024, 1),
+    }
+
+
+def bench_mode(mode, port, connections, settle_seconds, idle_seconds):
+    server = subprocess.Popen([sys.executable, os.path.abspath(__file__), "--serve", mode, "--port", str(port)],
+                              stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        if not wait_for_port(port):
+            raise Exception("{} server did not start listening on port {}".format(mode, port))
+        result = asyncio.run(run_fleet(port, connections, settle_seconds, idle_seconds, server.pid))
+    finally:
+        server.terminate()
+        try:
+            server.wait(10)
+        except subprocess.TimeoutExpired:
+            server.kill()
+            server.wait()
+    result["mode"] = mode
+    return result
+
+
+def raise_fd_limit():
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < hard:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    return
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--connections", type=int, default=500, help="number of fake inverters to connect")
+    parser.add_argument("--modes", nargs="+", default=["threaded", "asyncio"], choices=["threaded", "asyncio"])
+    parser.add_argument("--settle-seconds", type=float, default=12, help="time allowed for connect and handshake")
+    parser.add_argument("--idle-seconds", type=float, default=20, help="length of the measured window")
+    parser.add_argument("--port", type=int, default=3502, help="port for the first mode, the next mode uses the one after")
+    parser.add_argument("--serve", choices=["threaded", "asyncio"], help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    raise_fd_limit()
+    if args.serve is not None:
+        serve(args.serve, args.port)
+        return
+
+    for index, mode in enumerate(args.modes):
+        # each mode on its own port, clear of the last one's connections
+        result = bench_mode(mode, args.port + index, args.connections, args.settle_seconds, args.idle_seconds)
+        print(json.dumps(result))
+    return
+
+
+if __name__ == "__main__":
+    main()
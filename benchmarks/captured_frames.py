@@ -0,0 +1,51 @@
+#!/bin/python
+# Recorded frames and responses shared by the benchmarks.
+#
+# The raw frames are the wire captures documented in Protocol.md; the response payloads are real
+# answers from a 6500EX-48 (see the comments in voltronic_server.py) and are framed with the
+# counter of the query they answer.
+from voltronic_wifi_bridge import voltronic_tools
+
+
+PROTOCOL_FRAMES = [
+    bytes.fromhex("444a00010008ff04515049beac0d"),
+    bytes.fromhex("444c00010009ff0451534944bb050d"),
+    bytes.fromhex("6a4c0001000a0104504f503030c2480d"),
+    bytes.fromhex("69dc0001000a0104504f503032e20b0d"),
+    bytes.fromhex("69e00001000a0104504f503031d2690d"),
+    bytes.fromhex("6a670001000a010450435030319d5b0d"),
+    bytes.fromhex("6a690001000a01045043503032ad380d"),
+    bytes.fromhex("6a6b0001000a01045043503033bd190d"),
+]
+
+RESPONSES = {
+    b"QPI": b"(PI30",
+    b"QID": b"(96332309100452",
+    b"QVFW": b"(VERFW:00069.05",
+    b"QVFW2": b"(VERFW2:00012.21",
+    b"QPIGS": b"(120.4 59.9 120.4 59.9 1575 1481 024 232 53.70 000 100 0041 00.0 000.0 00.00 00000 00010000 00 00 00000 010",
+    b"QPIGS2": b"(00.0 000.0 00000 ",
+    b"QPIRI": b"(120.0 54.1 120.0 60.0 54.1 6500 6500 48.0 51.0 44.0 56.0 56.0 3 020 020 1 1 2 9 01 0 7 53.0 0 1 480 0 000",
+    b"QMOD": b"(L",
+    b"QPIWS": b"(100000000000000001000000000000000000",
+    b"QFLAG": b"(EkxyzDabjuv",
+    b"POP02": b"(ACK",
+    b"PCP01": b"(NAK",
+}
+
+POLL_CYCLE = [b"QPIRI", b"QFLAG", b"QPIGS", b"QPIGS2", b"QMOD", b"QPIWS"]
+
+
+def frame_response(counter, payload, preamble=b'\xff\x04'):
+    return voltronic_tools.package_frame(counter, preamble, payload)
+
+
+def response_stream(cycles, first_counter=1000):
+    # the inbound side of a session: `cycles` rounds of the six telemetry polls
+    frames = []
+    counter = first_counter
+    for _ in range(cycles):
+        for command in POLL_CYCLE:
+            frames.append(frame_response(counter, RESPONSES[command]))
+            counter = (counter + 1) & 0xFFFF
+    return frames
@@ -0,0 +1,360 @@
+#!/bin/python
+# End to end load test: N simulated inverters -> the bridge -> a local MQTT broker stand-in.
+#
+# The bridge runs as it would in production (python -m voltronic_wifi_bridge.main) in a child
+# process, so its CPU and memory are measured on their own.  The simulated inverters and the
+# broker share this process's event loop.  Each simulated inverter puts a running sample number
+# in pv1_input_power, so every QPIGS sample can be timed from the inverter's answer to its
+# arrival at the broker.  Set commands are published through the broker at --command-interval
+# and timed until they reach the inverter.  The bridge is started with --min-write-interval 0 so
+# the commands time the bridge rather than its write rate limit; pass -- --min-write-interval 30
+# to time them with the default.
+#
+#   python benchmarks/fleet_load_test.py --inverters 200 --qpigs-interval 1 --seconds 60
+#
+# Anything after -- is passed to the bridge, e.g. -- --publish-mode json --inflight-window 2
+# With --workers N the bridge runs N worker processes and CPU, threads and memory are summed over
+# all of them, so runs at 1, 2, 4 ... workers show how throughput scales with cores.
+# Linux only (CPU, thread and memory figures are read from /proc).
+import argparse
+import asyncio
+import json
+import os
+import resource
+import subprocess
+import sys
+import time
+
+from voltronic_wifi_bridge import mqtt_client
+from voltronic_wifi_bridge import voltronic_simulator
+
+BASE_TOPIC = "voltronic"
+
+
+class MiniBroker():
+    # just enough MQTT 3.1.1 for the bridge: CONNECT, SUBSCRIBE, PUBLISH at QoS 0/1, PING and
+    # DISCONNECT.  Every publish is handed to on_publish and forwarded to matching subscribers.
+    def __init__(self, on_publish):
+        self._on_publish = on_publish
+        self._router = mqtt_client.TopicRouter()
+        self._server = None
+        self.messages_in = 0
+        return
+
+    async def start(self, port):
+        self._server = await asyncio.start_server(self._handle_client, "127.0.0.1", port)
+        return
+
+    def close(self):
+        self._server.close()
+        return
+
+    def publish(self, topic, payload):
+        # deliver a message from the harness itself
+        packet = self._publish_packet(topic, payload)
+        for writer in set(self._router.match(topic)):
+            writer.write(packet)
+        return
+
+    def _publish_packet(self, topic, payload):
+        topic = topic.encode('utf-8')
+        body = len(topic).to_bytes(2, "big") + topic + payload
+        return b"\x30" + _encode_length(len(body)) + body
+
+    async def _handle_client(self, reader, writer):
+        filters = []
+        try:
+            while True:
+                first = await reader.readexactly(1)
+                length = 0
+                multiplier = 1
+                while True:
+                    byte = (await reader.readexactly(1))[0]
+                    length += (byte & 0x7F) * multiplier
+                    multiplier *= 128
+                    if byte & 0x80 == 0:
+                        break
+                body = await reader.readexactly(length)
+                packet_type = first[0] >> 4
+                if packet_type == 1:
+                    writer.write(b"\x20\x02\x00\x00")
+                elif packet_type == 3:
+                    qos = (first[0] >> 1) & 0x03
+                    topic_length = int.from_bytes(body[0:2], "big")
+                    topic = body[2:2 + topic_length].decode('utf-8')
+                    offset = 2 + topic_length
+                    if qos > 0:
+                        writer.write(b"\x40\x02" + body[offset:offset + 2])
+                        offset += 2
+                    payload = body[offset:]
+                    self.messages_in += 1
+                    self._on_publish(topic, payload)
+                    self.publish(topic, payload)
+                elif packet_type == 8:
+                    packet_id = body[0:2]
+                    offset = 2
+                    granted = b""
+                    while offset < len(body):
+                        filter_length = int.from_bytes(body[offset:offset + 2], "big")
+                        topicfilter = body[offset + 2:offset + 2 + filter_length].decode('utf-8')
+                        offset += 3 + filter_length
+                        if topicfilter not in filters:
+                            filters.append(topicfilter)
+                            self._router.add(topicfilter, writer)
+                        granted += b"\x00"
+                    writer.write(b"\x90" + _encode_length(2 + len(granted)) + packet_id + granted)
+                elif packet_type == 10:
+                    writer.write(b"\xb0\x02" + body[0:2])
+                elif packet_type == 12:
+                    writer.write(b"\xd0\x00")
+                elif packet_type == 14:
+                    break
+        except (asyncio.IncompleteReadError, ConnectionError, asyncio.CancelledError):
+            pass
+        finally:
+            for topicfilter in filters:
+                self._router.remove(topicfilter, writer)
+            writer.close()
+        return
+
+
+def _encode_length(length):
+    encoded = bytearray()
+    while True:
+        byte = length % 128
+        length //= 128
+        if length > 0:
+            byte |= 0x80
+        encoded.append(byte)
+        if length == 0:
+            return bytes(encoded)
+
+
+class LoadTest():
+    def __init__(self, args):
+        self._args = args
+        self._sample_times = {}
+        self._command_times = {}
+        self.sample_latencies = []
+        self.command_latencies = []
+        self.samples_sent = 0
+        self.commands_sent = 0
+        self.commands_received = 0
+        return
+
+    def reset(self):
+        self.sample_latencies = []
+        self.command_latencies = []
+        self.samples_sent = 0
+        self.commands_sent = 0
+        self.commands_received = 0
+        return
+
+    def on_sample(self, serial, sequence):
+        self._sample_times[(serial, sequence)] = time.monotonic()
+        self.samples_sent += 1
+        return
+
+    def on_command(self, serial, command):
+        sent = self._command_times.pop((serial, command), None)
+        if sent is not None:
+            self.commands_received += 1
+            self.command_latencies.append(time.monotonic() - sent)
+        return
+
+    def on_publish(self, topic, payload):
+        parts = topic.split("/")
+        if len(parts) != 3:
+            return
+        if parts[2] == "pv1_input_power":
+            sequence = int(float(payload))
+        elif parts[2] == "qpigs":
+            sequence = int(json.loads(payload)["pv1_input_power"])
+        else:
+            return
+        sent = self._sample_times.pop((parts[1], sequence), None)
+        if sent is not None:
+            self.sample_latencies.append(time.monotonic() - sent)
+        return
+
+    async def send_commands(self, broker, inverters):
+        # alternate each inverter between two output priorities
+        settings = [("utility_solar_battery", b"POP00"), ("solar_battery_utility", b"POP02")]
+        round_number = 0
+        while True:
+            await asyncio.sleep(self._args.command_interval)
+            setting, command = settings[round_number % 2]
+            round_number += 1
+            for inverter in inverters:
+                self._command_times[(inverter.serial, command)] = time.monotonic()
+                broker.publish("{}/{}/command/set_output_priority".format(BASE_TOPIC, inverter.serial), setting.encode('ascii'))
+                self.commands_sent += 1
+        return
+
+    async def run(self):
+        args = self._args
+        broker = MiniBroker(self.on_publish)
+        await broker.start(args.broker_port)
+        bridge = subprocess.Popen([sys.executable, "-m", "voltronic_wifi_bridge.main", "127.0.0.1", str(args.broker_port), "-t", BASE_TOPIC,
+                                   "-P", str(args.bridge_port), "-m", args.mode, "--poll-interval", "QPIGS={}".format(args.qpigs_interval),
+                                   "--workers", str(args.workers), "--log-level", "WARNING", "--min-write-interval", "0"] + args.bridge_args,
+                                  stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL if not args.show_bridge_output else None)
+        tasks = []
+        inverters = []
+        try:
+            if not await wait_for_port(args.bridge_port):
+                raise Exception("bridge did not start listening on port {}".format(args.bridge_port))
+            for index in range(args.inverters):
+                inverter = voltronic_simulator.SimulatedInverter("127.0.0.1", args.bridge_port, "{:014d}".format(10000000000000 + index),
+                                                                 latency=args.latency, jitter=args.jitter, nak_rate=args.nak_rate,
+                                                                 corrupt_rate=args.corrupt_rate, max_concurrent=args.max_concurrent,
+                                                                 sequence_field="pv1_input_power", on_sample=self.on_sample,
+                                                                 on_command=self.on_command)
+                inverters.append(inverter)
+                tasks.append(asyncio.ensure_future(inverter.run()))
+                if index % 100 == 99:
+                    # don't overflow the listen backlog
+                    await asyncio.sleep(0.05)
+            if args.command_interval > 0:
+                tasks.append(asyncio.ensure_future(self.send_commands(broker, inverters)))
+
+            await asyncio.sleep(args.settle_seconds)
+            self.reset()
+            messages_start = broker.messages_in
+            cpu_start, _, _ = read_proc_stats(bridge.pid)
+            wall_start = time.monotonic()
+            await asyncio.sleep(args.seconds)
+            wall = time.monotonic() - wall_start
+            cpu_end, threads, rss_kb = read_proc_stats(bridge.pid)
+            messages = broker.messages_in - messages_start
+            # anything sent more than a few seconds before the end that hasn't arrived is lost
+            cutoff = time.monotonic() - 5
+            lost = sum(1 for sent in self._sample_times.values() if sent < cutoff and sent >= wall_start)
+        finally:
+            for inverter in inverters:
+                inverter.stop()
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            bridge.terminate()
+            try:
+                bridge.wait(10)
+            except subprocess.TimeoutExpired:
+                bridge.kill()
+                bridge.wait()
+            broker.close()
+
+        cpu_fraction = (cpu_end - cpu_start) / wall
+        return {
+            "mode": args.mode,
+            "workers": args.workers,
+            "inverters": args.inverters,
+            "connected": sum(1 for inverter in inverters if inverter.counters["connections"] > 0),
+            "mqtt_messages_per_second": round(messages / wall, 1),
+            "samples_per_second": round(len(self.sample_latencies) / wall, 1),
+            "samples_lost": lost,
+            "sample_latency_ms": percentiles(self.sample_latencies),
+            "commands_sent": self.commands_sent,
+            "commands_received": self.commands_received,
+            "command_latency_ms": percentiles(self.command_latencies),
+            "cpu_percent": round(cpu_fraction * 100, 2),
+            "threads": threads,
+            "rss_mb": round(rss_kb / 1024, 1),
+        }
+
+
+def percentiles(values):
+    if len(values) == 0:
+        return None
+    values = sorted(values)
+    result = {}
+    for name, fraction in [("p50", 0.5), ("p90", 0.9), ("p99", 0.99)]:
+        result[name] = round(values[min(len(values) - 1, int(fraction * len(values)))] * 1000, 2)
+    result["max"] = round(values[-1] * 1000, 2)
+    return result
+
+
+def read_proc_stats(pid):
+    # summed over the process and its children (the workers under --workers)
+    ticks = os.sysconf("SC_CLK_TCK")
+    cpu = 0
+    threads = 0
+    rss_kb = 0
+    for process in [pid] + child_pids(pid):
+        try:
+            with open("/proc/{}/stat".format(process)) as f:
+                fields = f.read().rsplit(")", 1)[1].split()
+            cpu += (int(fields[11]) + int(fields[12])) / ticks
+            with open("/proc/{}/status".format(process)) as f:
+                for line in f:
+                    if line.startswith("Threads:"):
+                        threads += int(line.split()[1])
+                    elif line.startswith("VmRSS:"):
+                        rss_kb += int(line.split()[1])
+        except FileNotFoundError:
+            pass
+    return cpu, threads, rss_kb
+
+
+def child_pids(pid):
+    children = []
+    for task in os.listdir("/proc/{}/task".format(pid)):
+        try:
+            with open("/proc/{}/task/{}/children".format(pid, task)) as f:
+                children.extend(int(child) for child in f.read().split())
+        except FileNotFoundError:
+            pass
+    return children
+
+
+async def wait_for_port(port, timeout=10):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            _, writer = await asyncio.open_connection("127.0.0.1", port)
+            writer.close()
+            return True
+        except OSError:
+            await asyncio.sleep(0.1)
+    return False
+
+
+def raise_fd_limit():
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < hard:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    return
+
+
+def main():
+    argv = sys.argv[1:]
+    bridge_args = []
+    if "--" in argv:
+        bridge_args = argv[argv.index("--") + 1:]
+        argv = argv[:argv.index("--")]
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--inverters", type=int, default=50)
+    parser.add_argument("--mode", choices=["threaded", "asyncio"], default="asyncio")
+    parser.add_argument("--workers", type=int, default=1, help="bridge worker processes")
+    parser.add_argument("--qpigs-interval", type=float, default=1, help="seconds between QPIGS polls")
+    parser.add_argument("--command-interval", type=float, default=10, help="seconds between set commands to every inverter, 0 for none")
+    parser.add_argument("--latency", type=float, default=0.05, help="simulated inverter response time")
+    parser.add_argument("--jitter", type=float, default=0.0)
+    parser.add_argument("--nak-rate", type=float, default=0.0)
+    parser.add_argument("--corrupt-rate", type=float, default=0.0)
+    parser.add_argument("--max-concurrent", type=int, default=1)
+    parser.add_argument("--settle-seconds", type=float, default=20, help="time allowed for connect and handshake")
+    parser.add_argument("--seconds", type=float, default=30, help="length of the measured window")
+    parser.add_argument("--bridge-port", type=int, default=3503)
+    parser.add_argument("--broker-port", type=int, default=3883)
+    parser.add_argument("--show-bridge-output", action="store_true")
+    args = parser.parse_args(argv)
+    args.bridge_args = bridge_args
+
+    raise_fd_limit()
+    print(json.dumps(asyncio.run(LoadTest(args).run()), indent=2))
+    return
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,423 @@
+#!/bin/python
+# The benchmark suite: the hot paths one at a time and then the whole bridge, with a comparison
+# between two runs to catch regressions.
+#
+# The micro-benchmarks run the recorded frames in captured_frames.py through
+#   crc       cal_crc_half and package_frame
+#   framing   FrameBuffer splitting a stream of poll responses read 1460 bytes at a time
+#   receive   a session's whole receive path: framing, the CRC check, finding the pending query,
+#             its process_response and publishing the fields
+#   parsing   each poll's Query*.process_response on its own
+#   publish   Publisher in each publish mode into MQTTClient, with and without the outbox
+#   dispatch  MQTTClient.on_message finding one inverter's command callback among
+#             --dispatch-inverters
+# MQTTClient talks to a stand-in for paho that takes every message, so nothing needs a broker.
+# Each figure is the best of --repeat runs.
+#
+# The macro-benchmark (fleet) runs a VoltronicServer in this process with --inverters simulated
+# inverters connected to it and an MQTT stand-in that times each QPIGS sample from the inverter
+# sending it to its pv1_input_power field being published.  It waits out the identity handshake
+# (about 10 seconds) before measuring.  cpu_percent is for the whole process, simulated inverters
+# included.
+#
+#   python benchmarks/suite.py --output before.json
+#   python benchmarks/suite.py --output after.json
+#   python benchmarks/suite.py --compare before.json after.json --threshold 10
+#
+# --compare exits 1 if any figure is worse by more than --threshold percent.  Figures named
+# *_per_second are better higher; *_ms, *_s, *_lost and cpu_percent are better lower; the others
+# are only shown.
+import argparse
+import asyncio
+import json
+import platform
+import sys
+import time
+
+import paho.mqtt.client as mqtt
+
+from voltronic_wifi_bridge import mqtt_client
+from voltronic_wifi_bridge import mqtt_outbox
+from voltronic_wifi_bridge import voltronic_async_server
+from voltronic_wifi_bridge import voltronic_publisher
+from voltronic_wifi_bridge import voltronic_replay
+from voltronic_wifi_bridge import voltronic_schemas
+from voltronic_wifi_bridge import voltronic_server
+from voltronic_wifi_bridge import voltronic_simulator
+from voltronic_wifi_bridge import voltronic_tools
+from captured_frames import POLL_CYCLE, RESPONSES, response_stream
+from fleet_load_test import percentiles
+
+CASES = ["crc", "framing", "receive", "parsing", "publish", "dispatch", "fleet"]
+
+SERIAL = "96332309100452"
+CHUNK_SIZE = 1460
+
+
+class OfflinePaho():
+    # stands in for paho's client under MQTTClient: connects to nothing and takes every publish
+    class Result():
+        rc = mqtt.MQTT_ERR_SUCCESS
+
+    def __init__(self):
+        self.published = 0
+        return
+
+    def connect(self, host, port, keepalive):
+        return
+
+    def loop_start(self):
+        return
+
+    def loop_stop(self):
+        return
+
+    def subscribe(self, topic):
+        return
+
+    def publish(self, topic, payload, retain=False):
+        self.published += 1
+        return self.Result
+
+
+class OfflineMQTTClient(mqtt_client.MQTTClient):
+    def __init__(self, outbox=None):
+        mqtt_client.MQTTClient.__init__(self, "offline", 1883, "voltronic", outbox=outbox)
+        return
+
+    def _register_client(self):
+        return OfflinePaho()
+
+
+class CountingMQTT():
+    # stands in for MQTTClient under a session and counts what it publishes
+    def __init__(self):
+        self.published = 0
+        return
+
+    def publish_message(self, topicpart, message, retain=False):
+        self.published += 1
+        return
+
+    def register_message_callback(self, callback, topicmatch):
+        return
+
+    def unregister_message_callback(self, callback, topicmatch):
+        return
+
+
+class SampleMQTT(CountingMQTT):
+    # times each QPIGS sample from the simulated inverter sending it to its publish
+    def __init__(self):
+        CountingMQTT.__init__(self)
+        self._sent = {}
+        self.reset()
+        return
+
+    def reset(self):
+        self.published = 0
+        self.samples_sent = 0
+        self.latencies = []
+        return
+
+    def on_sample(self, serial, sequence):
+        self._sent[(serial, sequence)] = time.monotonic()
+        self.samples_sent += 1
+        return
+
+    def publish_message(self, topicpart, message, retain=False):
+        self.published += 1
+        serial, _, field = topicpart.partition("/")
+        if field == "pv1_input_power":
+            sent = self._sent.pop((serial, int(float(message))), None)
+            if sent is not None:
+                self.latencies.append(time.monotonic() - sent)
+        return
+
+    def unanswered(self, since, before):
+        return sum(1 for sent in self._sent.values() if since <= sent < before)
+
+
+def identified_session(sink):
+    # a session part way through its life: identity known, nothing pending
+    session = voltronic_server.VoltronicSession(("benchmark", 0), mqtt_client=sink)
+    session._protocol_version = 30
+    session._inverter_serial_number = SERIAL
+    return session
+
+
+def best_rate(function, number, repeat):
+    # calls per second over the fastest of repeat runs
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for _ in range(number):
+            function()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return round(number / best)
+
+
+def chunked(frames):
+    stream = b"".join(frames)
+    return [stream[offset:offset + CHUNK_SIZE] for offset in range(0, len(stream), CHUNK_SIZE)]
+
+
+def bench_crc(args):
+    payload = RESPONSES[b"QPIGS"]
+    return {
+        "cal_crc_half_per_second": best_rate(lambda: voltronic_tools.cal_crc_half(payload), args.number * 10, args.repeat),
+        "package_frame_per_second": best_rate(lambda: voltronic_tools.package_frame(1000, b'\xff\x04', payload), args.number * 10, args.repeat),
+    }
+
+
+def bench_framing(args):
+    frames = response_stream(args.cycles)
+    chunks = chunked(frames)
+    best = None
+    for _ in range(args.repeat):
+        buffer = voltronic_tools.FrameBuffer()
+        count = 0
+        start = time.perf_counter()
+        for chunk in chunks:
+            buffer.feed(chunk)
+            frame = buffer.next_frame()
+            while frame is not None:
+                count += 1
+                frame = buffer.next_frame()
+        elapsed = time.perf_counter() - start
+        if count != len(frames):
+            raise Exception("framing found {} of {} frames".format(count, len(frames)))
+        best = elapsed if best is None else min(best, elapsed)
+    return {
+        "frames_per_second": round(len(frames) / best),
+        "megabytes_per_second": round(sum(len(chunk) for chunk in chunks) / best / 1e6, 2),
+    }
+
+
+def bench_receive(args):
+    sink = CountingMQTT()
+    session = identified_session(sink)
+    frames = response_stream(args.cycles)
+    chunks = chunked(frames)
+    best = None
+    for _ in range(args.repeat):
+        # the queries these frames answer, under the counters response_stream gave them
+        for index, frame in enumerate(frames):
+            query = voltronic_replay.make_query(POLL_CYCLE[index % len(POLL_CYCLE)], session)
+            query._counter = int.from_bytes(frame[0:2], "big")
+            query._message_generated_time = time.time()
+            session._queries.add(query, float("inf"))
+        start = time.perf_counter()
+        for chunk in chunks:
+            session._feed(chunk)
+        elapsed = time.perf_counter() - start
+        if len(session._queries) > 0 or session._invalidresponse_count > 0:
+            raise Exception("{} responses went unmatched and {} were invalid".format(len(session._queries), session._invalidresponse_count))
+        best = elapsed if best is None else min(best, elapsed)
+    if sink.published == 0:
+        raise Exception("the session published nothing")
+    return {"responses_per_second": round(len(frames) / best)}
+
+
+def bench_parsing(args):
+    session = identified_session(CountingMQTT())
+    results = {}
+    for command in POLL_CYCLE:
+        query = voltronic_server.POLL_QUERIES[command.decode('ascii')](session)
+        msg = RESPONSES[command]
+        results[command.decode('ascii').lower() + "_per_second"] = best_rate(lambda: query.process_response(msg), args.number, args.repeat)
+    return results
+
+
+def bench_publish(args):
+    items = list(voltronic_schemas.get_schema(b"QPIGS").parse(RESPONSES[b"QPIGS"]).published_items())
+    results = {}
+    client = OfflineMQTTClient()
+    results["mqtt_client_messages_per_second"] = best_rate(lambda: client.publish_message(SERIAL + "/grid_voltage", 120.4), args.number * 10, args.repeat)
+    for mode in voltronic_publisher.Publisher.modes:
+        publisher = voltronic_publisher.Publisher(client, mode=mode)
+        results[mode + "_polls_per_second"] = best_rate(lambda: publisher.publish_fields(SERIAL, "QPIGS", items), args.number, args.repeat)
+    # the outbox with the broker connected, which is how every message goes with --mqtt-buffer-messages
+    outbox = mqtt_outbox.Outbox("voltronic")
+    outbox.set_connected(True)
+    publisher = voltronic_publisher.Publisher(OfflineMQTTClient(outbox=outbox))
+    results["fields_outbox_polls_per_second"] = best_rate(lambda: publisher.publish_fields(SERIAL, "QPIGS", items), args.number, args.repeat)
+    outbox.exit()
+    return results
+
+
+def bench_dispatch(args):
+    class Message():
+        def __init__(self, topic, payload):
+            self.topic = topic
+            self.payload = payload
+
+    received = []
+    client = OfflineMQTTClient()
+    for index in range(args.dispatch_inverters):
+        client.register_message_callback(received.append, "{:014d}/command/#".format(10000000000000 + index))
+    serial = "{:014d}".format(10000000000000 + args.dispatch_inverters // 2)
+    message = Message("voltronic/{}/command/set_output_priority".format(serial), b"solar_battery_utility")
+    results = {"messages_per_second": best_rate(lambda: client.on_message(None, None, message), args.number * 10, args.repeat)}
+    if len(received) != args.number * 10 * args.repeat:
+        raise Exception("dispatch delivered {} messages, expected {}".format(len(received), args.number * 10 * args.repeat))
+    return results
+
+
+async def bench_fleet(args):
+    sink = SampleMQTT()
+    options = {"poll_intervals": {"QPIGS": args.qpigs_interval}}
+    if args.mode == "asyncio":
+        bridge = voltronic_async_server.AsyncVoltronicServer(args.port, **options)
+    else:
+        bridge = voltronic_server.VoltronicServer(args.port, **options)
+    bridge.register_mqtt(sink)
+    bridge.start()
+    await asyncio.sleep(0.5)
+
+    inverters = []
+    tasks = []
+    try:
+        for index in range(args.inverters):
+            inverter = voltronic_simulator.SimulatedInverter("127.0.0.1", args.port, "{:014d}".format(10000000000000 + index),
+                                                             latency=args.latency, sequence_field="pv1_input_power", on_sample=sink.on_sample)
+            inverters.append(inverter)
+            tasks.append(asyncio.ensure_future(inverter.run()))
+        started = time.monotonic()
+        while bridge.session_counts()["identified"] < args.inverters:
+            if time.monotonic() - started > args.settle_timeout:
+                raise Exception("only {} of {} inverters identified within {} seconds".format(bridge.session_counts()["identified"], args.inverters,
+                                                                                           args.settle_timeout))
+            await asyncio.sleep(0.2)
+        identified = time.monotonic() - started
+        # the first polls are spread over a few seconds
+        await asyncio.sleep(5)
+
+        sink.reset()
+        wall_start = time.monotonic()
+        cpu_start = time.process_time()
+        await asyncio.sleep(args.seconds)
+        cpu = time.process_time() - cpu_start
+        wall_end = time.monotonic()
+        wall = wall_end - wall_start
+        # a sample still unpublished a second after it was sent is counted as lost
+        await asyncio.sleep(1)
+        lost = sink.unanswered(wall_start, wall_end - 1)
+    finally:
+        for inverter in inverters:
+            inverter.stop()
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        bridge.exit()
+        await asyncio.get_running_loop().run_in_executor(None, bridge.join)
+
+    return {
+        "mode": args.mode,
+        "inverters": args.inverters,
+        "identified_s": round(identified, 2),
+        "samples_per_second": round(len(sink.latencies) / wall, 1),
+        "samples_lost": lost,
+        "messages_per_second": round(sink.published / wall, 1),
+        "sample_latency_ms": percentiles(sink.latencies),
+        "cpu_percent": round(cpu / wall * 100, 2),
+    }
+
+
+def run(args):
+    results = {
+        "python": platform.python_version(),
+        "started": round(time.time()),
+        "cases": {},
+    }
+    micro = {"crc": bench_crc, "framing": bench_framing, "receive": bench_receive, "parsing": bench_parsing,
+             "publish": bench_publish, "dispatch": bench_dispatch}
+    for case in args.cases:
+        if case == "fleet":
+            results["cases"][case] = asyncio.run(bench_fleet(args))
+        else:
+            results["cases"][case] = micro[case](args)
+    return results
+
+
+def flatten(results, prefix=""):
+    # {"a": {"b": 1}} -> {"a.b": 1}, numbers only
+    figures = {}
+    for name, value in results.items():
+        if isinstance(value, dict):
+            figures.update(flatten(value, prefix + name + "."))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            figures[prefix + name] = value
+    return figures
+
+
+def direction(name):
+    # 1 if the figure is better higher, -1 if better lower, 0 if it's only shown
+    for part in reversed(name.split(".")):
+        if part.endswith("_per_second"):
+            return 1
+        if part.endswith(("_ms", "_s", "_lost")) or part == "cpu_percent":
+            return -1
+    return 0
+
+
+def compare(old, new, threshold):
+    old_figures = flatten(old["cases"])
+    new_figures = flatten(new["cases"])
+    report = {"threshold_percent": threshold, "regressions": [], "improvements": [], "figures": {}}
+    for name in sorted(set(old_figures) | set(new_figures)):
+        before = old_figures.get(name)
+        after = new_figures.get(name)
+        figure = {"old": before, "new": after}
+        if before is not None and after is not None and before != 0:
+            change = (after - before) / abs(before) * 100
+            figure["change_percent"] = round(change, 1)
+            better = change * direction(name)
+            if better < -threshold:
+                report["regressions"].append(name)
+            elif better > threshold:
+                report["improvements"].append(name)
+        report["figures"][name] = figure
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--cases", nargs="+", choices=CASES, default=CASES)
+    parser.add_argument("--output", help="write the results to this file as well as printing them")
+    parser.add_argument("--compare", nargs=2, metavar=("OLD", "NEW"), help="compare two results files instead of running anything")
+    parser.add_argument("--threshold", type=float, default=10, help="percent worse that counts as a regression")
+    parser.add_argument("--number", type=int, default=5000, help="calls per timing run in the micro-benchmarks")
+    parser.add_argument("--repeat", type=int, default=5, help="timing runs per figure, the fastest is kept")
+    parser.add_argument("--cycles", type=int, default=1000, help="poll cycles in the framing and receive streams")
+    parser.add_argument("--dispatch-inverters", type=int, default=1000, help="inverters with a command callback in the dispatch case")
+    parser.add_argument("--mode", choices=["threaded", "asyncio"], default="threaded", help="server for the fleet case")
+    parser.add_argument("--inverters", type=int, default=20, help="simulated inverters in the fleet case")
+    parser.add_argument("--qpigs-interval", type=float, default=1, help="QPIGS poll interval in the fleet case")
+    parser.add_argument("--latency", type=float, default=0.05, help="simulated inverter response time")
+    parser.add_argument("--seconds", type=float, default=20, help="length of the measured window in the fleet case")
+    parser.add_argument("--settle-timeout", type=float, default=60, help="give up if the fleet isn't identified within this long")
+    parser.add_argument("--port", type=int, default=3560)
+    args = parser.parse_args()
+
+    if args.compare is not None:
+        with open(args.compare[0]) as f:
+            old = json.load(f)
+        with open(args.compare[1]) as f:
+            new = json.load(f)
+        report = compare(old, new, args.threshold)
+        print(json.dumps(report, indent=2))
+        sys.exit(1 if len(report["regressions"]) > 0 else 0)
+
+    results = run(args)
+    text = json.dumps(results, indent=2)
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            f.write(text + "\n")
+    print(text)
+    return
+
+
+if __name__ == "__main__":
+    main()
@@ -1,19 +1,47 @@
 #!/bin/python
 import argparse
+import os
 import sys
-import pprint
-import time
+import logging
 import signal
 
 from voltronic_wifi_bridge import voltronic_server
+from voltronic_wifi_bridge import voltronic_async_server
 from voltronic_wifi_bridge import mqtt_client
+from voltronic_wifi_bridge import mqtt_outbox
+from voltronic_wifi_bridge import voltronic_publisher
+from voltronic_wifi_bridge import voltronic_scheduler
+from voltronic_wifi_bridge import voltronic_metrics
+from voltronic_wifi_bridge import voltronic_history
+from voltronic_wifi_bridge import voltronic_influx
+from voltronic_wifi_bridge import voltronic_proxy
+from voltronic_wifi_bridge import voltronic_discovery
+from voltronic_wifi_bridge import voltronic_supervisor
+from voltronic_wifi_bridge import voltronic_registry
+from voltronic_wifi_bridge import voltronic_identity
+from voltronic_wifi_bridge import voltronic_aggregate
+from voltronic_wifi_bridge import voltronic_energy
+
+logger = logging.getLogger(__name__)
 
 
 class VoltronicRelay():
     def __init__(self):
         self.mqttc = None
         self.vserver = None
+        self.metrics_server = None
+        self.metrics_reporter = None
+        self.history = None
+        self.influx = None
+        self.discovery = None
+        self.identity_cache = None
+        self.upstream = None
+        self.outbox = None
+        self.aggregator = None
+        self.energy = None
+        self._supervisor = None
         self._cleaned_up = False
+        self._cleaning_up = False
         self._run_parser()
     
     def _run_parser(self):
@@ -24,30 +52,310 @@ class VoltronicRelay():
         parser.add_argument("-p", "--password", help="password for the mqtt server")
         parser.add_argument("-t", "--topic", help="mqtt topic base", default="voltronic")
         parser.add_argument("-P", "--port", type=int, help="the port to run the voltronic server on", default=502)
+        parser.add_argument("-m", "--server-mode", choices=["threaded", "asyncio"], default="threaded",
+                            help="run a thread per inverter connection or serve every inverter from one asyncio event loop")
+        parser.add_argument("-w", "--workers", type=int, default=1,
+                            help="run this many worker processes sharing the inverter port (SO_REUSEPORT), restarted if they crash")
+        parser.add_argument("--mqtt-buffer-messages", type=int, default=10000,
+                            help="messages held in memory while the broker is unreachable, 0 to not hold any")
+        parser.add_argument("--mqtt-buffer-dir", help="spill held messages beyond --mqtt-buffer-messages to a file in this directory")
+        parser.add_argument("--mqtt-buffer-bytes", type=int, default=64 * 1024 * 1024, help="size of the spill file")
+        parser.add_argument("--mqtt-buffer-rate", type=float, default=200, help="held messages sent per second once the broker is back")
+        parser.add_argument("--mqtt-buffer-policy", action="append", default=[], metavar="FILTER=POLICY",
+                            help="what to hold for topics matching FILTER (inside the base topic) while the broker is unreachable: "
+                                 "{} (repeatable, first match wins; defaults: {})".format(
+                                     ", ".join(mqtt_outbox.POLICIES), ", ".join("{}={}".format(f, p) for f, p in mqtt_outbox.DEFAULT_POLICIES)))
+        parser.add_argument("--publish-mode", choices=voltronic_publisher.Publisher.modes, default="fields",
+                            help="fields: one message per field per poll, json: one json message per command per poll, changes: only fields that changed")
+        parser.add_argument("--deadband", action="append", default=[], metavar="FIELD=VALUE",
+                            help="in changes mode, how far a numeric field has to move before it is published again (repeatable)")
+        parser.add_argument("--default-deadband", type=float, default=0.0, help="deadband for numeric fields without their own --deadband")
+        parser.add_argument("--full-refresh-interval", type=float, default=300,
+                            help="in changes mode, seconds between publishing every field regardless of changes")
+        parser.add_argument("--poll-interval", action="append", default=[], metavar="COMMAND=SECONDS",
+                            help="seconds between polls of one of {} or 'once' for once per session (repeatable, defaults: {})".format(
+                                ", ".join(voltronic_server.POLL_QUERIES.keys()),
+                                ", ".join("{}={}".format(k, v) for k, v in voltronic_scheduler.DEFAULT_POLL_INTERVALS.items())))
+        parser.add_argument("--inflight-window", type=int, default=1,
+                            help="how many queries may be waiting for an answer from one inverter at once")
+        parser.add_argument("--inflight-window-for", action="append", default=[], metavar="PROTOCOL=WINDOW",
+                            help="in-flight window for inverters reporting a given QPI protocol version, e.g. 30=2 (repeatable)")
+        parser.add_argument("--idle-timeout", type=float, default=180,
+                            help="close an inverter connection that hasn't answered anything for this many seconds, 0 to never")
+        parser.add_argument("--ha-discovery", action="store_true", help="publish home assistant mqtt discovery configs for every inverter")
+        parser.add_argument("--ha-discovery-prefix", default="homeassistant", help="home assistant's discovery topic prefix")
+        parser.add_argument("--ha-discovery-rate", type=float, default=20, help="most discovery configs published per second")
+        parser.add_argument("--min-write-interval", type=float, default=30,
+                            help="least seconds between writes of the same setting; requests in between are merged into the latest")
+        parser.add_argument("--identity-cache", metavar="FILE",
+                            help="remember each inverter's serial, protocol and firmware here so a reconnect starts polling without the ~20 second handshake")
+        parser.add_argument("--upstream", metavar="HOST[:PORT]",
+                            help="pass each inverter through to the vendor's server as well, so its app keeps working (port defaults to 502)")
+        parser.add_argument("--upstream-reconnect-delay", type=float, default=10, help="seconds between attempts to reach the upstream server")
+        parser.add_argument("--metrics-port", type=int, help="serve prometheus metrics on this port (disabled by default)")
+        parser.add_argument("--metrics-address", default="127.0.0.1", help="address the metrics endpoint listens on")
+        parser.add_argument("--metrics-interval", type=float, default=0,
+                            help="seconds between json metric summaries published on <serial>/metrics, 0 to disable")
+        parser.add_argument("--capture-dir", help="record everything sent to and received from each inverter into files in this directory")
+        parser.add_argument("--capture-max-bytes", type=int, default=16 * 1024 * 1024, help="size at which a capture file is rotated")
+        parser.add_argument("--capture-backups", type=int, default=5, help="rotated capture files kept per inverter")
+        parser.add_argument("--history", action="store_true", help="keep recent history of numeric fields, queryable on <serial>/history/get")
+        parser.add_argument("--history-dir", help="keep the history in files in this directory so it survives a restart (implies --history)")
+        parser.add_argument("--history-commands", default=",".join(voltronic_history.DEFAULT_COMMANDS),
+                            help="comma separated commands whose numeric fields get history (default %(default)s)")
+        parser.add_argument("--site-totals", action="store_true",
+                            help="publish totals of power and battery current across every inverter, and per phase group, on <topic>/<site-topic>")
+        parser.add_argument("--site-topic", default="site", help="topic inside the base topic for the site totals")
+        parser.add_argument("--site-interval", type=float, default=5, help="seconds between site total updates")
+        parser.add_argument("--site-stale-after", type=float, default=30,
+                            help="leave an inverter out of the site totals once it hasn't sent a sample for this many seconds")
+        parser.add_argument("--energy", action="store_true",
+                            help="integrate PV, load, battery and estimated grid import energy from each QPIGS sample into kWh totals on <serial>/energy")
+        parser.add_argument("--energy-file", metavar="FILE", help="checkpoint the energy totals to this file so they survive a restart (implies --energy)")
+        parser.add_argument("--energy-max-gap", type=float, default=30,
+                            help="don't integrate between two samples further apart than this many seconds")
+        parser.add_argument("--energy-interval", type=float, default=30, help="seconds between energy total updates")
+        parser.add_argument("--influx-url", help="also write records to InfluxDB at this url, eg http://localhost:8086")
+        parser.add_argument("--influx-version", type=int, choices=[1, 2], default=1, help="InfluxDB write api version")
+        parser.add_argument("--influx-database", default="voltronic", help="v1 database")
+        parser.add_argument("--influx-username", help="v1 username")
+        parser.add_argument("--influx-password", help="v1 password")
+        parser.add_argument("--influx-org", help="v2 organisation")
+        parser.add_argument("--influx-bucket", default="voltronic", help="v2 bucket")
+        parser.add_argument("--influx-token", help="v2 api token")
+        parser.add_argument("--influx-batch-size", type=int, default=5000, help="points per write")
+        parser.add_argument("--influx-flush-interval", type=float, default=10, help="longest seconds a point waits before being written")
+        parser.add_argument("--influx-buffer", type=int, default=100000, help="points kept while InfluxDB is unreachable, oldest dropped first")
+        parser.add_argument("--log-level", choices=["DEBUG", "INFO", "WARNING", "ERROR"], default="INFO",
+                            help="DEBUG logs every frame sent and received")
         args = parser.parse_args()
-        pprint.pprint(args)
+        logging.basicConfig(level=getattr(logging, args.log_level), format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+        logger.debug("options: %s", args)
+        deadbands = self._parse_assignments(parser, "--deadband", args.deadband, float)
+        poll_intervals = self._parse_assignments(parser, "--poll-interval", args.poll_interval, self._parse_interval)
+        buffer_policies = self._parse_assignments(parser, "--mqtt-buffer-policy", args.mqtt_buffer_policy, self._parse_buffer_policy)
+        for command in poll_intervals.keys():
+            if command not in voltronic_server.POLL_QUERIES:
+                parser.error("unknown poll command {}, expected one of {}".format(command, ", ".join(voltronic_server.POLL_QUERIES.keys())))
+        inflight_windows = {}
+        for protocol, window in self._parse_assignments(parser, "--inflight-window-for", args.inflight_window_for, self._parse_window).items():
+            if not protocol.isdigit():
+                parser.error("--inflight-window-for expects a numeric protocol version, e.g. 30=2, got {}".format(protocol))
+            inflight_windows[int(protocol)] = window
+        if args.inflight_window < 1:
+            parser.error("--inflight-window must be at least 1")
+        session_options = {"poll_intervals": poll_intervals, "inflight_window": args.inflight_window, "inflight_windows": inflight_windows,
+                           "min_write_interval": args.min_write_interval, "idle_timeout": args.idle_timeout if args.idle_timeout > 0 else None}
+        if args.upstream is not None:
+            try:
+                session_options["upstream"] = voltronic_proxy.parse_address(args.upstream)
+            except ValueError:
+                parser.error("--upstream expects HOST or HOST:PORT, got {}".format(args.upstream))
+            session_options["upstream_reconnect_delay"] = args.upstream_reconnect_delay
+        if args.capture_dir is not None:
+            session_options.update({"capture_directory": args.capture_dir, "capture_max_bytes": args.capture_max_bytes,
+                                    "capture_backups": args.capture_backups})
+        if args.workers < 1:
+            parser.error("--workers must be at least 1")
+        if args.influx_url is not None and args.influx_version == 2 and (args.influx_org is None or args.influx_token is None):
+            parser.error("--influx-version 2 needs --influx-org and --influx-token")
+        self._args = args
+        self._deadbands = deadbands
+        self._buffer_policies = buffer_policies
+        self._session_options = session_options
+        return
+
+    def _build(self, worker=None):
+        # worker is the index of this process under --workers; the processes share the inverter port
+        # and each needs its own mqtt client id, metrics port and history directory
+        args = self._args
+        deadbands = self._deadbands
+        session_options = self._session_options
+        client_id = "voltronic-wifi-bridge"
+        metrics_port = args.metrics_port
+        history_dir = args.history_dir
+        spill_name = "outbox.spill"
+        site_topic = args.site_topic
+        if worker is not None:
+            spill_name = "outbox-{}.spill".format(worker)
+            # each worker only sees its own inverters
+            site_topic = "{}/worker-{}".format(site_topic, worker)
+            client_id = "voltronic-wifi-bridge-{}".format(worker)
+            if metrics_port is not None:
+                metrics_port += worker
+            if history_dir is not None:
+                history_dir = os.path.join(history_dir, "worker-{}".format(worker))
+        if "upstream" in session_options:
+            # looked up once here and then off the sessions' loops, see voltronic_proxy
+            self.upstream = voltronic_proxy.UpstreamResolver(session_options["upstream"])
+            self.upstream.resolve()
+            session_options = dict(session_options, upstream=self.upstream)
+        if args.identity_cache is not None:
+            # every worker uses the same file, they merge their changes into it
+            self.identity_cache = voltronic_identity.IdentityCache(args.identity_cache)
+            session_options = dict(session_options, identity_cache=self.identity_cache)
         if args.mqtthostname is not None:
-            self.mqttc = mqtt_client.MQTTClient(args.mqtthostname, args.mqttport, args.topic, username=args.user, password=args.password)
-            self.vserver = voltronic_server.VoltronicServer(args.port)
-            self.vserver.register_mqtt(self.mqttc)
+            if args.mqtt_buffer_messages > 0:
+                spill_path = os.path.join(args.mqtt_buffer_dir, spill_name) if args.mqtt_buffer_dir is not None else None
+                self.outbox = mqtt_outbox.Outbox(args.topic, policies=list(self._buffer_policies.items()), max_messages=args.mqtt_buffer_messages,
+                                                 spill_path=spill_path, spill_bytes=args.mqtt_buffer_bytes, rate=args.mqtt_buffer_rate)
+            self.mqttc = mqtt_client.MQTTClient(args.mqtthostname, args.mqttport, args.topic, username=args.user, password=args.password,
+                                                client_id=client_id, outbox=self.outbox)
+            # under --workers an inverter that reconnects to another worker takes its commands with it
+            claims = voltronic_registry.SerialClaims(self._supervisor.claims_directory) if worker is not None else None
+            if args.server_mode == "asyncio":
+                self.vserver = voltronic_async_server.AsyncVoltronicServer(args.port, reuse_port=worker is not None, claims=claims, **session_options)
+            else:
+                self.vserver = voltronic_server.VoltronicServer(args.port, reuse_port=worker is not None, claims=claims, **session_options)
+            publisher = voltronic_publisher.Publisher(self.mqttc, mode=args.publish_mode, deadbands=deadbands,
+                                                      default_deadband=args.default_deadband, full_refresh_interval=args.full_refresh_interval)
+            self.vserver.register_mqtt(self.mqttc, publisher)
+            energy = args.energy or args.energy_file is not None
+            if args.ha_discovery:
+                self.discovery = voltronic_discovery.HomeAssistantDiscovery(self.mqttc, publish_mode=args.publish_mode,
+                                                                            prefix=args.ha_discovery_prefix, rate=args.ha_discovery_rate,
+                                                                            energy=energy)
+                self.vserver.register_listener(self.discovery)
+            if args.history or args.history_dir is not None:
+                # under --workers only the worker serving an inverter answers for its history
+                self.history = voltronic_history.HistoryStore(commands=args.history_commands.split(","), directory=history_dir,
+                                                              answer_unknown=worker is None)
+                self.history.register_mqtt(self.mqttc)
+                self.vserver.register_listener(self.history)
+            if args.influx_url is not None:
+                self.influx = voltronic_influx.InfluxExporter(args.influx_url, version=args.influx_version, database=args.influx_database,
+                                                              username=args.influx_username, password=args.influx_password, org=args.influx_org,
+                                                              bucket=args.influx_bucket, token=args.influx_token, batch_size=args.influx_batch_size,
+                                                              flush_interval=args.influx_flush_interval, max_buffered=args.influx_buffer)
+                self.vserver.register_listener(self.influx)
+            if args.site_totals:
+                self.aggregator = voltronic_aggregate.SiteAggregator(self.mqttc, topic=site_topic, interval=args.site_interval,
+                                                                     stale_after=args.site_stale_after)
+                self.vserver.register_listener(self.aggregator)
+            if energy:
+                # every worker uses the same file, an inverter carries on from wherever it was last counted
+                self.energy = voltronic_energy.EnergyCounters(self.mqttc, path=args.energy_file, max_gap=args.energy_max_gap,
+                                                              publish_interval=args.energy_interval)
+                self.vserver.register_listener(self.energy)
+            if args.metrics_interval > 0:
+                self.metrics_reporter = voltronic_metrics.MetricsReporter(self.mqttc, args.metrics_interval)
+        if metrics_port is not None:
+            self.metrics_server = voltronic_metrics.MetricsHTTPServer(metrics_port, args.metrics_address)
         return
     
 
+    def _parse_assignments(self, parser, option, assignments, valuetype):
+        # turn ["name=value", ...] from a repeatable option into a dict
+        parsed = {}
+        for assignment in assignments:
+            name, sep, value = assignment.partition("=")
+            try:
+                if sep == "":
+                    raise ValueError()
+                parsed_value = valuetype(value)
+            except ValueError:
+                parser.error("{} expected NAME=VALUE, got {}".format(option, assignment))
+            if name in parsed:
+                parser.error("{} given more than once for {}".format(option, name))
+            parsed[name] = parsed_value
+        return parsed
+
+    def _parse_interval(self, value):
+        if value == "once":
+            return None
+        interval = float(value)
+        if interval <= 0:
+            raise ValueError()
+        return interval
+
+    def _parse_buffer_policy(self, value):
+        if value not in mqtt_outbox.POLICIES:
+            raise ValueError()
+        return value
+
+    def _parse_window(self, value):
+        window = int(value)
+        if window < 1:
+            raise ValueError()
+        return window
+
     def _clean_up(self, signum, frame):
-        print("cleaning up")
+        # SIGINT from a terminal reaches the workers as well as the supervisor's SIGTERM
+        if self._cleaning_up:
+            return
+        self._cleaning_up = True
+        logger.info("cleaning up")
         self.vserver.exit()
         self.vserver.join()
+        if self.identity_cache is not None:
+            self.identity_cache.close()
+        if self.upstream is not None:
+            self.upstream.exit()
+        if self.metrics_server is not None:
+            self.metrics_server.exit()
+        if self.metrics_reporter is not None:
+            self.metrics_reporter.exit()
+        if self.history is not None:
+            self.history.close()
+        if self.influx is not None:
+            self.influx.exit()
+            self.influx.join(15)
+        if self.discovery is not None:
+            self.discovery.exit()
+        if self.aggregator is not None:
+            self.aggregator.exit()
+        if self.energy is not None:
+            self.energy.exit()
         self.mqttc.loop_stop()
+        if self.outbox is not None:
+            self.outbox.exit()
         self._cleaned_up = True
         return
 
     def run(self):
+        if self._args.workers > 1:
+            self._supervisor = voltronic_supervisor.WorkerSupervisor(self._args.workers, self._run_worker)
+            self._supervisor.run()
+            return
+        self._build()
+        self._serve()
+        return
+
+    def _run_worker(self, worker):
+        self._build(worker)
+        self._serve()
+        return
+
+    def _serve(self):
         signal.signal(signal.SIGINT, self._clean_up)
         signal.signal(signal.SIGTERM, self._clean_up)
+        if self.upstream is not None:
+            self.upstream.start()
+        if self.identity_cache is not None:
+            self.identity_cache.start()
         self.vserver.start()
+        if self.metrics_server is not None:
+            self.metrics_server.start()
+        if self.metrics_reporter is not None:
+            self.metrics_reporter.start()
+        if self.influx is not None:
+            self.influx.start()
+        if self.discovery is not None:
+            self.discovery.start()
+        if self.aggregator is not None:
+            self.aggregator.start()
+        if self.energy is not None:
+            self.energy.start()
+        if self.outbox is not None:
+            self.outbox.start()
 
-        while not self._cleaned_up:
-            time.sleep(1)
+        # a signal runs _clean_up in this thread, which stops the server and ends the join
+        self.vserver.join()
+        if not self._cleaning_up:
+            # exiting lets the supervisor (or docker's restart policy) start us again
+            logger.error("inverter server stopped unexpectedly, exiting")
+            self._clean_up(None, None)
+            sys.exit(1)
         return
 
 
@@ -1,95 +1,208 @@
 #!/bin/python
 import time
+import logging
 import paho.mqtt.client as mqtt
 import threading
 
+logger = logging.getLogger(__name__)
 
 
+class _TopicNode():
+    __slots__ = ("children", "callbacks")
+
+    def __init__(self):
+        self.children = {}
+        self.callbacks = ()
+        return
+
+
+class TopicRouter():
+    # mqtt style topic filters (with + and # wildcards) kept in a trie of topic segments, so
+    # matching a topic costs its depth rather than the number of registrations.
+    # match() takes no lock: writers serialise on _write_lock and only ever replace a whole dict
+    # entry or callbacks tuple, which a concurrent reader sees as either before or after.
+    def __init__(self):
+        self._root = _TopicNode()
+        self._write_lock = threading.Lock()
+        return
+
+    def add(self, topicfilter, callback):
+        with self._write_lock:
+            node = self._root
+            for segment in topicfilter.split("/"):
+                child = node.children.get(segment)
+                if child is None:
+                    child = _TopicNode()
+                    node.children[segment] = child
+                node = child
+            node.callbacks = node.callbacks + (callback,)
+        return
+
+    def remove(self, topicfilter, callback):
+        with self._write_lock:
+            path = []
+            node = self._root
+            for segment in topicfilter.split("/"):
+                child = node.children.get(segment)
+                if child is None:
+                    return False
+                path.append((node, segment))
+                node = child
+            if callback not in node.callbacks:
+                return False
+            callbacks = list(node.callbacks)
+            callbacks.remove(callback)
+            node.callbacks = tuple(callbacks)
+            # prune the branch back up to the first node that's still in use
+            for parent, segment in reversed(path):
+                child = parent.children[segment]
+                if child.callbacks or child.children:
+                    break
+                del parent.children[segment]
+        return True
+
+    def match(self, topic):
+        callbacks = []
+        segments = topic.split("/")
+        last = len(segments)
+        pending = [(self._root, 0)]
+        while pending:
+            node, depth = pending.pop()
+            children = node.children
+            # '#' also matches the parent level, eg a/# matches a
+            wildcard = children.get("#")
+            if wildcard is not None:
+                callbacks.extend(wildcard.callbacks)
+            if depth == last:
+                callbacks.extend(node.callbacks)
+                continue
+            child = children.get(segments[depth])
+            if child is not None:
+                pending.append((child, depth + 1))
+            child = children.get("+")
+            if child is not None:
+                pending.append((child, depth + 1))
+        return callbacks
+
 
 class MQTTClient():
-    def __init__(self, mqtt_hostname, mqtt_port, base_topic, username = None, password = None):
+    def __init__(self, mqtt_hostname, mqtt_port, base_topic, username = None, password = None, client_id = "voltronic-wifi-bridge", outbox = None):
         self._mqtt_hostname = mqtt_hostname
         self._mqtt_port = mqtt_port
         self._username = username
         self._password = password
+        self._client_id = client_id
 
         self._base_topic = base_topic
 
+        # only the command topics are subscribed so our own telemetry isn't echoed back to us
+        self._subscriptions = ["+/command/#"]
+        self._router = TopicRouter()
+        # called with no arguments after every (re)connect to the broker, on paho's thread
+        self._connect_callbacks = []
+        # optional mqtt_outbox.Outbox holding messages while the broker is unreachable
+        self._outbox = outbox
 
         self._client = self._register_client()
-        print("about to connect")
+        if self._outbox is not None:
+            self._outbox.attach(self._publish_now)
+        logger.debug("about to connect")
         self._client.connect(self._mqtt_hostname, self._mqtt_port, 60)
         self.loop_start()
-        print("connected")
-
-        self._message_callback_registrations_lock = threading.Lock()
-        self._message_callback_registrations = []
+        logger.info("connected")
 
         return
     
     def register_message_callback(self, callback, topicmatch):
-        print("starting registering callback")
-        reg = {
-            "topicmatch": topicmatch,
-            "callback": callback
-        }
-        with self._message_callback_registrations_lock:
-            self._message_callback_registrations.append(reg)
-        print("finishing registering callback")
+        # topicmatch is an mqtt topic filter inside the base topic, eg "<serial>/command/#"
+        logger.debug("starting registering callback")
+        self._router.add("{}/{}".format(self._base_topic, topicmatch), callback)
+        logger.debug("finishing registering callback")
         return
 
     def unregister_message_callback(self, callback, topicmatch):
-        print("starting unregistering callback")
-        removelist = []
-        with self._message_callback_registrations_lock:
-            for index, value in enumerate(self._message_callback_registrations):
-                if value["topicmatch"] == topicmatch and value["callback"] == callback:
-                    removelist.append(index)
-            
-            for index in sorted(removelist,reverse=True):
-                self._message_callback_registrations.pop(index)
-        print("finished unregistering callback")
+        logger.debug("starting unregistering callback")
+        self._router.remove("{}/{}".format(self._base_topic, topicmatch), callback)
+        logger.debug("finished unregistering callback")
+        return
+
+    def register_connect_callback(self, callback):
+        self._connect_callbacks.append(callback)
+        return
+
+    def add_subscription(self, topicfilter):
+        # subscribe to another filter inside the base topic, kept across reconnects
+        if topicfilter not in self._subscriptions:
+            self._subscriptions.append(topicfilter)
+            self._client.subscribe("{}/{}".format(self._base_topic, topicfilter))
         return
     
-    def publish_message(self, topicpart, message):
+    def publish_message(self, topicpart, message, retain=False):
         # publish a message inside the base topic area
-        self._client.publish("{}/{}".format(self._base_topic, topicpart), message)
+        self.publish_absolute(self.full_topic(topicpart), message, retain=retain)
+        return
+
+    def publish_absolute(self, topic, message, retain=False):
+        # publish outside the base topic area, eg home assistant discovery
+        if self._outbox is not None:
+            self._outbox.put(topic, message, retain)
+        else:
+            self._client.publish(topic, message, retain=retain)
         return
 
+    def _publish_now(self, topic, message, retain):
+        return self._client.publish(topic, message, retain=retain).rc == mqtt.MQTT_ERR_SUCCESS
+
+    def full_topic(self, topicpart):
+        return "{}/{}".format(self._base_topic, topicpart)
+
 
     def _register_client(self):
 
-        client = mqtt.Client("voltronic-wifi-bridge")
+        client = mqtt.Client(self._client_id)
         client.on_connect = self.on_connect
         client.on_message = self.on_message
         client.on_publish = self.on_publish
+        client.on_disconnect = self.on_disconnect
         client.username_pw_set(self._username, password=self._password)
 
         return client
 
     def on_connect(self, client, userdata, flags, rc):
         
-        print("Connected with result code "+str(rc))
+        logger.info("Connected with result code %s", rc)
 
-        print("about to publish")
+        logger.debug("about to publish")
         client.publish("{}/connected".format(self._base_topic), time.time())
 
         # Subscribing in on_connect() means that if we lose the connection and
         # reconnect then subscriptions will be renewed.
-        print("about to subscribe")
-        client.subscribe("{}/#".format(self._base_topic))
-        print("subscribed")
+        logger.debug("about to subscribe")
+        for topicfilter in self._subscriptions:
+            client.subscribe("{}/{}".format(self._base_topic, topicfilter))
+        logger.debug("subscribed")
+        for callback in self._connect_callbacks:
+            callback()
+        if self._outbox is not None and rc == 0:
+            self._outbox.set_connected(True)
+        return
+
+    def on_disconnect(self, client, userdata, rc):
+        logger.info("Disconnected with result code %s", rc)
+        if self._outbox is not None:
+            self._outbox.set_connected(False)
         return
 
     def on_message(self, client, userdata, msg):
-        print("Got message {} on topic {}".format(msg.payload, msg.topic))
-
-        with self._message_callback_registrations_lock:
-            for reg in self._message_callback_registrations:
-                # print("checking match with: {}".format(reg["topicmatch"]))
-                if msg.topic.startswith("{}/{}".format(self._base_topic, reg["topicmatch"])):
-                    print("Message matched; doing callback")
-                    reg["callback"](msg)
+        logger.debug("Got message %s on topic %s", msg.payload, msg.topic)
+
+        for callback in self._router.match(msg.topic):
+            logger.debug("Message matched; doing callback")
+            try:
+                callback(msg)
+            except Exception:
+                # paho re-raises out of its network thread, which would stop all mqtt input
+                logger.exception("callback %s failed handling message on %s", callback, msg.topic)
 
         return
 
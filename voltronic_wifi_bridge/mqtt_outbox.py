@@ -0,0 +1,351 @@
+#!/bin/python
+# Store and forward for mqtt, so a broker outage neither loses everything nor grows without bound.
+#
+# While the broker is connected messages go straight to paho.  While it isn't, each topic is held
+# according to the first policy whose filter matches it:
+#   all    - every message is kept, oldest first, in a bounded queue in memory; when that's full
+#            the oldest spill to a ring file on disk (mmap'd, so it also survives a restart), and
+#            when that's full the oldest are dropped
+#   latest - only the newest message per topic is kept, so state costs one slot per topic however
+#            long the outage is
+#   drop   - nothing is kept
+# Once the broker is back a background thread drains what was held, oldest first, in batches at
+# a limited rate so a fleet's backlog doesn't stampede it.  New messages keep going straight out
+# while it drains; a held "latest" message is discarded when a newer one for its topic is sent.
+import collections
+import logging
+import mmap
+import os
+import struct
+import threading
+import time
+from voltronic_wifi_bridge import mqtt_client
+from voltronic_wifi_bridge import voltronic_metrics
+
+logger = logging.getLogger(__name__)
+
+POLICIES = ["all", "latest", "drop"]
+
+# relative to the base topic, first match wins; anything else is "latest"
+DEFAULT_POLICIES = [
+    # answers to requests made before the outage
+    ("+/history/response", "drop"),
+    # warning and status bits coming on and going off
+    ("+/events/+", "all"),
+    # power samples, per field or as json per command
+    ("+/output_w", "all"),
+    ("+/output_va", "all"),
+    ("+/pv1_input_power", "all"),
+    ("+/pv2_input_power", "all"),
+    ("+/qpigs", "all"),
+    ("+/qpigs2", "all"),
+]
+
+_MAGIC = b"VOUTBX01"
+# head (next write offset), tail (next read offset), bytes in use including wrapped space, records
+_HEADER = struct.Struct("=8sqqqq")
+# payload length, topic length, retain
+_RECORD = struct.Struct("=IHB")
+_WRAP = 0xFFFFFFFF
+
+
+def _encode(payload):
+    # paho sends str as utf-8 and numbers as their str()
+    if isinstance(payload, (bytes, bytearray)):
+        return bytes(payload)
+    if isinstance(payload, str):
+        return payload.encode('utf-8')
+    if payload is None:
+        return b""
+    return str(payload).encode('utf-8')
+
+
+class SpillRing():
+    # a fixed size ring of (topic, payload, retain) records in an mmap'd file; appending to a full
+    # ring drops the oldest records to make room
+    def __init__(self, path, size):
+        self._path = path
+        self._size = max(size, _HEADER.size + 4096)
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        fresh = not os.path.exists(path) or os.path.getsize(path) != self._size
+        if not fresh:
+            with open(path, "rb") as f:
+                fresh = f.read(len(_MAGIC)) != _MAGIC
+        if fresh and os.path.exists(path):
+            logger.warning("spill file %s doesn't match the configured size, starting it again", path)
+            os.replace(path, path + ".old")
+        self._file = open(path, "a+b")
+        if fresh:
+            self._file.truncate(self._size)
+        self._mapped = mmap.mmap(self._file.fileno(), self._size)
+        if fresh:
+            self._head = self._tail = _HEADER.size
+            self._used = 0
+            self._count = 0
+            self._save()
+        else:
+            _, self._head, self._tail, self._used, self._count = _HEADER.unpack_from(self._mapped, 0)
+            if self._count > 0:
+                logger.info("%s messages left in %s from before, they'll be sent once the broker is connected", self._count, path)
+        self.dropped = 0
+        return
+
+    def __len__(self):
+        return self._count
+
+    def _save(self):
+        _HEADER.pack_into(self._mapped, 0, _MAGIC, self._head, self._tail, self._used, self._count)
+        return
+
+    def _reset(self):
+        self._head = self._tail = _HEADER.size
+        self._used = 0
+        self._count = 0
+        return
+
+    def append(self, topic, payload, retain):
+        topic = topic.encode('utf-8')
+        need = _RECORD.size + len(topic) + len(payload)
+        if need > (self._size - _HEADER.size) // 2:
+            self.dropped += 1
+            return
+        while True:
+            if self._head > self._tail or self._used == 0:
+                if need <= self._size - self._head:
+                    break
+                # not enough room before the end, carry on from the start
+                waste = self._size - self._head
+                if waste >= _RECORD.size:
+                    _RECORD.pack_into(self._mapped, self._head, _WRAP, 0, 0)
+                self._used += waste
+                self._head = _HEADER.size
+            elif need <= self._tail - self._head:
+                break
+            else:
+                self._discard()
+                self.dropped += 1
+        position = self._head
+        _RECORD.pack_into(self._mapped, position, len(payload), len(topic), 1 if retain else 0)
+        position += _RECORD.size
+        self._mapped[position:position + len(topic)] = topic
+        position += len(topic)
+        self._mapped[position:position + len(payload)] = payload
+        self._head = position + len(payload)
+        self._used += need
+        self._count += 1
+        self._save()
+        return
+
+    def _skip_wrap(self):
+        if self._size - self._tail < _RECORD.size or _RECORD.unpack_from(self._mapped, self._tail)[0] == _WRAP:
+            self._used -= self._size - self._tail
+            self._tail = _HEADER.size
+        return
+
+    def peek(self):
+        # the oldest (topic, payload, retain) or None
+        if self._count == 0:
+            return None
+        self._skip_wrap()
+        length, topic_length, retain = _RECORD.unpack_from(self._mapped, self._tail)
+        position = self._tail + _RECORD.size
+        topic = self._mapped[position:position + topic_length].decode('utf-8')
+        position += topic_length
+        return (topic, self._mapped[position:position + length], retain == 1)
+
+    def _discard(self):
+        self._skip_wrap()
+        length, topic_length, _ = _RECORD.unpack_from(self._mapped, self._tail)
+        size = _RECORD.size + topic_length + length
+        self._tail += size
+        self._used -= size
+        self._count -= 1
+        if self._count == 0:
+            self._reset()
+        return
+
+    def pop(self):
+        if self._count > 0:
+            self._discard()
+            self._save()
+        return
+
+    def close(self):
+        self._mapped.flush()
+        self._mapped.close()
+        self._file.close()
+        return
+
+
+class Outbox(threading.Thread):
+    messages = voltronic_metrics.REGISTRY.counter("voltronic_mqtt_outbox_messages_total", "MQTT messages held while the broker was unreachable, by what became of them",
+                                                  ["outcome"])
+    depth = voltronic_metrics.REGISTRY.gauge("voltronic_mqtt_outbox_depth", "MQTT messages waiting for the broker", ["where"])
+
+    def __init__(self, base_topic, policies=None, max_messages=10000, spill_path=None, spill_bytes=64 * 1024 * 1024, rate=200, batch=50):
+        # policies are (topic filter inside the base topic, policy) ahead of DEFAULT_POLICIES
+        threading.Thread.__init__(self, daemon=True)
+        self._router = mqtt_client.TopicRouter()
+        for index, (topicfilter, policy) in enumerate(list(policies or []) + DEFAULT_POLICIES):
+            if policy not in POLICIES:
+                raise ValueError("Unknown mqtt buffer policy {}, expected one of {}".format(policy, POLICIES))
+            self._router.add("{}/{}".format(base_topic, topicfilter), (index, policy))
+        # topic -> policy, topics are a fixed set per inverter so this stays small
+        self._resolved = {}
+        self._max_messages = max_messages
+        self._spill = SpillRing(spill_path, spill_bytes) if spill_path is not None else None
+        # messages drained per second once the burst of one batch is spent
+        self._rate = rate
+        self._batch = batch
+
+        self._lock = threading.Lock()
+        self._queue = collections.deque()
+        # topic -> (payload, retain), oldest first
+        self._latest = {}
+        self._publish = None
+        self._connected = False
+        self._wakeup = threading.Event()
+        self._exit_request = False
+
+        self._queued = self.messages.labels("queued")
+        self._replaced = self.messages.labels("replaced")
+        self._spilled = self.messages.labels("spilled")
+        self._dropped = self.messages.labels("dropped")
+        self._sent = self.messages.labels("sent")
+        self.depth.labels("memory").set_function(lambda: len(self._queue) + len(self._latest))
+        self.depth.labels("disk").set_function(lambda: len(self._spill) if self._spill is not None else 0)
+        return
+
+    def attach(self, publish):
+        # publish(topic, payload, retain) is True once paho has taken the message
+        self._publish = publish
+        return
+
+    def set_connected(self, connected):
+        # from paho's callbacks, so only a flag and a wakeup
+        if self._connected and not connected:
+            logger.warning("lost the mqtt broker, holding messages until it's back")
+        self._connected = connected
+        self._wakeup.set()
+        return
+
+    def _policy(self, topic):
+        policy = self._resolved.get(topic)
+        if policy is None:
+            matches = self._router.match(topic)
+            policy = min(matches)[1] if len(matches) > 0 else "latest"
+            if len(self._resolved) >= 100000:
+                self._resolved.clear()
+            self._resolved[topic] = policy
+        return policy
+
+    def pending(self):
+        with self._lock:
+            return len(self._queue) + len(self._latest) + (len(self._spill) if self._spill is not None else 0)
+
+    def put(self, topic, payload, retain=False):
+        with self._lock:
+            policy = self._policy(topic)
+            if self._connected:
+                if policy == "latest" and len(self._latest) > 0:
+                    self._latest.pop(topic, None)
+                if self._publish(topic, payload, retain):
+                    return
+            if policy == "all":
+                self._queue.append((topic, payload, retain))
+                self._queued.inc()
+                if len(self._queue) > self._max_messages:
+                    self._overflow()
+            elif policy == "latest":
+                if topic in self._latest:
+                    # keep the topic's place in line so the drain stays oldest first
+                    self._replaced.inc()
+                else:
+                    self._queued.inc()
+                self._latest[topic] = (payload, retain)
+            else:
+                self._dropped.inc()
+        return
+
+    def _overflow(self):
+        # the memory queue is full: the oldest go to disk if there is one, otherwise they're lost
+        topic, payload, retain = self._queue.popleft()
+        if self._spill is None:
+            self._dropped.inc()
+            return
+        dropped = self._spill.dropped
+        self._spill.append(topic, _encode(payload), retain)
+        self._spilled.inc()
+        if self._spill.dropped > dropped:
+            self._dropped.inc(self._spill.dropped - dropped)
+        return
+
+    def _drain(self, count):
+        # send up to count held messages, oldest first: the disk, then the memory queue, then the
+        # latest values; returns how many went
+        sent = 0
+        with self._lock:
+            while sent < count and self._connected:
+                if self._spill is not None and len(self._spill) > 0:
+                    topic, payload, retain = self._spill.peek()
+                    if not self._publish(topic, bytes(payload), retain):
+                        break
+                    self._spill.pop()
+                elif len(self._queue) > 0:
+                    topic, payload, retain = self._queue[0]
+                    if not self._publish(topic, payload, retain):
+                        break
+                    self._queue.popleft()
+                elif len(self._latest) > 0:
+                    topic = next(iter(self._latest))
+                    payload, retain = self._latest[topic]
+                    if not self._publish(topic, payload, retain):
+                        break
+                    del self._latest[topic]
+                else:
+                    break
+                sent += 1
+        self._sent.inc(sent)
+        return sent
+
+    def run(self):
+        # token bucket: a batch at once, then rate per second
+        tokens = self._batch
+        last = time.monotonic()
+        drained = 0
+        while not self._exit_request:
+            if not self._connected or self.pending() == 0:
+                if drained > 0:
+                    logger.info("sent %s messages held while the broker was unreachable", drained)
+                    drained = 0
+                self._wakeup.wait(1)
+                self._wakeup.clear()
+                continue
+            now = time.monotonic()
+            tokens = min(self._batch, tokens + (now - last) * self._rate)
+            last = now
+            if tokens < 1:
+                time.sleep((1 - tokens) / self._rate)
+                continue
+            sent = self._drain(int(tokens))
+            if sent == 0:
+                # paho isn't taking messages yet, the disconnect callback will catch up shortly
+                time.sleep(0.1)
+            tokens -= sent
+            drained += sent
+        return
+
+    def exit(self):
+        self._exit_request = True
+        self._wakeup.set()
+        with self._lock:
+            # anything still in memory is lost unless it fits on disk
+            if self._spill is not None:
+                while len(self._queue) > 0:
+                    self._overflow()
+                for topic, (payload, retain) in self._latest.items():
+                    self._spill.append(topic, _encode(payload), retain)
+                self._latest.clear()
+                self._spill.close()
+                self._spill = None
+        return
@@ -0,0 +1,207 @@
+#!/bin/python
+# Site totals across every inverter the server talks to, so dashboards don't each have to
+# subscribe to the whole fleet and add it up.
+#
+# Each inverter's latest value of every summed field is kept, and a new sample only adds its
+# difference from the last one to the totals, so a sample costs the same however big the fleet
+# is.  Totals are kept for the whole site and for each phase group, which comes from the output
+# mode in the inverter's QPIRI (single, parallel, or which phase of a two or three phase system it
+# feeds).  An inverter that disconnects, or hasn't sent a sample for stale_after seconds, is taken
+# out of the totals until it sends another.  A background thread publishes the totals every
+# interval seconds when they've changed, as json on <topic> for the site and <topic>/<group>.
+import json
+import logging
+import threading
+import time
+from voltronic_wifi_bridge import voltronic_server
+from voltronic_wifi_bridge import voltronic_metrics
+
+logger = logging.getLogger(__name__)
+
+# fields added up across the fleet, by the command they come from
+SUMMED_FIELDS = {
+    "QPIGS": ["output_w", "output_va", "pv1_input_power", "battery_charging_current", "battery_discharging_current"],
+    "QPIGS2": ["pv2_input_power"],
+}
+
+# QPIRI output_mode -> phase group; from the docs, 5 and 7 are phase 1 and 2 of a split phase system
+OUTPUT_GROUPS = {
+    "0": "single",
+    "1": "parallel",
+    "2": "phase_1",
+    "3": "phase_2",
+    "4": "phase_3",
+    "5": "phase_1",
+    "7": "phase_2",
+}
+
+# the key of the whole site's totals, alongside the phase groups
+SITE = "site"
+
+
+class _Inverter():
+    __slots__ = ("group", "values", "seen")
+
+    def __init__(self, group):
+        self.group = group
+        # field -> the value it's contributing to the totals
+        self.values = {}
+        self.seen = 0
+        return
+
+
+class SiteAggregator(voltronic_server.SessionListener, threading.Thread):
+    inverters = voltronic_metrics.REGISTRY.gauge("voltronic_site_inverters", "Inverters counted in the site totals")
+
+    def __init__(self, mqtt_client, topic="site", interval=5, stale_after=30):
+        threading.Thread.__init__(self, daemon=True)
+        self._mqtt_client = mqtt_client
+        self._topic = topic
+        self._interval = interval
+        self._stale_after = stale_after
+        self._fields = [name for names in SUMMED_FIELDS.values() for name in names]
+
+        self._lock = threading.Lock()
+        # serial -> _Inverter for the inverters in the totals
+        self._inverters = {}
+        # serial -> phase group from its last QPIRI, kept while it's out of the totals
+        self._groups = {}
+        # group -> {field: total} and the number of inverters in it
+        self._totals = {SITE: dict.fromkeys(self._fields, 0.0)}
+        self._counts = {SITE: 0}
+        self._changed = False
+        # schema -> [(position, name)] of its summed fields, worked out on its first record
+        self._positions = {}
+        self._stop_event = threading.Event()
+        self.inverters.labels().set_function(lambda: len(self._inverters))
+        return
+
+    def _group(self, output_mode):
+        if output_mode is None:
+            return None
+        code = output_mode.lstrip("0") or "0"
+        return OUTPUT_GROUPS.get(code, "output_mode_{}".format(code))
+
+    def _add(self, group, name, delta):
+        # with self._lock held
+        self._totals[SITE][name] += delta
+        if group is not None:
+            self._totals[group][name] += delta
+        return
+
+    def _join(self, group, inverter, sign):
+        # count inverter's values in (sign 1) or out of (sign -1) group's totals
+        if group is None:
+            return
+        if group not in self._totals:
+            self._totals[group] = dict.fromkeys(self._fields, 0.0)
+            self._counts[group] = 0
+        self._counts[group] += sign
+        totals = self._totals[group]
+        if self._counts[group] == 0:
+            # nothing left to add up, so clear out any rounding the differences left behind
+            for name in totals:
+                totals[name] = 0.0
+            return
+        for name, value in inverter.values.items():
+            totals[name] += sign * value
+        return
+
+    def handle_record(self, serial, record, timestamp):
+        command = record.schema.command
+        if command == b"QPIRI":
+            self._set_group(serial, self._group(record.get("output_mode")))
+            return
+        fields = self._positions.get(record.schema)
+        if fields is None:
+            names = [name for name in SUMMED_FIELDS.get(command.decode('ascii'), []) if name in record.schema.positions]
+            fields = [(record.schema.positions[name], name) for name in names]
+            self._positions[record.schema] = fields
+        if len(fields) == 0:
+            return
+        values = record.values
+        with self._lock:
+            inverter = self._inverters.get(serial)
+            if inverter is None:
+                inverter = _Inverter(self._groups.get(serial))
+                self._inverters[serial] = inverter
+                self._join(SITE, inverter, 1)
+                self._join(inverter.group, inverter, 1)
+                logger.debug("%s counted in the site totals", serial)
+            for position, name in fields:
+                value = values[position]
+                if value is None:
+                    continue
+                delta = value - inverter.values.get(name, 0.0)
+                if delta != 0:
+                    self._add(inverter.group, name, delta)
+                    inverter.values[name] = value
+                    self._changed = True
+            inverter.seen = timestamp
+        return
+
+    def _set_group(self, serial, group):
+        with self._lock:
+            self._groups[serial] = group
+            inverter = self._inverters.get(serial)
+            if inverter is None or inverter.group == group:
+                return
+            logger.info("%s moved from phase group %s to %s", serial, inverter.group, group)
+            self._join(inverter.group, inverter, -1)
+            inverter.group = group
+            self._join(group, inverter, 1)
+            self._changed = True
+        return
+
+    def _remove(self, serial):
+        # with self._lock held
+        inverter = self._inverters.pop(serial, None)
+        if inverter is None:
+            return
+        self._join(inverter.group, inverter, -1)
+        self._join(SITE, inverter, -1)
+        self._changed = True
+        return
+
+    def handle_disconnect(self, serial):
+        with self._lock:
+            self._remove(serial)
+        return
+
+    def expire(self, now):
+        # take out inverters that have gone quiet without disconnecting
+        with self._lock:
+            for serial in [serial for serial, inverter in self._inverters.items() if now - inverter.seen > self._stale_after]:
+                logger.info("%s hasn't sent a sample for %s seconds, leaving it out of the site totals", serial, self._stale_after)
+                self._remove(serial)
+        return
+
+    def totals(self):
+        # {group: {field: total, "inverters": count}}
+        with self._lock:
+            totals = {}
+            for group, fields in self._totals.items():
+                summary = {name: round(value, 3) for name, value in fields.items()}
+                summary["inverters"] = self._counts[group]
+                totals[group] = summary
+            self._changed = False
+        return totals
+
+    def publish(self):
+        timestamp = round(time.time(), 3)
+        for group, summary in self.totals().items():
+            summary["timestamp"] = timestamp
+            topic = self._topic if group == SITE else "{}/{}".format(self._topic, group)
+            self._mqtt_client.publish_message(topic, json.dumps(summary))
+        return
+
+    def run(self):
+        while not self._stop_event.wait(self._interval):
+            self.expire(time.time())
+            if self._changed:
+                self.publish()
+        return
+
+    def exit(self):
+        self._stop_event.set()
+        return
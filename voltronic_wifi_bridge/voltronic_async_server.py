@@ -0,0 +1,207 @@
+#!/bin/python
+import asyncio
+import threading
+import logging
+import time
+from voltronic_wifi_bridge import voltronic_server
+from voltronic_wifi_bridge import voltronic_publisher
+from voltronic_wifi_bridge import voltronic_registry
+from voltronic_wifi_bridge.voltronic_server import InvalidResponseException
+
+logger = logging.getLogger(__name__)
+
+
+class AsyncVoltronicConnection(voltronic_server.VoltronicSession):
+    # one inverter session run as coroutines on the server's event loop instead of a thread
+    def __init__(self, reader, writer, loop, mqtt_client=None, publisher=None, **session_options):
+        voltronic_server.VoltronicSession.__init__(self, writer.get_extra_info("peername"), mqtt_client=mqtt_client, publisher=publisher,
+                                                   **session_options)
+
+        self._reader = reader
+        self._writer = writer
+        self._loop = loop
+        self._wakeup = asyncio.Event()
+        if self._upstream is not None:
+            self._upstream.on_close = self._upstream_closing
+        return
+
+    def _wake(self):
+        # mqtt callbacks arrive on the paho thread, so hand the wakeup to the event loop
+        self._loop.call_soon_threadsafe(self._wakeup.set)
+        return
+
+    async def run(self):
+        logger.info("New connection from address %s", self._address)
+        reader_task = asyncio.ensure_future(self._read_loop())
+        try:
+            while not self._exit_request and self._invalidresponse_count < 10 and not reader_task.done() and not self._idle_expired():
+                if self._upstream is not None and self._upstream.poll():
+                    self._loop.add_reader(self._upstream.fileno(), self._upstream_readable)
+                    self._loop.add_writer(self._upstream.fileno(), self._upstream_writable)
+                self._expire_queries()
+                self._queue_messages_to_send()
+                if self._can_send():
+                    while self._can_send():
+                        msg = self._next_message_to_send()
+                        self._writer.write(msg)
+                        logger.debug("sent: %s", msg)
+                    await self._writer.drain()
+                    continue
+
+                # sleep until the next poll or timeout is due or something (a response, a command, exit) wakes us
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=self._seconds_until_next_poll())
+                except asyncio.TimeoutError:
+                    pass
+            if self._invalidresponse_count >= 10 and not self._exit_request:
+                # wait for shutdown to try to let the inverter settle
+                await asyncio.sleep(10)
+        except ConnectionError:
+            logger.info("Connection from address %s has dropped", self._address)
+        finally:
+            reader_task.cancel()
+            logger.info("closing connection for address %s", self._address)
+            self._writer.close()
+            try:
+                await self._writer.wait_closed()
+            except (ConnectionError, asyncio.CancelledError):
+                pass
+            self._session_closed()
+        return
+
+    async def _read_loop(self):
+        # runs until the inverter hangs up; each batch of data may complete a response and free the send window
+        try:
+            while True:
+                data = await self._reader.read(2000)
+                if not data:
+                    logger.info("Connection from address %s has dropped", self._address)
+                    break
+                try:
+                    self._feed(data)
+                except InvalidResponseException:
+                    logger.warning("Invalid response from %s", self._address, exc_info=True)
+                    self._count_invalid_response()
+                if self._upstream is not None and self._upstream.wants_write():
+                    # some answers didn't fit in the upstream socket; send the rest once there's room
+                    self._loop.add_writer(self._upstream.fileno(), self._upstream_writable)
+                self._wakeup.set()
+        except ConnectionError:
+            logger.info("Connection from address %s has dropped", self._address)
+        finally:
+            self._wakeup.set()
+        return
+
+    def _upstream_readable(self):
+        self._upstream.handle_readable()
+        if self._queue_upstream_frames() > 0:
+            self._wakeup.set()
+        return
+
+    def _upstream_writable(self):
+        self._upstream.handle_writable()
+        if self._upstream.is_open() and not self._upstream.wants_write():
+            self._loop.remove_writer(self._upstream.fileno())
+        return
+
+    def _upstream_closing(self, upstream):
+        # stop watching the socket before it's closed; the run loop reconnects after the retry delay
+        self._loop.remove_reader(upstream.fileno())
+        self._loop.remove_writer(upstream.fileno())
+        self._wakeup.set()
+        return
+
+
+class AsyncVoltronicServer(threading.Thread):
+    # drop in replacement for VoltronicServer that serves every inverter from a single event loop
+    def __init__(self, portnumber, reuse_port=False, claims=None, **session_options):
+        # session_options (poll_intervals, inflight_window, ...) are passed on to every session
+        threading.Thread.__init__(self)
+
+        self._portnumber = portnumber
+        self._reuse_port = reuse_port
+        self._session_options = session_options
+        self._exit_request = False
+        # claims is a voltronic_registry.SerialClaims shared with the other workers, under --workers
+        self._registry = voltronic_registry.SessionRegistry(claims)
+
+        self._mqtt_client = None
+        self._publisher = None
+        self._listeners = []
+        self._loop = None
+        self._stop_event = None
+        self._started = threading.Event()
+        return
+
+    def register_mqtt(self, mqtt_client, publisher=None):
+        self._mqtt_client = mqtt_client
+        if publisher is None:
+            publisher = voltronic_publisher.Publisher(mqtt_client)
+        self._publisher = publisher
+        return
+
+    def register_listener(self, listener):
+        # a voltronic_server.SessionListener, called from the event loop thread
+        self._listeners.append(listener)
+        return
+
+    def run(self):
+        asyncio.run(self._serve())
+        return
+
+    async def _serve(self):
+        self._loop = asyncio.get_running_loop()
+        self._stop_event = asyncio.Event()
+        server = await asyncio.start_server(self._handle_client, "0.0.0.0", self._portnumber, backlog=1024,
+                                            reuse_address=True, reuse_port=self._reuse_port)
+        self._started.set()
+        try:
+            if not self._exit_request:
+                await self._stop_event.wait()
+        finally:
+            logger.info("closing socket connection")
+            server.close()
+            # from 3.12 wait_closed() also waits for the sessions' handlers, so end them first
+            await self.shutdown_inverter_connections()
+            await server.wait_closed()
+        return
+
+    async def _handle_client(self, reader, writer):
+        inverter_connection = AsyncVoltronicConnection(reader, writer, self._loop, mqtt_client=self._mqtt_client, publisher=self._publisher,
+                                                       listeners=self._listeners, registry=self._registry, **self._session_options)
+        # the session takes itself out of the registry once it's closed
+        self._registry.add(inverter_connection)
+        await inverter_connection.run()
+        return
+
+    def session_counts(self):
+        return self._registry.counts()
+
+    async def shutdown_inverter_connections(self):
+        for inverter_connection in self._registry.sessions():
+            inverter_connection.exit()
+        # give the sessions a moment to close their sockets cleanly
+        deadline = time.time() + 5
+        while len(self._registry) > 0 and time.time() < deadline:
+            await asyncio.sleep(0.05)
+        return
+
+    def exit(self):
+        self._exit_request = True
+        if self._loop is not None and self._stop_event is not None:
+            self._loop.call_soon_threadsafe(self._stop_event.set)
+        return
+
+
+if __name__ == "__main__":
+    # test server directly
+    testserver = AsyncVoltronicServer(3502)
+    testserver.start()
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        testserver.exit()
+    testserver.exit()
+    testserver.join()
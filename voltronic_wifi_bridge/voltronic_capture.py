@@ -0,0 +1,170 @@
+#!/bin/python
+# Append-only binary capture of everything sent to and received from an inverter.
+#
+# A capture file is a header followed by records:
+#   header: b"VCAP" + version (1 byte) + wall clock time and time.monotonic() when the file was
+#           started (2 doubles), so the monotonic record times can be put back on a calendar
+#   record: time.monotonic() (double), direction (1 byte, IN or OUT), length (uint32), data
+# Inbound data is recorded as it came off the socket (partial frames, garbage and all) so a
+# replay goes through the framing exactly as the session did; outbound data is one frame per record.
+import logging
+import os
+import re
+import struct
+import time
+
+logger = logging.getLogger(__name__)
+
+IN = 0
+OUT = 1
+
+MAGIC = b"VCAP"
+VERSION = 1
+_header = struct.Struct(">4sBdd")
+_record = struct.Struct(">dBI")
+
+
+class CaptureFormatError(ValueError):
+    "Used when a file isn't a capture or is a version we can't read"
+
+
+class CaptureWriter():
+    # records are collected in memory and written out once buffer_size bytes or flush_interval
+    # seconds have built up; the file rotates to <name>.1.vcap ... <name>.<backups>.vcap at max_bytes.
+    # with provisional=True nothing is written on the timer until rename() gives the real name, so
+    # a session that starts out named by address lands in one file named by serial
+    def __init__(self, directory, name, max_bytes=16 * 1024 * 1024, backups=5, buffer_size=64 * 1024, flush_interval=5, provisional=False):
+        self._directory = directory
+        self._name = None
+        self._max_bytes = max_bytes
+        self._backups = backups
+        self._buffer_size = buffer_size
+        self._flush_interval = flush_interval
+
+        self._buffer = bytearray()
+        # clock readings for the oldest record in the buffer, used for the header of a new file
+        self._buffer_started = None
+        self._file = None
+        self._file_size = 0
+        self._last_flush = time.monotonic()
+        self.rename(name)
+        self._provisional = provisional
+        return
+
+    def rename(self, name):
+        # capture under a different name (the serial number once it's known); records already
+        # written stay in the old file
+        name = re.sub(r"[^A-Za-z0-9_.-]", "_", name)
+        self._provisional = False
+        if name == self._name:
+            return
+        if self._file is not None:
+            self._write_out()
+            self._file.close()
+            self._file = None
+        self._name = name
+        return
+
+    def path(self, index=0):
+        if index == 0:
+            return os.path.join(self._directory, "{}.vcap".format(self._name))
+        return os.path.join(self._directory, "{}.{}.vcap".format(self._name, index))
+
+    def write(self, direction, data):
+        now = time.monotonic()
+        if len(self._buffer) == 0:
+            self._buffer_started = (time.time(), now)
+        self._buffer += _record.pack(now, direction, len(data))
+        self._buffer += data
+        if len(self._buffer) >= self._buffer_size or (now - self._last_flush >= self._flush_interval and not self._provisional):
+            self.flush()
+        return
+
+    def flush(self):
+        # a full disk loses the capture, not the session
+        try:
+            self._write_out()
+            if self._file is not None:
+                self._file.flush()
+        except OSError as e:
+            logger.warning("couldn't write capture %s, dropping %s bytes: %s", self.path(), len(self._buffer), e)
+            self._buffer = bytearray()
+        self._last_flush = time.monotonic()
+        return
+
+    def close(self):
+        self.flush()
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        return
+
+    def _write_out(self):
+        if len(self._buffer) == 0:
+            return
+        if self._file is not None and self._file_size + len(self._buffer) > self._max_bytes:
+            self._rotate()
+        if self._file is None:
+            self._open()
+        self._file.write(self._buffer)
+        self._file_size += len(self._buffer)
+        self._buffer = bytearray()
+        return
+
+    def _open(self):
+        os.makedirs(self._directory, exist_ok=True)
+        path = self.path()
+        self._file = open(path, "ab")
+        self._file_size = self._file.tell()
+        if self._file_size == 0:
+            self._file.write(_header.pack(MAGIC, VERSION, *self._buffer_started))
+            self._file_size = _header.size
+        elif self._file_size >= self._max_bytes:
+            self._rotate()
+            self._open()
+        return
+
+    def _rotate(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        if self._backups > 0:
+            for index in range(self._backups - 1, 0, -1):
+                if os.path.exists(self.path(index)):
+                    os.replace(self.path(index), self.path(index + 1))
+            os.replace(self.path(), self.path(1))
+        else:
+            os.remove(self.path())
+        return
+
+
+def read_capture(path):
+    # yields (monotonic time, direction, data) for each record; a record cut short by a crash
+    # ends the capture rather than raising
+    with open(path, "rb") as f:
+        header = f.read(_header.size)
+        if len(header) < _header.size:
+            raise CaptureFormatError("{} is too short to be a capture".format(path))
+        magic, version, _, _ = _header.unpack(header)
+        if magic != MAGIC:
+            raise CaptureFormatError("{} is not a capture file".format(path))
+        if version != VERSION:
+            raise CaptureFormatError("{} is capture version {}, expected {}".format(path, version, VERSION))
+        while True:
+            head = f.read(_record.size)
+            if len(head) < _record.size:
+                return
+            timestamp, direction, length = _record.unpack(head)
+            data = f.read(length)
+            if len(data) < length:
+                return
+            yield timestamp, direction, data
+
+
+def read_capture_start(path):
+    # (wall clock time, monotonic time) the capture file was started at
+    with open(path, "rb") as f:
+        magic, version, wall, monotonic = _header.unpack(f.read(_header.size))
+    if magic != MAGIC:
+        raise CaptureFormatError("{} is not a capture file".format(path))
+    return wall, monotonic
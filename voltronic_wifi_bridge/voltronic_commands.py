@@ -0,0 +1,117 @@
+#!/bin/python
+# Set commands from mqtt, held back until they're worth sending to the inverter.
+#
+# Each setting keeps at most one pending value, so a newer request replaces one that hasn't gone
+# out yet.  A pending value is dropped when the inverter's last QPIRI (or a write it ACKed)
+# already shows it, and writes of the same setting are at least min_interval seconds apart.  An
+# automation republishing the same value, or a retained command replayed when the broker
+# connection comes back, then costs nothing on the link and no EEPROM write.  A request that
+# arrives before the inverter's settings are known waits up to state_wait seconds for its
+# QPIRI.  Once a write is ACKed its value is taken as current and the session polls QPIRI straight
+# away to confirm it.
+import logging
+from voltronic_wifi_bridge import voltronic_schemas
+from voltronic_wifi_bridge import voltronic_metrics
+
+logger = logging.getLogger(__name__)
+
+# command topic -> (QPIRI field it sets, code -> label)
+SETTINGS = {
+    "set_output_priority": ("output_source_priority", voltronic_schemas.OUTPUT_SOURCE_PRIORITY),
+    "set_charge_priority": ("charger_source_priority", voltronic_schemas.CHARGER_SOURCE_PRIORITY),
+}
+
+
+class CommandQueue():
+    results = voltronic_metrics.REGISTRY.counter("voltronic_set_commands_total", "Set commands from mqtt by what became of them", ["result"])
+
+    def __init__(self, min_interval=30, state_wait=10):
+        self._min_interval = min_interval
+        self._state_wait = state_wait
+        # command -> (label, time it was requested); only the latest request per command is kept
+        self._pending = {}
+        # command -> when it was last written
+        self._last_write = {}
+        # QPIRI field -> the label the inverter last reported or ACKed
+        self._current = {}
+        self._in_flight = set()
+
+        self._written = self.results.labels("written")
+        self._failed = self.results.labels("failed")
+        self._coalesced = self.results.labels("coalesced")
+        self._suppressed = self.results.labels("suppressed")
+        self._rejected = self.results.labels("rejected")
+        return
+
+    def submit(self, command, label, now):
+        # False if it isn't a setting we know or the value isn't one of its labels
+        setting = SETTINGS.get(command)
+        if setting is None or label not in setting[1].values():
+            logger.warning("ignoring %s %s, expected one of %s", command, label,
+                           ", ".join(setting[1].values()) if setting is not None else ", ".join(SETTINGS.keys()))
+            self._rejected.inc()
+            return False
+        if command in self._pending:
+            logger.info("%s %s replaces %s which hadn't been sent yet", command, label, self._pending[command][0])
+            self._coalesced.inc()
+        self._pending[command] = (label, now)
+        return True
+
+    def __len__(self):
+        return len(self._pending)
+
+    def take(self, now):
+        # the (command, label) pairs to write now
+        ready = []
+        for command, (label, requested) in list(self._pending.items()):
+            field = SETTINGS[command][0]
+            if command in self._in_flight:
+                continue
+            current = self._current.get(field)
+            if current is None and now - requested < self._state_wait:
+                continue
+            if current == label:
+                logger.info("%s is already %s, not writing it", field, label)
+                del self._pending[command]
+                self._suppressed.inc()
+                continue
+            last = self._last_write.get(command)
+            if last is not None and now - last < self._min_interval:
+                continue
+            del self._pending[command]
+            self._in_flight.add(command)
+            self._last_write[command] = now
+            ready.append((command, label))
+        return ready
+
+    def next_due(self):
+        # the earliest a pending write could be ready, or None if nothing is waiting on time
+        due = None
+        for command, (label, requested) in self._pending.items():
+            if command in self._in_flight:
+                continue
+            at = requested + self._state_wait if self._current.get(SETTINGS[command][0]) is None else requested
+            last = self._last_write.get(command)
+            if last is not None:
+                at = max(at, last + self._min_interval)
+            if due is None or at < due:
+                due = at
+        return due
+
+    def write_finished(self, command, label, accepted):
+        # accepted is False for a NAK or no answer at all
+        self._in_flight.discard(command)
+        if accepted:
+            self._current[SETTINGS[command][0]] = label
+            self._written.inc()
+        else:
+            self._failed.inc()
+        return
+
+    def observe(self, record):
+        # a parsed QPIRI; what the inverter says beats whatever we assumed
+        for field, _ in SETTINGS.values():
+            value = record.get(field)
+            if value is not None:
+                self._current[field] = value
+        return
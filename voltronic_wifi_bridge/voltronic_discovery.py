@@ -0,0 +1,231 @@
+#!/bin/python
+# Home Assistant mqtt discovery for every inverter the bridge talks to.
+#
+# Configs are built from the response layouts in voltronic_schemas the first time an inverter
+# sends each command, published retained under <prefix>/<component>/<serial>/<field>/config and
+# remembered per serial.  A reconnecting inverter or a repeat poll costs a dict lookup; a config
+# is only published again when it changes (a different layout after a protocol version change),
+# and everything remembered is re-sent when the broker connection comes back in case the broker
+# lost its retained messages.  Configs go out from one thread at a limited rate and queued
+# configs for the same topic replace each other, so a fleet reconnecting at once or a flapping
+# broker connection can't flood the broker.
+import json
+import logging
+import threading
+import time
+from voltronic_wifi_bridge import voltronic_server
+from voltronic_wifi_bridge import voltronic_schemas
+from voltronic_wifi_bridge import voltronic_energy
+
+logger = logging.getLogger(__name__)
+
+# commands whose records become entities, and the topic their publisher sends them on:
+# None for the Publisher's per field / per command topics, otherwise one json topic per record
+DISCOVERED_COMMANDS = {
+    "QPIGS": None,
+    "QPIGS2": None,
+    "QPIRI": None,
+    "QPIWS": "warnings",
+    "QFLAG": "flags",
+}
+
+# fields that are controllable are selects rather than sensors: (command topic, code -> label)
+SELECTS = {
+    "output_source_priority": ("set_output_priority", voltronic_schemas.OUTPUT_SOURCE_PRIORITY),
+    "charger_source_priority": ("set_charge_priority", voltronic_schemas.CHARGER_SOURCE_PRIORITY),
+}
+
+DEVICE_CLASSES = {"V": "voltage", "A": "current", "W": "power", "VA": "apparent_power", "Hz": "frequency", "°C": "temperature"}
+
+MODES = ["power_on", "standby", "line", "battery", "fault", "power_saving"]
+
+
+def _title(name):
+    return name.replace("_", " ").strip().capitalize()
+
+
+class HomeAssistantDiscovery(voltronic_server.SessionListener, threading.Thread):
+    def __init__(self, mqtt_client, publish_mode="fields", prefix="homeassistant", rate=20, burst=50, energy=False):
+        threading.Thread.__init__(self, daemon=True)
+        self._mqtt_client = mqtt_client
+        self._publish_mode = publish_mode
+        # whether voltronic_energy's counters are published, so they get energy dashboard sensors
+        self._energy = energy
+        self._prefix = prefix
+        # configs published per second once the burst allowance is spent
+        self._rate = rate
+        self._burst = burst
+
+        self._lock = threading.Lock()
+        # serial -> {topic: (payload, command)} for everything published (or queued) for that inverter, and
+        # serial -> {command: schema} that produced them
+        self._configs = {}
+        self._schemas = {}
+        # topic -> payload waiting to go out, oldest first; a newer payload for a topic replaces the queued one
+        self._queue = {}
+        self._wakeup = threading.Event()
+        self._exit_request = False
+
+        self.published = 0
+        mqtt_client.register_connect_callback(self.republish)
+        return
+
+    def handle_connect(self, serial):
+        self._mqtt_client.publish_message("{}/availability".format(serial), "online", retain=True)
+        with self._lock:
+            if serial in self._configs:
+                return
+            self._configs[serial] = {}
+            self._schemas[serial] = {}
+        self._update(serial, "QMOD", self._mode_configs(serial))
+        if self._energy:
+            self._update(serial, "energy", self._energy_configs(serial))
+        return
+
+    def handle_disconnect(self, serial):
+        self._mqtt_client.publish_message("{}/availability".format(serial), "offline", retain=True)
+        return
+
+    def handle_record(self, serial, record, timestamp):
+        schema = record.schema
+        schemas = self._schemas.get(serial)
+        if schemas is not None and schemas.get(schema.command) is schema:
+            return
+        command = schema.command.decode('ascii')
+        if command not in DISCOVERED_COMMANDS:
+            return
+        with self._lock:
+            schemas = self._schemas.setdefault(serial, {})
+            self._configs.setdefault(serial, {})
+            if schemas.get(schema.command) is schema:
+                return
+            schemas[schema.command] = schema
+        self._update(serial, command, self._schema_configs(serial, command, schema))
+        return
+
+    def _update(self, serial, command, configs):
+        # queue what's new or changed for one command and clear out entities it no longer has
+        with self._lock:
+            known = self._configs[serial]
+            for topic in [topic for topic, (_, owner) in known.items() if owner == command and topic not in configs]:
+                del known[topic]
+                self._queue[topic] = ""
+            for topic, payload in configs.items():
+                if known.get(topic, (None,))[0] != payload:
+                    known[topic] = (payload, command)
+                    self._queue[topic] = payload
+            waiting = len(self._queue)
+        if waiting > 0:
+            self._wakeup.set()
+        return
+
+    def republish(self):
+        # after a broker (re)connect; topics already queued keep their place
+        with self._lock:
+            for known in self._configs.values():
+                for topic, (payload, _) in known.items():
+                    self._queue.setdefault(topic, payload)
+            waiting = len(self._queue)
+        if waiting > 0:
+            self._wakeup.set()
+        return
+
+    def _device(self, serial):
+        return {"identifiers": ["voltronic_{}".format(serial)], "name": "Voltronic {}".format(serial), "manufacturer": "Voltronic Power"}
+
+    def _base_config(self, serial, name, state_topic):
+        return {
+            "name": _title(name),
+            "unique_id": "voltronic_{}_{}".format(serial, name),
+            "state_topic": self._mqtt_client.full_topic(state_topic),
+            "availability_topic": self._mqtt_client.full_topic("{}/availability".format(serial)),
+            "device": self._device(serial),
+        }
+
+    def _config_topic(self, component, serial, name):
+        return "{}/{}/{}/{}/config".format(self._prefix, component, serial, name)
+
+    def _mode_configs(self, serial):
+        config = self._base_config(serial, "mode", "{}/mode".format(serial))
+        config.update({"device_class": "enum", "options": MODES})
+        return {self._config_topic("sensor", serial, "mode"): json.dumps(config, sort_keys=True)}
+
+    def _energy_configs(self, serial):
+        configs = {}
+        for name in voltronic_energy.COUNTERS:
+            config = self._base_config(serial, name, "{}/energy".format(serial))
+            config.update({"value_template": "{{{{ value_json.{} }}}}".format(name), "unit_of_measurement": "kWh", "device_class": "energy",
+                           "state_class": "total_increasing"})
+            configs[self._config_topic("sensor", serial, name)] = json.dumps(config, sort_keys=True)
+        return configs
+
+    def _schema_configs(self, serial, command, schema):
+        json_topic = DISCOVERED_COMMANDS[command]
+        configs = {}
+        for position in schema.published:
+            field = schema.fields[position]
+            if json_topic is not None:
+                config = self._base_config(serial, field.name, "{}/{}".format(serial, json_topic))
+                config["value_template"] = "{{{{ 'ON' if value_json.{} else 'OFF' }}}}".format(field.name)
+                config["entity_category"] = "diagnostic"
+                if json_topic == "warnings":
+                    config["device_class"] = "problem"
+                configs[self._config_topic("binary_sensor", serial, field.name)] = json.dumps(config, sort_keys=True)
+                continue
+
+            if self._publish_mode == "json":
+                config = self._base_config(serial, field.name, "{}/{}".format(serial, command.lower()))
+                config["value_template"] = "{{{{ value_json.{} }}}}".format(field.name)
+            else:
+                config = self._base_config(serial, field.name, "{}/{}".format(serial, field.name))
+            select = SELECTS.get(field.name)
+            if select is not None:
+                topic, mapping = select
+                config["command_topic"] = self._mqtt_client.full_topic("{}/command/{}".format(serial, topic))
+                config["options"] = [label for label in mapping.values() if not label.startswith("unknown")]
+                configs[self._config_topic("select", serial, field.name)] = json.dumps(config, sort_keys=True)
+                continue
+            if field.unit is not None:
+                config["unit_of_measurement"] = field.unit
+                config["state_class"] = "measurement"
+                if field.unit in DEVICE_CLASSES:
+                    config["device_class"] = DEVICE_CLASSES[field.unit]
+                elif field.unit == "%" and "SOC" in field.name:
+                    config["device_class"] = "battery"
+            configs[self._config_topic("sensor", serial, field.name)] = json.dumps(config, sort_keys=True)
+        return configs
+
+    def pending(self):
+        with self._lock:
+            return len(self._queue)
+
+    def run(self):
+        # token bucket: up to burst configs at once, then rate per second
+        tokens = self._burst
+        last = time.monotonic()
+        while not self._exit_request:
+            if self.pending() == 0:
+                self._wakeup.wait()
+                self._wakeup.clear()
+                continue
+            now = time.monotonic()
+            tokens = min(self._burst, tokens + (now - last) * self._rate)
+            last = now
+            if tokens < 1:
+                time.sleep((1 - tokens) / self._rate)
+                continue
+            with self._lock:
+                batch = []
+                for topic in list(self._queue.keys())[0:int(tokens)]:
+                    batch.append((topic, self._queue.pop(topic)))
+            for topic, payload in batch:
+                self._mqtt_client.publish_absolute(topic, payload, retain=True)
+            tokens -= len(batch)
+            self.published += len(batch)
+            logger.debug("published %s discovery configs, %s waiting", len(batch), self.pending())
+        return
+
+    def exit(self):
+        self._exit_request = True
+        self._wakeup.set()
+        return
@@ -0,0 +1,258 @@
+#!/bin/python
+# Energy totals in kWh per inverter, integrated from the power in each QPIGS sample.
+#
+# Each QPIGS sample adds the trapezoid between it and the inverter's previous sample to each
+# counter.  A pair of samples further apart than max_gap seconds, or either side of a disconnect,
+# is skipped rather than guessed at, so an outage costs what it would have counted and never
+# invents energy.  The counters only ever grow, which is what Home Assistant's energy dashboard
+# expects of a total_increasing sensor.  They're published retained as json on <serial>/energy
+# every publish_interval seconds if they changed.
+#
+# With a path the totals are checkpointed to a small json file, written to a temporary file that
+# replaces the old one, at most every checkpoint_interval seconds and whenever an inverter
+# disconnects, and picked up again after a restart.  Workers sharing the file under --workers
+# hold a lock while writing and keep the larger of their value and the file's, so an inverter
+# that reconnects to another worker carries on from where the last one got to.
+import fcntl
+import json
+import logging
+import os
+import threading
+import time
+from voltronic_wifi_bridge import voltronic_server
+from voltronic_wifi_bridge import voltronic_metrics
+
+logger = logging.getLogger(__name__)
+
+_VERSION = 1
+
+# in the order _powers() returns them; grid import is estimated from what the load and the
+# battery took less what PV and the battery gave, since QPIGS doesn't report grid power
+COUNTERS = ["pv_energy", "load_energy", "battery_charge_energy", "battery_discharge_energy", "grid_import_energy"]
+
+# watt seconds -> kWh, with the trapezoid's halving folded in
+_SCALE = 1 / (2 * 3600 * 1000)
+
+
+class _Inverter():
+    __slots__ = ("totals", "last_time", "last_powers", "pv2_power", "pv2_time")
+
+    def __init__(self, totals):
+        self.totals = totals
+        self.last_time = None
+        self.last_powers = None
+        self.pv2_power = 0.0
+        self.pv2_time = None
+        return
+
+
+def _powers(record, pv2_power):
+    battery_voltage = record["battery_voltage"]
+    pv = record["pv1_input_power"] + pv2_power
+    load = record["output_w"]
+    charge = battery_voltage * record["battery_charging_current"]
+    discharge = battery_voltage * record["battery_discharging_current"]
+    return (pv, load, charge, discharge, max(0.0, load + charge - pv - discharge))
+
+
+class EnergyCounters(voltronic_server.SessionListener, threading.Thread):
+    samples = voltronic_metrics.REGISTRY.counter("voltronic_energy_samples_total", "QPIGS samples by whether they were integrated or followed a gap",
+                                                 ["outcome"])
+
+    def __init__(self, mqtt_client, path=None, max_gap=30, publish_interval=30, checkpoint_interval=60):
+        threading.Thread.__init__(self, daemon=True)
+        self._mqtt_client = mqtt_client
+        self._path = path
+        self._max_gap = max_gap
+        self._publish_interval = publish_interval
+        self._checkpoint_interval = checkpoint_interval
+
+        self._lock = threading.Lock()
+        # serial -> _Inverter
+        self._inverters = {}
+        # serial -> [kWh per counter] as last read from the file
+        self._saved = {}
+        self._loaded_mtime = None
+        # serials whose totals changed since they were last published / written
+        self._unpublished = set()
+        self._dirty = set()
+        self._last_checkpoint = time.monotonic()
+        self._wakeup = threading.Event()
+        self._checkpoint_now = False
+        self._exit_request = False
+
+        self._integrated = self.samples.labels("integrated")
+        self._gaps = self.samples.labels("gap")
+        if path is not None:
+            self._load()
+        return
+
+    def _read(self):
+        try:
+            with open(self._path, "r") as f:
+                contents = json.load(f)
+        except FileNotFoundError:
+            return {}
+        except (OSError, ValueError) as e:
+            logger.warning("ignoring unreadable energy checkpoint %s: %s", self._path, e)
+            return {}
+        if not isinstance(contents, dict) or contents.get("version") != _VERSION or not isinstance(contents.get("inverters"), dict):
+            logger.warning("ignoring energy checkpoint %s, it isn't in a format this version understands", self._path)
+            return {}
+        saved = {}
+        for serial, counters in contents["inverters"].items():
+            saved[serial] = [float(counters.get(name, 0.0)) for name in COUNTERS]
+        return saved
+
+    def _mtime(self):
+        try:
+            return os.stat(self._path).st_mtime_ns
+        except OSError:
+            return None
+
+    def _load(self):
+        # with self._lock held; pick up anything another worker has written since we last looked
+        mtime = self._mtime()
+        if mtime == self._loaded_mtime:
+            return
+        self._saved = self._read()
+        self._loaded_mtime = mtime
+        return
+
+    def _inverter(self, serial):
+        # with self._lock held
+        inverter = self._inverters.get(serial)
+        if inverter is None:
+            if self._path is not None:
+                self._load()
+            inverter = _Inverter(list(self._saved.get(serial, [0.0] * len(COUNTERS))))
+            self._inverters[serial] = inverter
+        return inverter
+
+    def handle_record(self, serial, record, timestamp):
+        command = record.schema.command
+        if command == b"QPIGS2":
+            power = record.get("pv2_input_power")
+            if power is not None:
+                with self._lock:
+                    inverter = self._inverter(serial)
+                    inverter.pv2_power = power
+                    inverter.pv2_time = timestamp
+            return
+        if command != b"QPIGS":
+            return
+        with self._lock:
+            inverter = self._inverter(serial)
+            pv2_power = inverter.pv2_power if inverter.pv2_time is not None and timestamp - inverter.pv2_time <= self._max_gap else 0.0
+            try:
+                powers = _powers(record, pv2_power)
+            except (KeyError, TypeError):
+                return
+            if inverter.last_time is not None:
+                elapsed = timestamp - inverter.last_time
+                if 0 < elapsed <= self._max_gap:
+                    totals = inverter.totals
+                    for index, (before, now) in enumerate(zip(inverter.last_powers, powers)):
+                        if before > 0 or now > 0:
+                            totals[index] += (max(0.0, before) + max(0.0, now)) * elapsed * _SCALE
+                    self._unpublished.add(serial)
+                    self._dirty.add(serial)
+                    self._integrated.inc()
+                else:
+                    self._gaps.inc()
+            inverter.last_time = timestamp
+            inverter.last_powers = powers
+        return
+
+    def handle_connect(self, serial):
+        # another worker may have had this inverter since we last did
+        if self._path is None:
+            return
+        with self._lock:
+            inverter = self._inverters.get(serial)
+            if inverter is None:
+                return
+            self._load()
+            saved = self._saved.get(serial)
+            if saved is not None:
+                inverter.totals = [max(ours, theirs) for ours, theirs in zip(inverter.totals, saved)]
+        return
+
+    def handle_disconnect(self, serial):
+        # don't integrate across the gap, and let another worker carry on from here
+        with self._lock:
+            inverter = self._inverters.get(serial)
+            if inverter is None:
+                return
+            inverter.last_time = None
+            inverter.pv2_time = None
+            self._checkpoint_now = len(self._dirty) > 0
+        if self._checkpoint_now:
+            self._wakeup.set()
+        return
+
+    def totals(self, serial):
+        # {counter: kWh} or None
+        with self._lock:
+            inverter = self._inverters.get(serial)
+            if inverter is None:
+                return None
+            return dict(zip(COUNTERS, inverter.totals))
+
+    def publish(self):
+        with self._lock:
+            changed = [(serial, list(self._inverters[serial].totals)) for serial in self._unpublished]
+            self._unpublished.clear()
+        for serial, totals in changed:
+            self._mqtt_client.publish_message("{}/energy".format(serial), json.dumps({name: round(total, 3) for name, total in zip(COUNTERS, totals)}),
+                                              retain=True)
+        return
+
+    def checkpoint(self):
+        with self._lock:
+            self._checkpoint_now = False
+            self._last_checkpoint = time.monotonic()
+            if self._path is None or len(self._dirty) == 0:
+                return
+            temporary = "{}.{}.tmp".format(self._path, os.getpid())
+            try:
+                with open(self._path + ".lock", "a") as lock:
+                    fcntl.flock(lock, fcntl.LOCK_EX)
+                    saved = self._read()
+                    for serial in self._dirty:
+                        inverter = self._inverters[serial]
+                        # another worker may have counted further if it had the inverter more recently
+                        totals = [max(ours, theirs) for ours, theirs in zip(inverter.totals, saved.get(serial, inverter.totals))]
+                        if totals != inverter.totals:
+                            inverter.totals = totals
+                            self._unpublished.add(serial)
+                        saved[serial] = list(totals)
+                    contents = {serial: dict(zip(COUNTERS, totals)) for serial, totals in saved.items()}
+                    with open(temporary, "w") as f:
+                        json.dump({"version": _VERSION, "inverters": contents}, f, indent=1, sort_keys=True)
+                        f.flush()
+                        os.fsync(f.fileno())
+                    os.replace(temporary, self._path)
+                    self._saved = saved
+                    self._loaded_mtime = self._mtime()
+            except OSError as e:
+                logger.warning("couldn't write energy checkpoint %s: %s", self._path, e)
+                return
+            logger.debug("checkpointed energy for %s inverters to %s", len(self._dirty), self._path)
+            self._dirty.clear()
+        return
+
+    def run(self):
+        while not self._exit_request:
+            self._wakeup.wait(self._publish_interval)
+            self._wakeup.clear()
+            self.publish()
+            if self._checkpoint_now or time.monotonic() - self._last_checkpoint >= self._checkpoint_interval:
+                self.checkpoint()
+        return
+
+    def exit(self):
+        self._exit_request = True
+        self._wakeup.set()
+        self.checkpoint()
+        return
@@ -0,0 +1,95 @@
+#!/bin/python
+# Warning and status bits as events rather than a blob to diff every poll.
+#
+# QPIWS's warning bits and QPIGS's two device status bitmaps are held per inverter as integers.
+# Each poll's value is XORed with the last one, so an unchanged bitfield costs one comparison, and
+# only the bits that moved are looked at, through masks worked out once per layout.  Each bit that
+# rose or fell goes out on <serial>/events/<bit name> as json saying whether it's now active and
+# when that was seen.  The whole bitfield is published retained on its state topic only when
+# something in it changed.  The first value after a connect is published as the state but isn't
+# an edge, since what it was before is unknown.
+from voltronic_wifi_bridge import voltronic_metrics
+
+# QPIGS's status bits as the PI30 docs number them: qpigs_device_status_bitmap is b7..b0 and
+# qpigs_device_status_bitmap_2 is b10..b8, so the two strings joined are b10..b0
+STATUS_BITS = [
+    ("ac_charging", 0),
+    ("scc_charging", 1),
+    ("charging", 2),
+    ("battery_voltage_steady_while_charging", 3),
+    ("load_on", 4),
+    ("scc_firmware_updated", 5),
+    ("configuration_changed", 6),
+    ("sbu_priority_version", 7),
+    ("dustproof_installed", 8),
+    ("switched_on", 9),
+    ("charging_to_float", 10),
+]
+
+
+class Bitfield():
+    # the named bits of one bitfield and the topic its state is published on
+    def __init__(self, state_topic, bits):
+        # bits is (name, mask) pairs
+        self.state_topic = state_topic
+        self.bits = tuple(bits)
+        return
+
+    def state(self, value):
+        return {name: value & mask != 0 for name, mask in self.bits}
+
+
+STATUS = Bitfield("status", [(name, 1 << bit) for name, bit in STATUS_BITS])
+
+# BitSchema -> its Bitfield, so each layout's masks are only worked out once
+_schema_bitfields = {}
+
+
+def schema_bitfield(schema, state_topic):
+    bitfield = _schema_bitfields.get(schema)
+    if bitfield is None:
+        bitfield = Bitfield(state_topic, zip(schema.names, schema.masks))
+        _schema_bitfields[schema] = bitfield
+    return bitfield
+
+
+def status_bits(record):
+    # QPIGS's two status bitmaps as one integer, or None if they aren't the documented b7..b0 and b10..b8
+    low = record.get("qpigs_device_status_bitmap")
+    high = record.get("qpigs_device_status_bitmap_2")
+    if low is None or high is None or len(low) != 8 or len(high) != 3:
+        return None
+    try:
+        return int(high + low, 2)
+    except ValueError:
+        return None
+
+
+class EdgeDetector():
+    # one inverter's last value of each bitfield
+    edges = voltronic_metrics.REGISTRY.counter("voltronic_bit_events_total", "Warning and status bits that came on or went off", ["edge"])
+
+    def __init__(self):
+        # Bitfield -> last value
+        self._values = {}
+        self._rising = self.edges.labels("rising")
+        self._falling = self.edges.labels("falling")
+        return
+
+    def update(self, bitfield, value):
+        # None if nothing changed, otherwise the (bit name, now active) pairs that moved, empty for
+        # the first value
+        previous = self._values.get(bitfield)
+        if previous == value:
+            return None
+        self._values[bitfield] = value
+        if previous is None:
+            return []
+        changed = previous ^ value
+        moved = [(name, value & mask != 0) for name, mask in bitfield.bits if changed & mask]
+        rising = sum(1 for _, active in moved if active)
+        if rising > 0:
+            self._rising.inc(rising)
+        if len(moved) > rising:
+            self._falling.inc(len(moved) - rising)
+        return moved
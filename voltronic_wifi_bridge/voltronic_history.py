@@ -0,0 +1,355 @@
+#!/bin/python
+# Recent telemetry history kept in the bridge, so "what was the battery voltage over the last
+# hour" doesn't need a database.
+#
+# Every numeric field of the selected commands gets a set of fixed size rings: the raw samples
+# plus min/max/mean rollups at coarser resolutions (1 and 15 minutes by default), all updated as
+# each sample arrives.  The rings are flat typed arrays ('d' for times and sums, 'f' for values)
+# so memory is fixed up front and there's no python object per sample.  With a directory the
+# arrays live in an mmap'd file per field instead and survive a restart.
+#
+# Queried over mqtt: publish {"field": "battery_voltage", "resolution": "1m", "start": <unix time>,
+# "end": <unix time>, "id": <anything>} to <serial>/history/get and the answer comes back on
+# <serial>/history/response.  {"fields": true} lists the fields that have history.
+import array
+import json
+import logging
+import mmap
+import os
+import re
+import struct
+import threading
+from voltronic_wifi_bridge import voltronic_server
+
+logger = logging.getLogger(__name__)
+
+# (name, seconds per point (0 is raw samples), points kept)
+DEFAULT_RESOLUTIONS = [("raw", 0, 720), ("1m", 60, 1440), ("15m", 900, 672)]
+DEFAULT_COMMANDS = ["QPIGS", "QPIGS2"]
+
+_MAGIC = b"VHIST001"
+# per ring: resolution, capacity, head (next slot to write), count
+_RING_META = 4
+
+
+class _Allocator():
+    # hands out typed arrays, either plain array.array or views into one mmap'd file
+    def __init__(self, mapped=None):
+        self._mapped = mapped
+        self._offset = 0
+        return
+
+    def take(self, typecode, length):
+        size = struct.calcsize(typecode) * length
+        if self._mapped is None:
+            return array.array(typecode, bytes(size))
+        # keep every array 8 byte aligned
+        view = memoryview(self._mapped)[self._offset:self._offset + size].cast(typecode)
+        self._offset += (size + 7) // 8 * 8
+        return view
+
+    @staticmethod
+    def size(layout):
+        return sum((struct.calcsize(typecode) * length + 7) // 8 * 8 for typecode, length in layout)
+
+
+class FieldHistory():
+    # the rings for one field of one inverter; callers hold the owning InverterHistory's lock
+    def __init__(self, resolutions, path=None):
+        self._resolutions = resolutions
+        self._file = None
+        self._mapped = None
+        layout = self._layout(resolutions)
+        if path is not None:
+            allocator = self._map(path, layout)
+        else:
+            allocator = _Allocator()
+        self._take_arrays(allocator)
+        return
+
+    @staticmethod
+    def _layout(resolutions):
+        layout = [("B", len(_MAGIC)), ("q", 1 + _RING_META * len(resolutions))]
+        for _, seconds, capacity in resolutions:
+            if seconds == 0:
+                layout += [("d", capacity), ("f", capacity)]
+            else:
+                layout += [("d", capacity), ("d", capacity), ("f", capacity), ("f", capacity), ("d", capacity)]
+        return layout
+
+    def _map(self, path, layout):
+        size = _Allocator.size(layout)
+        fresh = not os.path.exists(path) or os.path.getsize(path) != size
+        if not fresh:
+            with open(path, "rb") as f:
+                header = f.read(len(_MAGIC) + 8 * (1 + _RING_META * len(self._resolutions)))
+            meta = struct.unpack("={}q".format(1 + _RING_META * len(self._resolutions)), header[len(_MAGIC):])
+            expected = [seconds for _, seconds, _ in self._resolutions]
+            if header[:len(_MAGIC)] != _MAGIC or [meta[1 + i * _RING_META] for i in range(len(expected))] != expected:
+                fresh = True
+        if fresh and os.path.exists(path):
+            logger.warning("history file %s doesn't match the configured resolutions, starting it again", path)
+            os.replace(path, path + ".old")
+        self._file = open(path, "a+b")
+        if fresh:
+            self._file.truncate(size)
+        self._mapped = mmap.mmap(self._file.fileno(), size)
+        if fresh:
+            self._mapped[0:len(_MAGIC)] = _MAGIC
+        return _Allocator(self._mapped)
+
+    def _take_arrays(self, allocator):
+        allocator.take("B", len(_MAGIC))
+        self._meta = allocator.take("q", 1 + _RING_META * len(self._resolutions))
+        self._meta[0] = 1
+        self._rings = []
+        for index, (_, seconds, capacity) in enumerate(self._resolutions):
+            base = 1 + index * _RING_META
+            self._meta[base] = seconds
+            self._meta[base + 1] = capacity
+            if seconds == 0:
+                arrays = (allocator.take("d", capacity), allocator.take("f", capacity))
+            else:
+                # bucket start, sum, min, max, count
+                arrays = (allocator.take("d", capacity), allocator.take("d", capacity), allocator.take("f", capacity),
+                          allocator.take("f", capacity), allocator.take("d", capacity))
+            self._rings.append((base, seconds, capacity, arrays))
+        return
+
+    def add(self, timestamp, value):
+        meta = self._meta
+        for base, seconds, capacity, arrays in self._rings:
+            head = meta[base + 2]
+            count = meta[base + 3]
+            if seconds == 0:
+                times, values = arrays
+                times[head] = timestamp
+                values[head] = value
+                meta[base + 2] = (head + 1) % capacity
+                meta[base + 3] = min(count + 1, capacity)
+                continue
+            starts, sums, minimums, maximums, counts = arrays
+            bucket = timestamp - timestamp % seconds
+            last = (head - 1) % capacity
+            if count > 0 and starts[last] == bucket:
+                sums[last] += value
+                counts[last] += 1
+                if value < minimums[last]:
+                    minimums[last] = value
+                if value > maximums[last]:
+                    maximums[last] = value
+            elif count == 0 or bucket > starts[last]:
+                starts[head] = bucket
+                sums[head] = value
+                minimums[head] = value
+                maximums[head] = value
+                counts[head] = 1
+                meta[base + 2] = (head + 1) % capacity
+                meta[base + 3] = min(count + 1, capacity)
+            # a sample older than the open bucket (clock stepped back) is only kept raw
+        return
+
+    def query(self, resolution, start=None, end=None, limit=None):
+        # oldest first; raw points are [time, value], rollups [bucket start, min, max, mean]
+        for index, (name, _, _) in enumerate(self._resolutions):
+            if name == resolution:
+                break
+        else:
+            raise KeyError(resolution)
+        base, seconds, capacity, arrays = self._rings[index]
+        head = self._meta[base + 2]
+        count = self._meta[base + 3]
+        points = []
+        for offset in range(count):
+            slot = (head - count + offset) % capacity
+            timestamp = arrays[0][slot]
+            if (start is not None and timestamp < start) or (end is not None and timestamp > end):
+                continue
+            if seconds == 0:
+                points.append([timestamp, round(arrays[1][slot], 4)])
+            else:
+                points.append([timestamp, round(arrays[2][slot], 4), round(arrays[3][slot], 4), round(arrays[1][slot] / arrays[4][slot], 4)])
+        if limit is not None and len(points) > limit:
+            points = points[-limit:]
+        return points
+
+    def flush(self):
+        if self._mapped is not None:
+            self._mapped.flush()
+        return
+
+    def close(self):
+        if self._mapped is not None:
+            self._meta = None
+            self._rings = []
+            self._mapped.flush()
+            self._mapped.close()
+            self._file.close()
+            self._mapped = None
+        return
+
+
+class InverterHistory():
+    def __init__(self, serial, resolutions, directory=None):
+        self.serial = serial
+        self._resolutions = resolutions
+        self._directory = None
+        if directory is not None:
+            self._directory = os.path.join(directory, re.sub(r"[^A-Za-z0-9_.-]", "_", serial))
+            os.makedirs(self._directory, exist_ok=True)
+        self.lock = threading.Lock()
+        self.fields = {}
+        return
+
+    def add(self, name, timestamp, value):
+        # with lock held
+        field = self.fields.get(name)
+        if field is None:
+            path = None
+            if self._directory is not None:
+                path = os.path.join(self._directory, re.sub(r"[^A-Za-z0-9_.-]", "_", name) + ".hist")
+            field = FieldHistory(self._resolutions, path)
+            self.fields[name] = field
+        field.add(timestamp, value)
+        return
+
+    def close(self):
+        with self.lock:
+            for field in self.fields.values():
+                field.close()
+        return
+
+
+class HistoryStore(voltronic_server.SessionListener):
+    def __init__(self, commands=None, resolutions=None, directory=None, max_points=2000, answer_unknown=True):
+        self._commands = set((commands if commands is not None else DEFAULT_COMMANDS))
+        self._resolutions = resolutions if resolutions is not None else DEFAULT_RESOLUTIONS
+        self._directory = directory
+        self._max_points = max_points
+        # with answer_unknown=False requests for serials we've never seen get no answer, for when
+        # several processes share the request topic and only one of them has the inverter
+        self._answer_unknown = answer_unknown
+        self._lock = threading.Lock()
+        self._inverters = {}
+        self._mqtt_client = None
+        # numeric field names per schema, worked out on the first record of each
+        self._numeric_fields = {}
+        if directory is not None:
+            # pick up what was there before a restart
+            for serial in sorted(os.listdir(directory)) if os.path.isdir(directory) else []:
+                if os.path.isdir(os.path.join(directory, serial)):
+                    inverter = self._inverter(serial)
+                    with inverter.lock:
+                        for filename in sorted(os.listdir(os.path.join(directory, serial))):
+                            if filename.endswith(".hist"):
+                                inverter.fields[filename[:-5]] = FieldHistory(self._resolutions, os.path.join(directory, serial, filename))
+        return
+
+    def _inverter(self, serial):
+        with self._lock:
+            inverter = self._inverters.get(serial)
+            if inverter is None:
+                inverter = InverterHistory(serial, self._resolutions, self._directory)
+                self._inverters[serial] = inverter
+        return inverter
+
+    def handle_record(self, serial, record, timestamp):
+        command = record.schema.command.decode('ascii')
+        if command not in self._commands:
+            return
+        names = self._numeric_fields.get(record.schema)
+        if names is None:
+            names = [(field.name, field.index) for field in record.schema.fields if field.type in (float, int)]
+            self._numeric_fields[record.schema] = names
+        inverter = self._inverter(serial)
+        with inverter.lock:
+            for name, _ in names:
+                value = record[name]
+                if value is not None:
+                    inverter.add(name, timestamp, value)
+        return
+
+    def query(self, serial, field, resolution="raw", start=None, end=None, limit=None):
+        with self._lock:
+            inverter = self._inverters.get(serial)
+        if inverter is None:
+            raise KeyError(serial)
+        with inverter.lock:
+            history = inverter.fields.get(field)
+            if history is None:
+                raise KeyError(field)
+            return history.query(resolution, start, end, min(limit or self._max_points, self._max_points))
+
+    def list_fields(self, serial):
+        with self._lock:
+            inverter = self._inverters.get(serial)
+        if inverter is None:
+            return []
+        with inverter.lock:
+            return sorted(inverter.fields.keys())
+
+    def memory_bytes(self):
+        # what the rings take, whether in memory or mapped
+        per_field = _Allocator.size(FieldHistory._layout(self._resolutions))
+        with self._lock:
+            return per_field * sum(len(inverter.fields) for inverter in self._inverters.values())
+
+    def register_mqtt(self, mqtt_client):
+        self._mqtt_client = mqtt_client
+        mqtt_client.add_subscription("+/history/get")
+        mqtt_client.register_message_callback(self.handle_mqtt_request, "+/history/get")
+        return
+
+    def _check_request(self, field, resolution, start, end, limit):
+        # the request comes from anyone who can publish to the broker, so check it before it's used
+        if not isinstance(field, str):
+            raise TypeError("field must be a string")
+        if not isinstance(resolution, str):
+            raise TypeError("resolution must be a string")
+        for name, value in (("start", start), ("end", end)):
+            if value is not None and (isinstance(value, bool) or not isinstance(value, (int, float))):
+                raise TypeError("{} must be a number".format(name))
+        if limit is not None and (isinstance(limit, bool) or not isinstance(limit, int) or limit < 0):
+            raise TypeError("limit must be a whole number of points")
+        return
+
+    def handle_mqtt_request(self, msg):
+        serial = msg.topic.split("/")[-3]
+        if not self._answer_unknown:
+            with self._lock:
+                if serial not in self._inverters:
+                    return
+        response = {}
+        try:
+            request = json.loads(msg.payload.decode('utf-8') or "{}")
+            response["id"] = request.get("id")
+            if request.get("fields"):
+                response["fields"] = self.list_fields(serial)
+            else:
+                response["field"] = request["field"]
+                response["resolution"] = request.get("resolution", "raw")
+                start, end, limit = request.get("start"), request.get("end"), request.get("limit")
+                self._check_request(response["field"], response["resolution"], start, end, limit)
+                response["points"] = self.query(serial, response["field"], response["resolution"], start, end, limit)
+        except KeyError as e:
+            response["error"] = "unknown {}".format(e)
+        except (ValueError, TypeError, AttributeError) as e:
+            response["error"] = "bad request: {}".format(e)
+        self._mqtt_client.publish_message("{}/history/response".format(serial), json.dumps(response))
+        return
+
+    def flush(self):
+        with self._lock:
+            inverters = list(self._inverters.values())
+        for inverter in inverters:
+            with inverter.lock:
+                for field in inverter.fields.values():
+                    field.flush()
+        return
+
+    def close(self):
+        with self._lock:
+            inverters = list(self._inverters.values())
+        for inverter in inverters:
+            inverter.close()
+        return
@@ -0,0 +1,147 @@
+#!/bin/python
+# What each inverter told us about itself last time, so a reconnect can skip the handshake.
+#
+# The handshake (QPI, QID, then the QVFW firmware queries, a few seconds apart) holds back
+# telemetry for about 20 seconds, and the wifi dongles drop and reconnect often.  The protocol
+# version, serial and firmware versions are kept in a small json file keyed by the dongle's
+# address.  A session from a known address checks the cached identity with a single QID and
+# starts polling as soon as it's confirmed; only if the serial doesn't match does it go back to
+# the full handshake.
+#
+# Writes are batched (a background thread writes whatever changed every flush_interval seconds,
+# and close() writes the rest) and go to a temporary file that replaces the old one, so a crash leaves either the old or the new file and
+# never half of one.  Workers sharing the file under --workers hold a lock while writing and merge
+# in what the others have written since.
+import fcntl
+import json
+import logging
+import os
+import threading
+import time
+from voltronic_wifi_bridge import voltronic_metrics
+
+logger = logging.getLogger(__name__)
+
+_VERSION = 1
+
+
+class IdentityCache(threading.Thread):
+    lookups = voltronic_metrics.REGISTRY.counter("voltronic_identity_cache_total", "Identity cache lookups and checks by outcome", ["outcome"])
+
+    def __init__(self, path, flush_interval=5):
+        threading.Thread.__init__(self, daemon=True)
+        self._path = path
+        self._flush_interval = flush_interval
+        self._lock = threading.Lock()
+        # key -> {"protocol_version": int, "serial": str, "firmware": {number: version}, "updated": unix time}
+        self._entries = {}
+        # keys changed here and not yet written, so merging with other workers' writes keeps ours
+        self._dirty = set()
+        self._last_flush = 0
+        self._loaded_mtime = None
+        self._stop_event = threading.Event()
+        self._load()
+        return
+
+    def _read(self):
+        try:
+            with open(self._path, "r") as f:
+                contents = json.load(f)
+        except FileNotFoundError:
+            return {}
+        except (OSError, ValueError) as e:
+            logger.warning("ignoring unreadable identity cache %s: %s", self._path, e)
+            return {}
+        if not isinstance(contents, dict) or contents.get("version") != _VERSION or not isinstance(contents.get("inverters"), dict):
+            logger.warning("ignoring identity cache %s, it isn't in a format this version understands", self._path)
+            return {}
+        return contents["inverters"]
+
+    def _mtime(self):
+        try:
+            return os.stat(self._path).st_mtime_ns
+        except OSError:
+            return None
+
+    def _load(self):
+        # pick up anything another worker has written since we last looked
+        mtime = self._mtime()
+        if mtime == self._loaded_mtime:
+            return
+        entries = self._read()
+        for key in self._dirty:
+            if key in self._entries:
+                entries[key] = self._entries[key]
+        self._entries = entries
+        self._loaded_mtime = mtime
+        return
+
+    def get(self, key):
+        # (protocol_version, serial, {firmware number: version}) or None
+        with self._lock:
+            self._load()
+            entry = self._entries.get(key)
+        if entry is None:
+            self.lookups.labels("miss").inc()
+            return None
+        self.lookups.labels("hit").inc()
+        return (entry["protocol_version"], entry["serial"], dict(entry["firmware"]))
+
+    def store(self, key, protocol_version, serial, firmware):
+        entry = {"protocol_version": protocol_version, "serial": serial, "firmware": dict(firmware)}
+        with self._lock:
+            current = self._entries.get(key)
+            if current is not None and all(current.get(name) == value for name, value in entry.items()):
+                return
+            entry["updated"] = time.time()
+            self._entries[key] = entry
+            self._dirty.add(key)
+            # a burst of connects is written together by run(), a change on a quiet cache straight away
+            if time.monotonic() - self._last_flush >= self._flush_interval:
+                self._flush()
+        return
+
+    def record_check(self, matched):
+        self.lookups.labels("confirmed" if matched else "mismatched").inc()
+        return
+
+    def _flush(self):
+        # with self._lock held
+        if len(self._dirty) == 0:
+            return
+        self._last_flush = time.monotonic()
+        temporary = "{}.{}.tmp".format(self._path, os.getpid())
+        try:
+            with open(self._path + ".lock", "a") as lock:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+                entries = self._read()
+                for key in self._dirty:
+                    entries[key] = self._entries[key]
+                with open(temporary, "w") as f:
+                    json.dump({"version": _VERSION, "inverters": entries}, f, indent=1, sort_keys=True)
+                    f.flush()
+                    os.fsync(f.fileno())
+                os.replace(temporary, self._path)
+                self._entries = entries
+                self._loaded_mtime = self._mtime()
+        except OSError as e:
+            logger.warning("couldn't write identity cache %s: %s", self._path, e)
+            return
+        logger.debug("wrote %s changed identities to %s", len(self._dirty), self._path)
+        self._dirty.clear()
+        return
+
+    def flush(self):
+        with self._lock:
+            self._flush()
+        return
+
+    def run(self):
+        while not self._stop_event.wait(self._flush_interval):
+            self.flush()
+        return
+
+    def close(self):
+        self._stop_event.set()
+        self.flush()
+        return
@@ -0,0 +1,219 @@
+#!/bin/python
+# Send parsed records to InfluxDB as line protocol.
+#
+# Each record becomes one point: measurement is the command (qpigs, qpiri, ...), the inverter
+# serial is a tag and every parsed field is a field.  Points from every inverter are batched and
+# sent gzipped from one background thread over a single keep-alive connection, either when
+# batch_size points are waiting or every flush_interval seconds.  If InfluxDB can't be reached
+# points wait in a bounded buffer and the oldest are dropped first once it's full.
+import base64
+import gzip
+import http.client
+import logging
+import math
+import threading
+import time
+import urllib.parse
+from voltronic_wifi_bridge import voltronic_server
+from voltronic_wifi_bridge import voltronic_metrics
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_COMMANDS = ["QPIGS", "QPIGS2", "QPIRI", "QPIWS"]
+
+
+class InfluxWriteError(Exception):
+    "Used when InfluxDB rejects a write in a way that retrying won't fix"
+
+
+def _escape_key(text):
+    # measurement names, tag keys and values, field keys
+    return text.replace("\\", "\\\\").replace(",", "\\,").replace("=", "\\=").replace(" ", "\\ ")
+
+
+def _format_value(value):
+    if isinstance(value, bool):
+        return "true" if value else "false"
+    if isinstance(value, int):
+        return "{}i".format(value)
+    if isinstance(value, float):
+        return repr(value)
+    return '"{}"'.format(str(value).replace("\\", "\\\\").replace('"', '\\"'))
+
+
+class InfluxExporter(voltronic_server.SessionListener, threading.Thread):
+    points = voltronic_metrics.REGISTRY.counter("voltronic_influx_points_total", "Points written to or dropped before reaching InfluxDB", ["result"])
+    requests = voltronic_metrics.REGISTRY.counter("voltronic_influx_requests_total", "Writes sent to InfluxDB by outcome", ["outcome"])
+
+    def __init__(self, url, version=1, database="voltronic", username=None, password=None, org=None, bucket=None, token=None,
+                 commands=None, batch_size=5000, flush_interval=10, max_buffered=100000, timeout=10, compresslevel=5):
+        threading.Thread.__init__(self, daemon=True)
+        parsed = urllib.parse.urlsplit(url)
+        if parsed.scheme not in ("http", "https"):
+            raise ValueError("influx url must be http:// or https://, got {}".format(url))
+        self._scheme = parsed.scheme
+        self._host = parsed.hostname
+        self._port = parsed.port
+        self._timeout = timeout
+        self._headers = {"Content-Type": "text/plain; charset=utf-8", "Content-Encoding": "gzip"}
+        if version == 2:
+            if org is None or bucket is None or token is None:
+                raise ValueError("influx version 2 needs an org, a bucket and a token")
+            self._path = "{}/api/v2/write?{}".format(parsed.path.rstrip("/"), urllib.parse.urlencode({"org": org, "bucket": bucket, "precision": "ms"}))
+            self._headers["Authorization"] = "Token {}".format(token)
+        elif version == 1:
+            self._path = "{}/write?{}".format(parsed.path.rstrip("/"), urllib.parse.urlencode({"db": database, "precision": "ms"}))
+            if username is not None:
+                credentials = base64.b64encode("{}:{}".format(username, password or "").encode('utf-8')).decode('ascii')
+                self._headers["Authorization"] = "Basic {}".format(credentials)
+        else:
+            raise ValueError("influx version must be 1 or 2")
+        self._commands = set(commands if commands is not None else DEFAULT_COMMANDS)
+        self._batch_size = batch_size
+        self._flush_interval = flush_interval
+        self._max_buffered = max_buffered
+        self._compresslevel = compresslevel
+
+        # line protocol for one point per entry, oldest first
+        self._lock = threading.Lock()
+        self._buffer = []
+        self._wakeup = threading.Event()
+        self._exit_request = False
+        self._connection = None
+        # escaped field keys per schema, and escaped serial tags
+        self._field_keys = {}
+        self._tags = {}
+
+        self._written = self.points.labels("written")
+        self._dropped = self.points.labels("dropped")
+        return
+
+    def handle_record(self, serial, record, timestamp):
+        schema = record.schema
+        keys = self._field_keys.get(schema)
+        if keys is None:
+            command = schema.command.decode('ascii')
+            if command not in self._commands:
+                keys = ()
+            else:
+                keys = (_escape_key(command.lower()), [(field.name, _escape_key(field.name)) for field in schema.fields])
+            self._field_keys[schema] = keys
+        if len(keys) == 0:
+            return
+        tag = self._tags.get(serial)
+        if tag is None:
+            tag = self._tags[serial] = _escape_key(serial)
+        measurement, fields = keys
+        values = record.values
+        field_set = ",".join("{}={}".format(key, _format_value(values[index])) for index, (_, key) in enumerate(fields)
+                             if values[index] is not None and not (isinstance(values[index], float) and not math.isfinite(values[index])))
+        if field_set == "":
+            return
+        self.add_lines(["{},serial={} {} {}".format(measurement, tag, field_set, int(timestamp * 1000))])
+        return
+
+    def add_lines(self, lines):
+        with self._lock:
+            self._buffer.extend(lines)
+            overflow = len(self._buffer) - self._max_buffered
+            if overflow > 0:
+                del self._buffer[0:overflow]
+            waiting = len(self._buffer)
+        if overflow > 0:
+            self._dropped.inc(overflow)
+        if waiting >= self._batch_size:
+            self._wakeup.set()
+        return
+
+    def pending(self):
+        with self._lock:
+            return len(self._buffer)
+
+    def run(self):
+        backoff = 0
+        next_flush = time.monotonic() + self._flush_interval
+        while True:
+            timeout = max(0, next_flush - time.monotonic()) if backoff == 0 else backoff
+            self._wakeup.wait(timeout)
+            self._wakeup.clear()
+            if backoff == 0 and not self._exit_request and self.pending() < self._batch_size and time.monotonic() < next_flush:
+                continue
+            next_flush = time.monotonic() + self._flush_interval
+            try:
+                self.flush()
+                backoff = 0
+            except (OSError, http.client.HTTPException) as e:
+                backoff = min(max(1, backoff * 2), 60)
+                logger.warning("influx write failed, retrying in %s seconds: %s", backoff, e)
+            if self._exit_request:
+                break
+        self._close_connection()
+        return
+
+    def flush(self):
+        # send everything waiting, a batch at a time; raises if influx can't be reached, leaving
+        # the unsent points buffered
+        while True:
+            with self._lock:
+                batch = self._buffer[0:self._batch_size]
+                del self._buffer[0:self._batch_size]
+            if len(batch) == 0:
+                return
+            try:
+                self._write(batch)
+                self._written.inc(len(batch))
+            except InfluxWriteError as e:
+                logger.error("influx rejected %s points, dropping them: %s", len(batch), e)
+                self._dropped.inc(len(batch))
+            except:
+                # put them back in front of anything newer, trimming the oldest if that overflows
+                with self._lock:
+                    self._buffer[0:0] = batch
+                    overflow = len(self._buffer) - self._max_buffered
+                    if overflow > 0:
+                        del self._buffer[0:overflow]
+                if overflow > 0:
+                    self._dropped.inc(overflow)
+                raise
+
+    def _write(self, lines):
+        body = gzip.compress("\n".join(lines).encode('utf-8'), compresslevel=self._compresslevel)
+        for attempt in (1, 2):
+            if self._connection is None:
+                if self._scheme == "https":
+                    self._connection = http.client.HTTPSConnection(self._host, self._port, timeout=self._timeout)
+                else:
+                    self._connection = http.client.HTTPConnection(self._host, self._port, timeout=self._timeout)
+            try:
+                self._connection.request("POST", self._path, body, self._headers)
+                response = self._connection.getresponse()
+                detail = response.read()
+            except (OSError, http.client.HTTPException):
+                self._close_connection()
+                # a keep-alive connection the server has since closed fails once; try a fresh one
+                if attempt == 2:
+                    self.requests.labels("error").inc()
+                    raise
+                continue
+            if response.getheader("Connection", "").lower() == "close":
+                self._close_connection()
+            break
+        if response.status < 300:
+            self.requests.labels("ok").inc()
+            return
+        self.requests.labels(str(response.status)).inc()
+        if response.status == 429 or response.status >= 500:
+            raise http.client.HTTPException("influx answered {} {}".format(response.status, detail[:200]))
+        raise InfluxWriteError("influx answered {} {}".format(response.status, detail[:200]))
+
+    def _close_connection(self):
+        if self._connection is not None:
+            self._connection.close()
+            self._connection = None
+        return
+
+    def exit(self):
+        # the thread makes one last attempt to send what's buffered before it stops
+        self._exit_request = True
+        self._wakeup.set()
+        return
@@ -0,0 +1,378 @@
+#!/bin/python
+import bisect
+import http.server
+import json
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+# seconds, covers a fast lan dongle up to the longest query timeout
+LATENCY_BUCKETS = (0.05, 0.1, 0.2, 0.35, 0.5, 0.75, 1.0, 1.5, 2.5, 5.0, 10.0)
+
+
+class _Value():
+    # one counter or gauge series; either holds a value or reads one from a function at scrape time
+    __slots__ = ("_lock", "_value", "_function")
+
+    def __init__(self, lock):
+        self._lock = lock
+        self._value = 0
+        self._function = None
+        return
+
+    def inc(self, amount=1):
+        with self._lock:
+            self._value += amount
+        return
+
+    def dec(self, amount=1):
+        with self._lock:
+            self._value -= amount
+        return
+
+    def set(self, value):
+        self._value = value
+        return
+
+    def set_function(self, function):
+        # for values the code already keeps (queue lengths etc), nothing to do on the hot path
+        self._function = function
+        return
+
+    def get(self):
+        if self._function is not None:
+            return self._function()
+        return self._value
+
+
+class _Histogram():
+    __slots__ = ("_lock", "_buckets", "_counts", "_sum", "_count")
+
+    def __init__(self, lock, buckets):
+        self._lock = lock
+        self._buckets = buckets
+        self._counts = [0] * (len(buckets) + 1)
+        self._sum = 0.0
+        self._count = 0
+        return
+
+    def observe(self, value):
+        index = bisect.bisect_left(self._buckets, value)
+        with self._lock:
+            self._counts[index] += 1
+            self._sum += value
+            self._count += 1
+        return
+
+    def merge(self, other):
+        with other._lock:
+            counts = list(other._counts)
+            total, count = other._sum, other._count
+        with self._lock:
+            for index, bucket_count in enumerate(counts):
+                self._counts[index] += bucket_count
+            self._sum += total
+            self._count += count
+        return
+
+    def get(self):
+        # cumulative bucket counts the way prometheus wants them, plus sum and count
+        with self._lock:
+            counts = list(self._counts)
+            total, count = self._sum, self._count
+        cumulative = []
+        running = 0
+        for bucket_count in counts:
+            running += bucket_count
+            cumulative.append(running)
+        return cumulative, total, count
+
+
+class MetricFamily():
+    # a named metric with a fixed set of label names; each combination of label values is a series
+    def __init__(self, name, documentation, metric_type, labelnames, buckets=None):
+        self.name = name
+        self.documentation = documentation
+        self.type = metric_type
+        self.labelnames = tuple(labelnames)
+        self._buckets = buckets
+        self._lock = threading.Lock()
+        self._children = {}
+        return
+
+    def labels(self, *values):
+        # look up (or create) the series for these label values; callers keep the result around
+        # so the hot path is just the increment
+        child = self._children.get(values)
+        if child is None:
+            if len(values) != len(self.labelnames):
+                raise ValueError("{} expects labels {}".format(self.name, self.labelnames))
+            with self._lock:
+                child = self._children.get(values)
+                if child is None:
+                    child = self._new_child()
+                    self._children[values] = child
+        return child
+
+    def replace(self, *values):
+        # a new series in place of any existing one with these label values, for gauges reading from
+        # an object that a newer one takes over from (see remove's child)
+        if len(values) != len(self.labelnames):
+            raise ValueError("{} expects labels {}".format(self.name, self.labelnames))
+        with self._lock:
+            child = self._new_child()
+            self._children[values] = child
+        return child
+
+    def _new_child(self):
+        if self.type == "histogram":
+            return _Histogram(self._lock, self._buckets)
+        return _Value(self._lock)
+
+    def remove(self, *values, child=None):
+        # with child, only if the series is still that one and not a newer one with the same labels
+        with self._lock:
+            if child is None or self._children.get(values) is child:
+                self._children.pop(values, None)
+        return
+
+    def series(self):
+        with self._lock:
+            return list(self._children.items())
+
+
+class Registry():
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._families = {}
+        return
+
+    def _family(self, name, documentation, metric_type, labelnames, buckets=None):
+        with self._lock:
+            family = self._families.get(name)
+            if family is None:
+                family = MetricFamily(name, documentation, metric_type, labelnames, buckets)
+                self._families[name] = family
+            elif family.type != metric_type or family.labelnames != tuple(labelnames):
+                raise ValueError("metric {} is already registered differently".format(name))
+        return family
+
+    def counter(self, name, documentation, labelnames=()):
+        return self._family(name, documentation, "counter", labelnames)
+
+    def gauge(self, name, documentation, labelnames=()):
+        return self._family(name, documentation, "gauge", labelnames)
+
+    def histogram(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        return self._family(name, documentation, "histogram", labelnames, tuple(sorted(buckets)))
+
+    def families(self):
+        with self._lock:
+            return list(self._families.values())
+
+    def render(self):
+        # prometheus text exposition format
+        lines = []
+        for family in self.families():
+            lines.append("# HELP {} {}".format(family.name, family.documentation))
+            lines.append("# TYPE {} {}".format(family.name, family.type))
+            for values, child in family.series():
+                labels = ",".join('{}="{}"'.format(name, _escape(value)) for name, value in zip(family.labelnames, values))
+                if family.type == "histogram":
+                    cumulative, total, count = child.get()
+                    prefix = labels + "," if labels else ""
+                    for bound, bucket_count in zip(family._buckets + (float("inf"),), cumulative):
+                        lines.append('{}_bucket{{{}le="{}"}} {}'.format(family.name, prefix, _format_bound(bound), bucket_count))
+                    lines.append("{}_sum{} {}".format(family.name, _braces(labels), total))
+                    lines.append("{}_count{} {}".format(family.name, _braces(labels), count))
+                else:
+                    lines.append("{}{} {}".format(family.name, _braces(labels), child.get()))
+        lines.append("")
+        return "\n".join(lines)
+
+    def summary(self, labelname="inverter"):
+        # {label value: {metric: value}} for every series carrying labelname, histograms as
+        # count and mean, other labels folded into the metric name
+        summaries = {}
+        for family in self.families():
+            if labelname not in family.labelnames:
+                continue
+            position = family.labelnames.index(labelname)
+            for values, child in family.series():
+                name = "_".join([family.name] + [value for i, value in enumerate(values) if i != position])
+                if family.type == "histogram":
+                    _, total, count = child.get()
+                    value = {"count": count, "mean": round(total / count, 4) if count > 0 else None}
+                else:
+                    value = child.get()
+                summaries.setdefault(values[position], {})[name] = value
+        return summaries
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _braces(labels):
+    return "{" + labels + "}" if labels else ""
+
+
+def _format_bound(bound):
+    return "+Inf" if bound == float("inf") else repr(bound)
+
+
+# the registry everything in the bridge records into
+REGISTRY = Registry()
+
+
+class MetricsHTTPServer(threading.Thread):
+    # serves the registry as prometheus text on http://<address>:<port>/metrics
+    def __init__(self, port, address="127.0.0.1", registry=REGISTRY):
+        threading.Thread.__init__(self, daemon=True)
+        self._registry = registry
+        registry_ref = registry
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split("?", 1)[0] not in ("/", "/metrics"):
+                    self.send_error(404)
+                    return
+                body = registry_ref.render().encode('utf-8')
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+                return
+
+            def log_message(self, format, *args):
+                logger.debug("metrics request from %s: " + format, self.address_string(), *args)
+                return
+
+        self._httpd = http.server.ThreadingHTTPServer((address, port), Handler)
+        self._httpd.daemon_threads = True
+        return
+
+    def run(self):
+        logger.info("serving metrics on %s:%s", *self._httpd.server_address[:2])
+        self._httpd.serve_forever()
+        return
+
+    def exit(self):
+        self._httpd.shutdown()
+        self._httpd.server_close()
+        return
+
+
+class MetricsReporter(threading.Thread):
+    # publishes a json summary of each inverter's metrics on <serial>/metrics every interval seconds
+    def __init__(self, mqtt_client, interval, registry=REGISTRY):
+        threading.Thread.__init__(self, daemon=True)
+        self._mqtt_client = mqtt_client
+        self._interval = interval
+        self._registry = registry
+        self._stop_event = threading.Event()
+        return
+
+    def run(self):
+        while not self._stop_event.wait(self._interval):
+            for inverter, summary in self._registry.summary().items():
+                self._mqtt_client.publish_message("{}/metrics".format(inverter), json.dumps(summary))
+        return
+
+    def exit(self):
+        self._stop_event.set()
+        return
+
+
+class InverterMetrics():
+    # the series for one inverter session, looked up once so recording is just the increment
+    frames = REGISTRY.counter("voltronic_frames_total", "Frames sent to and received from the inverter", ["inverter", "direction"])
+    transferred = REGISTRY.counter("voltronic_bytes_total", "Bytes sent to and received from the inverter", ["inverter", "direction"])
+    crc_failures = REGISTRY.counter("voltronic_crc_failures_total", "Received frames with a bad CRC", ["inverter"])
+    naks = REGISTRY.counter("voltronic_naks_total", "Queries the inverter answered with NAK", ["inverter"])
+    timeouts = REGISTRY.counter("voltronic_timeouts_total", "Queries given up on without an answer", ["inverter"])
+    invalid_responses = REGISTRY.counter("voltronic_invalid_responses_total", "Responses that couldn't be parsed", ["inverter"])
+    invalid_resets = REGISTRY.counter("voltronic_invalid_response_resets_total",
+                                      "Connections dropped after too many invalid responses", ["inverter"])
+    resyncs = REGISTRY.counter("voltronic_frame_resyncs_total", "Times the frame parser had to skip garbage to find a frame", ["inverter"])
+    queue_depth = REGISTRY.gauge("voltronic_queue_depth", "Queries waiting to be sent (to_send) or for an answer (in_flight)", ["inverter", "queue"])
+    latency = REGISTRY.histogram("voltronic_response_seconds", "Round trip time from sending a query to its answer", ["inverter", "command"])
+
+    def __init__(self, inverter, session):
+        self.inverter = inverter
+        self.frames_in = self.frames.labels(inverter, "in")
+        self.frames_out = self.frames.labels(inverter, "out")
+        self.bytes_in = self.transferred.labels(inverter, "in")
+        self.bytes_out = self.transferred.labels(inverter, "out")
+        self.crc_failure = self.crc_failures.labels(inverter)
+        self.nak = self.naks.labels(inverter)
+        self.timeout = self.timeouts.labels(inverter)
+        self.invalid_response = self.invalid_responses.labels(inverter)
+        self.invalid_reset = self.invalid_resets.labels(inverter)
+        self._resyncs = self.resyncs.replace(inverter)
+        self._resyncs.set_function(lambda: session._frames.resync_events)
+        self._to_send = self.queue_depth.replace(inverter, "to_send")
+        self._to_send.set_function(lambda: len(session._to_send))
+        self._in_flight = self.queue_depth.replace(inverter, "in_flight")
+        self._in_flight.set_function(lambda: len(session._queries))
+        self._latencies = {}
+        return
+
+    def observe_latency(self, command, seconds):
+        histogram = self._latencies.get(command)
+        if histogram is None:
+            histogram = self.latency.labels(self.inverter, command)
+            self._latencies[command] = histogram
+        histogram.observe(seconds)
+        return
+
+    def carry_over(self, previous):
+        # the session learnt its serial number; move what was counted under the address to the serial
+        for mine, theirs in [(self.frames_in, previous.frames_in), (self.frames_out, previous.frames_out),
+                             (self.bytes_in, previous.bytes_in), (self.bytes_out, previous.bytes_out),
+                             (self.crc_failure, previous.crc_failure), (self.nak, previous.nak), (self.timeout, previous.timeout),
+                             (self.invalid_response, previous.invalid_response)]:
+            mine.inc(theirs.get())
+        for command, histogram in previous._latencies.items():
+            if command not in self._latencies:
+                self._latencies[command] = self.latency.labels(self.inverter, command)
+            self._latencies[command].merge(histogram)
+        previous.close(remove_all=True)
+        return
+
+    def close(self, remove_all=False):
+        # the session's gauges read from the session, so they go when it does, unless a newer
+        # session for the same inverter has already replaced them
+        self.resyncs.remove(self.inverter, child=self._resyncs)
+        self.queue_depth.remove(self.inverter, "to_send", child=self._to_send)
+        self.queue_depth.remove(self.inverter, "in_flight", child=self._in_flight)
+        if remove_all:
+            for direction in ("in", "out"):
+                self.frames.remove(self.inverter, direction)
+                self.transferred.remove(self.inverter, direction)
+            for family in (self.crc_failures, self.naks, self.timeouts, self.invalid_responses, self.invalid_resets):
+                family.remove(self.inverter)
+            for command in self._latencies.keys():
+                self.latency.remove(self.inverter, command)
+        return
+
+
+class PublisherMetrics():
+    messages = REGISTRY.counter("voltronic_mqtt_messages_total", "MQTT messages published or suppressed by the publisher", ["inverter", "result"])
+
+    def __init__(self):
+        self._sent = {}
+        self._suppressed = {}
+        return
+
+    def record(self, inverter, sent, suppressed):
+        child = self._sent.get(inverter)
+        if child is None:
+            child = self._sent[inverter] = self.messages.labels(inverter, "sent")
+            self._suppressed[inverter] = self.messages.labels(inverter, "suppressed")
+        child.inc(sent)
+        if suppressed:
+            self._suppressed[inverter].inc(suppressed)
+        return
@@ -0,0 +1,88 @@
+#!/bin/python
+import heapq
+
+
+class RTTEstimator():
+    # smoothed round trip time and variance (Jacobson/Karels, as TCP does) giving a timeout that
+    # follows what this inverter actually achieves instead of a fixed 10 seconds
+    def __init__(self, initial_timeout=10.0, min_timeout=0.5, max_timeout=10.0):
+        self._initial_timeout = initial_timeout
+        self._min_timeout = min_timeout
+        self._max_timeout = max_timeout
+        self.srtt = None
+        self.rttvar = None
+        return
+
+    def update(self, sample):
+        if self.srtt is None:
+            self.srtt = sample
+            self.rttvar = sample / 2
+        else:
+            self.rttvar = 0.75 * self.rttvar + 0.25 * abs(self.srtt - sample)
+            self.srtt = 0.875 * self.srtt + 0.125 * sample
+        return
+
+    def timeout(self):
+        if self.srtt is None:
+            return self._initial_timeout
+        return min(self._max_timeout, max(self._min_timeout, self.srtt + 4 * self.rttvar))
+
+
+class PendingQueries():
+    # queries that have gone out and are waiting for an answer, by their 2 byte counter key, with a
+    # min-heap of deadlines so finding the expired ones is O(log n) instead of a scan.
+    # answered queries are left in the heap and skipped when they reach the top
+    def __init__(self):
+        self._pending = {}
+        self._deadlines = []
+        self._sequence = 0
+        return
+
+    def __len__(self):
+        return len(self._pending)
+
+    def __contains__(self, key):
+        return key in self._pending
+
+    def values(self):
+        return self._pending.values()
+
+    def add(self, query, deadline):
+        key = query.get_key()
+        self._pending[key] = query
+        self._sequence += 1
+        heapq.heappush(self._deadlines, (deadline, self._sequence, key, query))
+        if len(self._deadlines) > 4 * len(self._pending) + 16:
+            self._compact()
+        return
+
+    def pop(self, key):
+        return self._pending.pop(key, None)
+
+    def _compact(self):
+        self._deadlines = [entry for entry in self._deadlines if self._pending.get(entry[2]) is entry[3]]
+        heapq.heapify(self._deadlines)
+        return
+
+    def _drop_answered(self):
+        while len(self._deadlines) > 0 and self._pending.get(self._deadlines[0][2]) is not self._deadlines[0][3]:
+            heapq.heappop(self._deadlines)
+        return
+
+    def next_deadline(self):
+        self._drop_answered()
+        if len(self._deadlines) == 0:
+            return None
+        return self._deadlines[0][0]
+
+    def expire(self, now):
+        # remove and return every query whose deadline has passed
+        expired = []
+        self._drop_answered()
+        while len(self._deadlines) > 0 and self._deadlines[0][0] <= now:
+            _, _, key, query = heapq.heappop(self._deadlines)
+            if self._pending.get(key) is query:
+                del self._pending[key]
+                expired.append(query)
+            self._drop_answered()
+        return expired
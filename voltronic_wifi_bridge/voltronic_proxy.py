@@ -0,0 +1,279 @@
+#!/bin/python
+# Pass the vendor cloud's traffic through to the inverter so the phone app keeps working.
+#
+# With an upstream address each inverter session opens its own connection to the cloud server,
+# standing in for the wifi module.  Frames the cloud sends are queued on the session as
+# voltronic_server.ProxiedQuery, so they share the in-flight window with our own polls and are
+# sent with a counter from the session's counter space.  The inverter's answer goes back up with
+# the cloud's counter put back in place of ours; the counter isn't covered by the CRC so nothing
+# else in the frame changes.
+#
+# The link is non-blocking and owned by the session's loop: call poll() regularly, wait for
+# fileno() to be readable (and writable while wants_write()), then call handle_readable() or
+# handle_writable().
+#
+# The upstream's name is looked up by one UpstreamResolver shared by every session, once at
+# startup and then on its own thread every refresh_interval seconds or soon after a connection
+# fails, so a slow or broken DNS server never holds up a session's loop (or, under asyncio, every
+# session at once).  Until a lookup has succeeded the links count it as a failed connect and retry.
+import errno
+import logging
+import os
+import socket
+import threading
+import time
+from voltronic_wifi_bridge import voltronic_tools
+from voltronic_wifi_bridge import voltronic_metrics
+
+logger = logging.getLogger(__name__)
+
+
+def parse_address(text, default_port=502):
+    # "host:port" or "host" to (host, port)
+    host, sep, port = text.rpartition(":")
+    if sep == "":
+        return (text, default_port)
+    return (host.strip("[]"), int(port))
+
+
+class UpstreamResolver(threading.Thread):
+    lookups = voltronic_metrics.REGISTRY.counter("voltronic_proxy_lookups_total", "Lookups of the upstream server's address by outcome",
+                                                 ["outcome"])
+
+    def __init__(self, address, refresh_interval=300, min_interval=10):
+        threading.Thread.__init__(self, daemon=True)
+        # (host, port) as given
+        self.address = address
+        self._refresh_interval = refresh_interval
+        self._min_interval = min_interval
+        # (family, type, proto, sockaddr) from the last lookup that worked
+        self._resolved = None
+        self._failures = 0
+        self._wakeup = threading.Event()
+        self._stop_event = threading.Event()
+        return
+
+    def resolve(self):
+        # blocking; True if the address was found
+        host, port = self.address
+        try:
+            family, kind, proto, _, address = socket.getaddrinfo(host, port, type=socket.SOCK_STREAM)[0]
+        except OSError as e:
+            self.lookups.labels("failed").inc()
+            self._failures += 1
+            # keep using the last address we had, if any; a name that stays broken is only worth one warning
+            logger.log(logging.WARNING if self._failures == 1 else logging.DEBUG, "couldn't look up upstream %s:%s: %s", host, port, e)
+            return False
+        self.lookups.labels("ok").inc()
+        self._failures = 0
+        if self._resolved is None or self._resolved[3] != address:
+            logger.info("upstream %s:%s is at %s", host, port, address[0])
+        self._resolved = (family, kind, proto, address)
+        return True
+
+    def resolved(self):
+        # the last address found, or None; never blocks
+        return self._resolved
+
+    def refresh(self):
+        # look the name up again soon, eg after a connection to the old address failed
+        self._wakeup.set()
+        return
+
+    def run(self):
+        while not self._stop_event.is_set():
+            self._wakeup.wait(self._refresh_interval if self._resolved is not None else self._min_interval)
+            self._wakeup.clear()
+            if self._stop_event.is_set():
+                break
+            self.resolve()
+            # however many sessions ask, don't look it up more often than this
+            self._stop_event.wait(self._min_interval)
+        return
+
+    def exit(self):
+        self._stop_event.set()
+        self._wakeup.set()
+        return
+
+
+class UpstreamLink():
+    frames = voltronic_metrics.REGISTRY.counter("voltronic_proxy_frames_total", "Frames relayed between the upstream server and the inverters",
+                                                ["direction"])
+    connects = voltronic_metrics.REGISTRY.counter("voltronic_proxy_connects_total", "Connection attempts to the upstream server by outcome",
+                                                  ["outcome"])
+
+    def __init__(self, resolver, reconnect_delay=10, max_pending=64 * 1024):
+        # an UpstreamResolver, shared with the other sessions
+        self._resolver = resolver
+        self._address = resolver.address
+        self._reconnect_delay = reconnect_delay
+        # how much of the inverter's answers may back up behind a slow upstream before we give up on it
+        self._max_pending = max_pending
+        self._sock = None
+        self._connecting = False
+        self._next_attempt = 0
+        self._failures = 0
+        self._frames = voltronic_tools.FrameBuffer()
+        self._pending = bytearray()
+        # bumped on every new connection, so answers to queries from a previous one aren't sent on this one
+        self.generation = 0
+        # called with this link just before its socket is closed, for loops that registered the fd
+        self.on_close = None
+
+        self._frames_down = self.frames.labels("down")
+        self._frames_up = self.frames.labels("up")
+        self._frames_dropped = self.frames.labels("dropped")
+        return
+
+    def fileno(self):
+        return self._sock.fileno() if self._sock is not None else -1
+
+    def is_open(self):
+        return self._sock is not None
+
+    def connected(self):
+        return self._sock is not None and not self._connecting
+
+    def wants_write(self):
+        return self._sock is not None and (self._connecting or len(self._pending) > 0)
+
+    def seconds_until_retry(self):
+        if self._sock is not None:
+            return None
+        return max(0, self._next_attempt - time.monotonic())
+
+    def poll(self):
+        # start connecting if there's no connection and the retry delay has passed; True if it did
+        if self._sock is not None or time.monotonic() < self._next_attempt:
+            return False
+        resolved = self._resolver.resolved()
+        if resolved is None:
+            self._failed(OSError("address not known yet"))
+            return False
+        family, kind, proto, address = resolved
+        try:
+            sock = socket.socket(family, kind, proto)
+        except OSError as e:
+            self._failed(e)
+            return False
+        sock.setblocking(False)
+        result = sock.connect_ex(address)
+        if result not in (0, errno.EINPROGRESS, errno.EWOULDBLOCK):
+            sock.close()
+            self._failed(OSError(result, os.strerror(result)))
+            return False
+        self._sock = sock
+        self._connecting = True
+        self.generation += 1
+        return True
+
+    def handle_writable(self):
+        if self._connecting:
+            result = self._sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+            if result != 0:
+                self._failed(OSError(result, os.strerror(result)))
+                return
+            self._connecting = False
+            self._failures = 0
+            self._sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            self.connects.labels("ok").inc()
+            logger.info("connected to upstream %s:%s", self._address[0], self._address[1])
+        self._flush()
+        return
+
+    def handle_readable(self):
+        # False once the connection has gone; frames are then available from next_frame()
+        if self._sock is None:
+            return False
+        if self._connecting:
+            self.handle_writable()
+            if not self.connected():
+                return False
+        try:
+            buffer = self._frames.writable()
+            received = self._sock.recv_into(buffer)
+        except BlockingIOError:
+            return True
+        except OSError as e:
+            self._failed(e)
+            return False
+        if received == 0:
+            logger.info("upstream %s:%s closed the connection", self._address[0], self._address[1])
+            self.close()
+            return False
+        self._frames.commit(received)
+        return True
+
+    def next_frame(self):
+        # a view into the receive buffer, only valid until the next handle_readable()
+        frame = self._frames.next_frame()
+        if frame is not None:
+            self._frames_down.inc()
+        return frame
+
+    def send_response(self, counter, frame, generation):
+        # frame is the inverter's answer, straight out of the session's receive buffer; it goes up
+        # with the upstream's counter in front of it and without being copied unless the socket is full
+        if not self.connected() or generation != self.generation:
+            self._frames_dropped.inc()
+            return
+        tail = frame[2:]
+        self._frames_up.inc()
+        if len(self._pending) > 0:
+            self._pending += counter
+            self._pending += tail
+            self._flush()
+            return
+        try:
+            sent = self._sock.sendmsg([counter, tail])
+        except BlockingIOError:
+            sent = 0
+        except OSError as e:
+            self._failed(e)
+            return
+        if sent < len(counter):
+            self._pending += counter[sent:]
+            self._pending += tail
+        elif sent < len(counter) + len(tail):
+            self._pending += tail[sent - len(counter):]
+        if len(self._pending) > self._max_pending:
+            self._failed(OSError("upstream isn't keeping up, {} bytes waiting".format(len(self._pending))))
+        return
+
+    def _flush(self):
+        if len(self._pending) == 0 or not self.connected():
+            return
+        try:
+            sent = self._sock.send(self._pending)
+        except BlockingIOError:
+            return
+        except OSError as e:
+            self._failed(e)
+            return
+        del self._pending[0:sent]
+        return
+
+    def _failed(self, error):
+        if self._connecting or self._sock is None:
+            self.connects.labels("failed").inc()
+            # the name may point somewhere else now
+            self._resolver.refresh()
+        self._failures += 1
+        # an upstream that stays down is only worth one warning
+        logger.log(logging.WARNING if self._failures == 1 else logging.DEBUG,
+                   "upstream %s:%s failed, retrying in %s seconds: %s", self._address[0], self._address[1], self._reconnect_delay, error)
+        self.close()
+        return
+
+    def close(self):
+        if self._sock is not None:
+            if self.on_close is not None:
+                self.on_close(self)
+            self._sock.close()
+            self._sock = None
+        self._connecting = False
+        self._pending = bytearray()
+        self._frames = voltronic_tools.FrameBuffer()
+        self._next_attempt = time.monotonic() + self._reconnect_delay
+        return
@@ -0,0 +1,105 @@
+#!/bin/python
+import json
+import threading
+import time
+from voltronic_wifi_bridge import voltronic_metrics
+
+
+class Publisher():
+    # sits between the inverter connections and MQTTClient.publish_message and decides how the
+    # fields from each poll go out:
+    #   fields  - one message per field, every poll (the original behaviour)
+    #   json    - one json document per command per poll on <serial>/<command>
+    #   changes - one message per field, but only when it moved more than its deadband, plus a
+    #             full refresh of every field each full_refresh_interval seconds
+    modes = ["fields", "json", "changes"]
+
+    def __init__(self, mqtt_client, mode="fields", deadbands=None, default_deadband=0.0, full_refresh_interval=300):
+        if mode not in self.modes:
+            raise ValueError("Unknown publish mode {}, expected one of {}".format(mode, self.modes))
+        self._mqtt_client = mqtt_client
+        self._mode = mode
+        self._deadbands = dict(deadbands or {})
+        self._default_deadband = default_deadband
+        self._full_refresh_interval = full_refresh_interval
+
+        # serial -> {"values": {field: last sent value}, "last_full": time of the last full refresh,
+        #            "refreshed": fields sent since then}
+        self._states_lock = threading.Lock()
+        self._states = {}
+
+        self.messages_sent = 0
+        self.messages_suppressed = 0
+        self._metrics = voltronic_metrics.PublisherMetrics()
+        return
+
+    def get_counters(self):
+        return {"sent": self.messages_sent, "suppressed": self.messages_suppressed}
+
+    def publish_message(self, topicpart, message, retain=False):
+        # a single message that doesn't go through any of the field policies
+        self._mqtt_client.publish_message(topicpart, message, retain=retain)
+        with self._states_lock:
+            self.messages_sent += 1
+        self._metrics.record(topicpart.split("/", 1)[0], 1, 0)
+        return
+
+    def publish_fields(self, serial, command, items):
+        # items is a list of (field name, value) from one poll of command
+        if self._mode == "json":
+            self._mqtt_client.publish_message("{}/{}".format(serial, command.lower()), json.dumps(dict(items)))
+            sent = 1
+            suppressed = len(items) - 1
+        elif self._mode == "changes":
+            sent = 0
+            for name, value in self._changed_items(serial, items):
+                self._mqtt_client.publish_message("{}/{}".format(serial, name), value)
+                sent += 1
+            suppressed = len(items) - sent
+        else:
+            for name, value in items:
+                self._mqtt_client.publish_message("{}/{}".format(serial, name), value)
+            sent = len(items)
+            suppressed = 0
+
+        with self._states_lock:
+            self.messages_sent += sent
+            self.messages_suppressed += suppressed
+        self._metrics.record(serial, sent, suppressed)
+        return
+
+    def _changed_items(self, serial, items):
+        now = time.time()
+        with self._states_lock:
+            state = self._states.get(serial)
+            if state is None:
+                state = {"values": {}, "last_full": now, "refreshed": set()}
+                self._states[serial] = state
+        if now - state["last_full"] >= self._full_refresh_interval:
+            # every field is sent once more on the first poll that carries it after this point
+            state["last_full"] = now
+            state["refreshed"] = set()
+        last_values = state["values"]
+        refreshed = state["refreshed"]
+
+        changed = []
+        for name, value in items:
+            if name in refreshed and not self._has_changed(name, last_values.get(name), value):
+                continue
+            refreshed.add(name)
+            last_values[name] = value
+            changed.append((name, value))
+        return changed
+
+    def _has_changed(self, name, last, value):
+        if last is None:
+            return True
+        if isinstance(value, float) and isinstance(last, float):
+            return abs(value - last) > self._deadbands.get(name, self._default_deadband)
+        return value != last
+
+    def forget(self, serial):
+        # drop the change tracking for an inverter, its next poll will be sent in full
+        with self._states_lock:
+            self._states.pop(serial, None)
+        return
@@ -0,0 +1,116 @@
+#!/bin/python
+# The live inverter sessions of one server, by address and by serial.
+#
+# Sessions add themselves when they're created and remove themselves once their socket is closed,
+# so a finished session (its queries, buffers, metric series and mqtt registration) is gone as soon
+# as it stops rather than living as long as the process.  When a dongle reconnects before the old
+# connection has been noticed as dead, the new session claims the serial and the old one is
+# evicted: it stops taking commands for the serial straight away and closes without telling the
+# listeners the inverter went offline.
+#
+# Under --workers the reconnect may land on another worker, whose registry knows nothing of the
+# old session.  SerialClaims shares the claims between them as one small file per serial naming
+# the process that claimed it last; a session only acts on commands while its process holds the
+# claim, so the old worker stops taking commands as soon as the new session has identified itself.
+import logging
+import os
+import threading
+from voltronic_wifi_bridge import voltronic_metrics
+
+logger = logging.getLogger(__name__)
+
+
+class SessionRegistry():
+    live = voltronic_metrics.REGISTRY.gauge("voltronic_sessions", "Inverter sessions open now, and how many of them have identified themselves",
+                                            ["state"])
+    closed = voltronic_metrics.REGISTRY.counter("voltronic_sessions_closed_total", "Inverter sessions closed by why", ["reason"])
+
+    def __init__(self, claims=None):
+        self._lock = threading.Lock()
+        # optional SerialClaims shared with the other workers
+        self._claims = claims
+        # address label -> session, serial -> session
+        self._by_address = {}
+        self._by_serial = {}
+        self.live.labels("connected").set_function(lambda: len(self._by_address))
+        self.live.labels("identified").set_function(lambda: len(self._by_serial))
+        return
+
+    def __len__(self):
+        return len(self._by_address)
+
+    def add(self, session):
+        with self._lock:
+            self._by_address[session._address_label()] = session
+        return
+
+    def claim(self, session, serial):
+        # session has learnt it talks to serial; any other session still holding it is evicted
+        with self._lock:
+            previous = self._by_serial.get(serial)
+            if session._inverter_serial_number is not None and self._by_serial.get(session._inverter_serial_number) is session:
+                del self._by_serial[session._inverter_serial_number]
+            self._by_serial[serial] = session
+        if self._claims is not None:
+            self._claims.claim(serial)
+        if previous is not None and previous is not session:
+            logger.info("%s reconnected from %s, closing its old session from %s", serial, session._address_label(), previous._address_label())
+            previous.evict()
+        return
+
+    def remove(self, session, reason):
+        with self._lock:
+            if self._by_address.get(session._address_label()) is session:
+                del self._by_address[session._address_label()]
+            if session._inverter_serial_number is not None and self._by_serial.get(session._inverter_serial_number) is session:
+                del self._by_serial[session._inverter_serial_number]
+        self.closed.labels(reason).inc()
+        return
+
+    def get(self, serial):
+        return self._by_serial.get(serial)
+
+    def holds(self, serial):
+        # False if another worker's session has claimed serial since this one did
+        return self._claims is None or self._claims.holds(serial)
+
+    def sessions(self):
+        with self._lock:
+            return list(self._by_address.values())
+
+    def counts(self):
+        with self._lock:
+            return {"connected": len(self._by_address), "identified": len(self._by_serial)}
+
+
+class SerialClaims():
+    # which worker process last claimed each serial, as files in a directory they all share
+    def __init__(self, directory):
+        self._directory = directory
+        self._owner = str(os.getpid())
+        return
+
+    def _path(self, serial):
+        # serials come from the inverter, keep them to a plain file name
+        return os.path.join(self._directory, "".join(c for c in serial if c.isalnum()) or "_")
+
+    def claim(self, serial):
+        path = self._path(serial)
+        temporary = "{}.{}.tmp".format(path, self._owner)
+        try:
+            with open(temporary, "w") as f:
+                f.write(self._owner)
+            os.replace(temporary, path)
+        except OSError as e:
+            logger.warning("couldn't claim %s in %s: %s", serial, self._directory, e)
+        return
+
+    def holds(self, serial):
+        try:
+            with open(self._path(serial), "r") as f:
+                return f.read() == self._owner
+        except FileNotFoundError:
+            return True
+        except OSError as e:
+            logger.warning("couldn't check the claim on %s in %s: %s", serial, self._directory, e)
+            return True
@@ -0,0 +1,146 @@
+#!/bin/python
+# Feed a capture from --capture-dir back through the session's framing, CRC check and parsers.
+#
+# Outbound frames in the capture re-create the query they carried (with its original counter)
+# and inbound data is fed to the session exactly as it came off the socket, so the responses
+# are matched, parsed and published the same way they were live.  Publishes go to a stand-in
+# MQTT client that counts them (or prints them with --print).
+#
+#   python -m voltronic_wifi_bridge.voltronic_replay captures/96332309100452.vcap
+#   python -m voltronic_wifi_bridge.voltronic_replay --speed 1 captures/96332309100452.vcap
+import argparse
+import collections
+import json
+import logging
+import time
+from voltronic_wifi_bridge import voltronic_server
+from voltronic_wifi_bridge import voltronic_capture
+
+logger = logging.getLogger(__name__)
+
+
+class ReplayMQTT():
+    # takes the place of MQTTClient and counts what the session publishes
+    def __init__(self, show=False):
+        self._show = show
+        self.published = collections.Counter()
+        return
+
+    def publish_message(self, topicpart, message, retain=False):
+        self.published[topicpart.split("/", 1)[-1]] += 1
+        if self._show:
+            print("{} {}".format(topicpart, message))
+        return
+
+    def register_message_callback(self, callback, topicmatch):
+        return
+
+    def unregister_message_callback(self, callback, topicmatch):
+        return
+
+
+class ReplaySession(voltronic_server.VoltronicSession):
+    def __init__(self, path, mqtt_client):
+        voltronic_server.VoltronicSession.__init__(self, ("replay", path), mqtt_client=mqtt_client)
+        self.frames_out = 0
+        return
+
+    def replay_out(self, frame):
+        # put the query this frame carried back in the pending table under its original counter
+        command = frame[8:-3]
+        query = make_query(command, self)
+        query._counter = int.from_bytes(frame[0:2], "big")
+        query._message_generated_time = time.time()
+        self._queries.add(query, float("inf"))
+        self.frames_out += 1
+        return
+
+
+def make_query(command, session):
+    poll = voltronic_server.POLL_QUERIES.get(command.decode('ascii', 'replace'))
+    if poll is not None:
+        return poll(session)
+    if command == b"QPI":
+        return voltronic_server.QueryProtocolID(session)
+    if command == b"QID":
+        return voltronic_server.QuerySerial(session)
+    if command.startswith(b"QVFW"):
+        return voltronic_server.QueryFirmware(session, command[4:])
+    if command.startswith(b"P"):
+        return voltronic_server.SetQuery(command, session)
+    return voltronic_server.Query(command, session)
+
+
+def replay(path, speed=0, show=False):
+    # speed 0 replays as fast as possible, 1 at the pace it was captured, 2 at twice that, ...
+    mqtt = ReplayMQTT(show)
+    session = ReplaySession(path, mqtt)
+    records = 0
+    bytes_in = 0
+    start = time.perf_counter()
+    first_timestamp = None
+    for timestamp, direction, data in voltronic_capture.read_capture(path):
+        if speed > 0:
+            if first_timestamp is None:
+                first_timestamp = timestamp
+            delay = (timestamp - first_timestamp) / speed - (time.perf_counter() - start)
+            if delay > 0:
+                time.sleep(delay)
+        records += 1
+        if direction == voltronic_capture.OUT:
+            session.replay_out(data)
+        else:
+            bytes_in += len(data)
+            session._feed(data)
+    elapsed = time.perf_counter() - start
+    session._session_closed()
+
+    # replayed queries never time out, so whatever is left in the table went unanswered
+    responses = session.frames_out - len(session._queries)
+    return {
+        "records": records,
+        "frames_out": session.frames_out,
+        "bytes_in": bytes_in,
+        "responses_matched": responses,
+        "unanswered": len(session._queries),
+        "invalid_responses": session._invalidresponse_count,
+        "resync_events": session._frames.resync_events,
+        "bytes_discarded": session._frames.bytes_discarded,
+        "serial_number": session._inverter_serial_number,
+        "published": sum(mqtt.published.values()),
+        "seconds": round(elapsed, 4),
+        "responses_per_second": round(responses / elapsed) if elapsed > 0 else None,
+        "megabytes_per_second": round(bytes_in / elapsed / 1e6, 2) if elapsed > 0 else None,
+    }
+
+
+def dump(path):
+    # the capture as text, one record per line
+    _, first = voltronic_capture.read_capture_start(path)
+    for timestamp, direction, data in voltronic_capture.read_capture(path):
+        print("{:10.4f} {} {}".format(timestamp - first, "<-" if direction == voltronic_capture.IN else "->", data.hex()))
+    return
+
+
+def main():
+    parser = argparse.ArgumentParser(description="replay a voltronic-wifi-bridge capture")
+    parser.add_argument("captures", nargs="+", help="capture files, replayed one after the other")
+    parser.add_argument("--speed", type=float, default=0, help="0 for as fast as possible, 1 for real time, 2 for double speed etc")
+    parser.add_argument("--print", action="store_true", dest="show", help="print everything the session publishes")
+    parser.add_argument("--dump", action="store_true", help="just list the records in hex")
+    parser.add_argument("--log-level", choices=["DEBUG", "INFO", "WARNING", "ERROR"], default="WARNING")
+    args = parser.parse_args()
+    logging.basicConfig(level=getattr(logging, args.log_level), format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+
+    for path in args.captures:
+        if args.dump:
+            dump(path)
+        else:
+            result = replay(path, args.speed, args.show)
+            result["capture"] = path
+            print(json.dumps(result))
+    return
+
+
+if __name__ == "__main__":
+    main()
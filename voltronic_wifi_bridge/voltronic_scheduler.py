@@ -0,0 +1,85 @@
+#!/bin/python
+import heapq
+import random
+
+
+# seconds between polls of each telemetry command; None means once per session
+DEFAULT_POLL_INTERVALS = {
+    "QPIGS": 5,
+    "QPIGS2": 5,
+    "QMOD": 5,
+    "QPIWS": 5,
+    "QPIRI": 300,
+    "QFLAG": 300,
+}
+
+
+class PollScheduler():
+    # per inverter priority queue of (due time, command) so each command runs at its own interval
+    #  - the first poll of each command lands at a random point in the first few seconds, and every
+    #    later one is jittered, so a fleet that reconnects together doesn't poll in lockstep
+    #  - every timeout doubles the intervals (up to max_backoff times) for this inverter and a
+    #    response resets them
+    def __init__(self, intervals=None, jitter=0.1, max_backoff=8, rng=None):
+        self._intervals = dict(DEFAULT_POLL_INTERVALS)
+        if intervals is not None:
+            self._intervals.update(intervals)
+        self._jitter = jitter
+        self._max_backoff = max_backoff
+        self._rng = rng if rng is not None else random.Random()
+
+        self._heap = []
+        self._sequence = 0
+        self._started = False
+        self.backoff = 1
+        return
+
+    def _push(self, due, command, repeat=True):
+        # the sequence number keeps ties in insertion order without comparing commands
+        self._sequence += 1
+        heapq.heappush(self._heap, (due, self._sequence, command, repeat))
+        return
+
+    def start(self, now):
+        if self._started:
+            return
+        self._started = True
+        for command, interval in self._intervals.items():
+            if interval is None:
+                self._push(now, command)
+            else:
+                self._push(now + self._rng.uniform(0, min(interval, 5)), command)
+        return
+
+    def is_started(self):
+        return self._started
+
+    def next_due(self):
+        if len(self._heap) == 0:
+            return None
+        return self._heap[0][0]
+
+    def due(self, now):
+        # pop and reschedule every command that is due
+        commands = []
+        while len(self._heap) > 0 and self._heap[0][0] <= now:
+            _, _, command, repeat = heapq.heappop(self._heap)
+            commands.append(command)
+            interval = self._intervals.get(command)
+            if repeat and interval is not None:
+                interval = interval * self.backoff * self._rng.uniform(1 - self._jitter, 1 + self._jitter)
+                self._push(now + interval, command)
+        return commands
+
+    def request_now(self, command, now):
+        # an extra one off poll, on top of the regular schedule
+        self._push(now, command, repeat=False)
+        return
+
+    def record_timeout(self):
+        self.backoff = min(self.backoff * 2, self._max_backoff)
+        return
+
+    def record_success(self):
+        self.backoff = 1
+        return
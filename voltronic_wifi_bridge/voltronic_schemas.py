@@ -0,0 +1,320 @@
+#!/bin/python
+# Response layouts for the telemetry queries.
+#
+# Each command gets a table of fields (name, index, type, unit, publish) registered against the
+# protocol versions it applies to.  A table is compiled once into a parser that fills a reusable
+# Record in place, so a poll doesn't build a dict.  Supporting a new firmware layout should only
+# need a new table registered for its protocol version.
+
+OUTPUT_SOURCE_PRIORITY = {
+    "0": "utility_solar_battery", # only use battery + solar when utility not available
+    "1": "solar_utility_battery", # use solar and supplement from utility without touching battery (ish?)
+    "2": "solar_battery_utility", # use solar and battery power, only touch utility when battery is too low
+    "3": "unknown 3"
+}
+CHARGER_SOURCE_PRIORITY = {
+    "0": "utility_first", # charge from utility when exists, solar when not
+    "1": "solar_first", # charge from solar when exists, utility when not
+    "2": "solar_and_utility", # charge from solar and utility at the same time
+    "3": "only_solar", # only charge from solar
+}
+
+
+class SchemaMismatch(ValueError):
+    "Used when a response doesn't fit the layout registered for its command"
+
+
+class Field():
+    __slots__ = ("name", "index", "type", "unit", "publish")
+
+    def __init__(self, name, index, type=float, unit=None, publish=True):
+        # type is float, int, str, a dict mapping the raw code to a label, or bool for bit/flag layouts
+        self.name = name
+        self.index = index
+        self.type = type
+        self.unit = unit
+        self.publish = publish
+        return
+
+
+class Record():
+    # the values of one parsed response, stored in field order; bit layouts also keep the raw bits
+    # as an integer
+    __slots__ = ("schema", "values", "bits")
+
+    def __init__(self, schema):
+        self.schema = schema
+        self.values = [None] * len(schema.fields)
+        self.bits = None
+        return
+
+    def __getitem__(self, name):
+        return self.values[self.schema.positions[name]]
+
+    def get(self, name, default=None):
+        position = self.schema.positions.get(name)
+        if position is None:
+            return default
+        return self.values[position]
+
+    def items(self):
+        return zip(self.schema.names, self.values)
+
+    def published_items(self):
+        names = self.schema.names
+        values = self.values
+        return [(names[position], values[position]) for position in self.schema.published]
+
+
+class Schema():
+    # common parts of a compiled table; subclasses provide _compile() and parse_into()
+    def __init__(self, command, fields, min_length=2):
+        self.command = command
+        self.fields = tuple(fields)
+        self.names = tuple(field.name for field in self.fields)
+        self.positions = {field.name: position for position, field in enumerate(self.fields)}
+        self.published = tuple(position for position, field in enumerate(self.fields) if field.publish)
+        self.min_length = min_length
+        self._fill = self._compile()
+        return
+
+    def new_record(self):
+        return Record(self)
+
+    def _check(self, msg):
+        if len(msg) < self.min_length or msg[0] != 0x28:
+            raise SchemaMismatch("Response to {} doesn't match its layout: {}".format(self.command, msg))
+        return
+
+    def parse(self, msg):
+        record = self.new_record()
+        self.parse_into(msg, record)
+        return record
+
+
+class SpaceSeparatedSchema(Schema):
+    # "(a b c ..." where field.index is the position in the space separated list
+    def _compile(self):
+        namespace = {}
+        lines = ["def fill(parts, values):"]
+        for position, field in enumerate(self.fields):
+            if field.type is str:
+                expression = "parts[{}]".format(field.index)
+            elif isinstance(field.type, dict):
+                namespace["map{}".format(position)] = field.type
+                expression = "map{0}.get(parts[{1}], 'unknown ' + parts[{1}])".format(position, field.index)
+            else:
+                namespace["type{}".format(position)] = field.type
+                expression = "type{}(parts[{}])".format(position, field.index)
+            lines.append("    values[{}] = {}".format(position, expression))
+        lines.append("    return")
+        exec("\n".join(lines), namespace)
+        self._part_count = max(field.index for field in self.fields) + 1
+        return namespace["fill"]
+
+    def parse_into(self, msg, record):
+        self._check(msg)
+        parts = msg[1:].decode('ascii').split(" ")
+        if len(parts) < self._part_count:
+            raise SchemaMismatch("Response to {} has {} values, expected {}: {}".format(self.command, len(parts), self._part_count, msg))
+        try:
+            self._fill(parts, record.values)
+        except ValueError as e:
+            raise SchemaMismatch("Response to {} has a bad value ({}): {}".format(self.command, e, msg))
+        return record
+
+
+class BitSchema(Schema):
+    # "(0100..." where field.index is the position of the '0'/'1' in the raw response (the '(' is 0).
+    # The response is read as one integer with the character at index i as bit i - 1, and the
+    # fields are only filled in again when that integer changes
+    def _compile(self):
+        self.masks = tuple(1 << (field.index - 1) for field in self.fields)
+        namespace = {}
+        lines = ["def fill(bits, values):"]
+        for position, mask in enumerate(self.masks):
+            lines.append("    values[{}] = bits & {} != 0".format(position, mask))
+        lines.append("    return")
+        exec("\n".join(lines), namespace)
+        self.min_length = max(self.min_length, max(field.index for field in self.fields) + 1)
+        return namespace["fill"]
+
+    def bits(self, msg):
+        self._check(msg)
+        try:
+            return int(msg[:0:-1], 2)
+        except ValueError:
+            raise SchemaMismatch("Response to {} isn't all 0s and 1s: {}".format(self.command, msg))
+
+    def parse_into(self, msg, record):
+        bits = self.bits(msg)
+        if bits != record.bits:
+            self._fill(bits, record.values)
+            record.bits = bits
+        return record
+
+
+class FlagSchema(Schema):
+    # "(E<enabled letters>D<disabled letters>" where field.index is the letter; absent letters are None
+    def _compile(self):
+        codes = tuple(field.index for field in self.fields)
+
+        def fill(text, values):
+            enabled, _, disabled = text.partition("E")[2].partition("D")
+            for position, code in enumerate(codes):
+                if code in enabled:
+                    values[position] = True
+                elif code in disabled:
+                    values[position] = False
+                else:
+                    values[position] = None
+            return
+        return fill
+
+    def parse_into(self, msg, record):
+        self._check(msg)
+        self._fill(msg[1:].decode('ascii'), record.values)
+        return record
+
+
+_registry = {}
+
+
+def register_schema(schema, protocol_versions=None):
+    # protocol_versions of None makes this the fallback layout for the command
+    if protocol_versions is None:
+        protocol_versions = [None]
+    for protocol_version in protocol_versions:
+        _registry[(schema.command, protocol_version)] = schema
+    return schema
+
+
+def get_schema(command, protocol_version=None):
+    schema = _registry.get((command, protocol_version))
+    if schema is None:
+        schema = _registry.get((command, None))
+    if schema is None:
+        raise KeyError("No response layout registered for {}".format(command))
+    return schema
+
+
+# layouts observed on a 6500EX-48 (PI30); these are also the fallback for unknown protocol versions
+
+register_schema(SpaceSeparatedSchema(b"QPIGS", [
+    # 0     1    2     3    4    5    6   7   8     9   10  11   12   13    14    15    16       17 18 19    20
+    # 120.4 59.9 120.4 59.9 1575 1481 024 232 53.70 000 100 0041 00.0 000.0 00.00 00000 00010000 00 00 00000 010
+    # 118.9 60.0 118.9 60.0 1545 1424 023 232 53.60 000 099 0040 00.0 000.0 00.00 00000 00010000 00 00 00000 010
+    Field("grid_voltage", 0, unit="V"),
+    Field("grid_frequency", 1, unit="Hz"),
+    Field("output_voltage", 2, unit="V"),
+    Field("output_frequency", 3, unit="Hz"),
+    Field("output_va", 4, unit="VA"),
+    Field("output_w", 5, unit="W"),
+    Field("output_load_percent", 6, unit="%"),
+    Field("bus_voltage", 7, unit="V"),
+    Field("battery_voltage", 8, unit="V"),
+    Field("battery_charging_current", 9, unit="A"),
+    Field("battery_SOC", 10, unit="%"),
+    Field("inverter_heatsink_temp", 11, unit="°C"),
+    Field("pv1_input_current", 12, unit="A"),
+    Field("pv1_input_voltage", 13, unit="V"),
+    Field("battery_voltage_scc_1", 14, str, unit="V"),
+    Field("battery_discharging_current", 15, unit="A"),
+    # process bitmat to get grid failure etc
+    Field("qpigs_device_status_bitmap", 16, str),
+    Field("17", 17, str, publish=False),
+    Field("18", 18, str, publish=False),
+    Field("pv1_input_power", 19, unit="W"),
+    Field("qpigs_device_status_bitmap_2", 20, str),
+], min_length=70))
+
+register_schema(SpaceSeparatedSchema(b"QPIGS2", [
+    Field("pv2_input_current", 0, unit="A"),
+    Field("pv2_input_voltage", 1, unit="V"),
+    Field("pv2_input_power", 2, unit="W"),
+], min_length=15))
+
+register_schema(SpaceSeparatedSchema(b"QPIRI", [
+    # 0     1    2     3    4    5    6    7    8    9    10   11   12 13  14  15 16 17 18 19 20 21 22   23 24 25  26 27
+    # 120.0 54.1 120.0 60.0 54.1 6500 6500 48.0 51.0 44.0 56.0 56.0 3  020 020 1  1  2  9  01 0  7  53.0 0  1  480 0  000
+    Field("grid_rating_voltage", 0, str, unit="V", publish=False),
+    Field("grid_rating_current_maybe", 1, str, unit="A", publish=False),
+    Field("output_rating_voltage", 2, str, unit="V", publish=False),
+    Field("output_rating_frequency", 3, str, unit="Hz", publish=False),
+    Field("output_rating_current_maybe", 4, str, unit="A", publish=False),
+    Field("output_rating_va", 5, str, unit="VA", publish=False),
+    Field("output_rating_w", 6, str, unit="W", publish=False),
+    Field("battery_rating_voltage", 7, str, unit="V", publish=False),
+    Field("battery_recharge_voltage", 8, unit="V"),  # this might be the switch to grid voltage
+    Field("battery_under_voltage", 9, unit="V", publish=False),
+    Field("battery_bulk_voltage", 10, unit="V", publish=False),
+    Field("battery_float_voltage", 11, unit="V", publish=False),
+    Field("battery_type", 12, str, publish=False),  # from docs: 0: AGM 1: Flooded 2: User
+    Field("max_ac_charging_current", 13, unit="A"),
+    Field("current_max_charging_current", 14, unit="A"),
+    Field("input_voltage_range", 15, str, publish=False),  # from docs: 0: appliance 1: UPS
+    Field("output_source_priority", 16, OUTPUT_SOURCE_PRIORITY),
+    Field("charger_source_priority", 17, CHARGER_SOURCE_PRIORITY),
+    Field("parrallel_max_num", 18, str, publish=False),
+    Field("machine_type", 19, str, publish=False),  # from docs: 00: grid_tie 01: off_grid 10: hybrid
+    Field("topology", 20, str, publish=False),  # from docs: 0: transformerless 1: transformer
+    # from docs: 00: single 01: parallel 02: Phase 1 of 3 03: Phase 2 of 3 04: Phase 3 of 3  5 would be phase 1 of 2 7 would be phase 2 of 2 180*
+    Field("output_mode", 21, str),
+    Field("battery_redischarge_voltage", 22, str, unit="V", publish=False),
+    Field("pv_ok_condition_for_parallel", 23, str, publish=False),  # 0: pv is ok if any inverter has solar  1: all inverters must have PV for solar
+    Field("pv_power_balance", 24, str, publish=False),  # 0: pv max input is charge current  1: pv input is the max charge power + current load
+    Field("25", 25, str, publish=False),  # 480   # not in docs
+    Field("26", 26, str, publish=False),  # 0   # not in docs
+    Field("27", 27, str, publish=False),  # 000   # not in docs
+], min_length=70))
+
+register_schema(BitSchema(b"QPIWS", [
+    #    0    5    10   16   20
+    # b'(100000000000000001000000000000000000'
+    # index is the bit number from the docs
+    Field("inverter_fault", 2, bool),
+    Field("bus_over", 3, bool),
+    Field("bus_under", 4, bool),
+    Field("bus_soft_fail", 5, bool),
+    Field("line_fail", 6, bool),
+    Field("opv_short", 7, bool),
+    Field("inverter_voltage_low", 8, bool),
+    Field("inverter_voltage_high", 9, bool),
+    Field("over_temperature", 10, bool),
+    Field("fan_locked", 11, bool),
+    Field("battery_voltage_high", 12, bool),
+    Field("battery_low_alarm", 13, bool),
+    Field("battery_under_shutdown", 15, bool),
+    Field("over_load", 17, bool),
+    Field("eeprom_fault", 18, bool),
+    Field("inverter_over_current", 19, bool),
+    Field("inverter_soft_fail", 20, bool),
+    Field("self_test_fail", 21, bool),
+    Field("op_dc_voltage_over", 22, bool),
+    Field("bat_open", 23, bool),
+    Field("current_sensor_fail", 24, bool),
+    Field("battery_short", 25, bool),
+    Field("power_limit", 26, bool),
+    Field("pv_voltage_high_1", 27, bool),
+    Field("mptt_overload_fault_1", 28, bool),
+    Field("mppt_overload_warning_1", 29, bool),
+    Field("batter_too_low_to_charge_1", 30, bool),
+    Field("pv_voltage_high_2", 31, bool),
+    Field("mptt_overload_fault_2", 32, bool),
+    Field("mppt_overload_warning_2", 33, bool),
+    Field("batter_too_low_to_charge_2", 34, bool),
+], min_length=5))
+
+register_schema(FlagSchema(b"QFLAG", [
+    # b'(EkxyzDabjuv'
+    # I believe the letters after E are enabled and the letters after D are disabled
+    Field("buzzer_enabled", 'a', bool),
+    Field("overload_bypass_enabled", 'b', bool),
+    Field("power_saving_enabled", 'j', bool),
+    Field("lcd_menu_timeout_enabled", 'k', bool),
+    Field("overload_restart_enabled", 'u', bool),
+    Field("overtemp_restart_enabled", 'v', bool),
+    Field("backlight_enabled", 'x', bool),
+    Field("alarm_on_primary_source_interrupt_enabled", 'y', bool),
+    Field("fault_code_record_enabled", 'z', bool),
+], min_length=5))
@@ -1,31 +1,47 @@
 #!/bin/python
 import socket
+import selectors
 import sys
-import traceback
+import logging
 import threading
 import time
 import random
-import pprint
 import json
 from voltronic_wifi_bridge import voltronic_tools
+from voltronic_wifi_bridge import voltronic_schemas
+from voltronic_wifi_bridge import voltronic_publisher
+from voltronic_wifi_bridge import voltronic_scheduler
+from voltronic_wifi_bridge import voltronic_pipeline
+from voltronic_wifi_bridge import voltronic_metrics
+from voltronic_wifi_bridge import voltronic_capture
+from voltronic_wifi_bridge import voltronic_proxy
+from voltronic_wifi_bridge import voltronic_commands
+from voltronic_wifi_bridge import voltronic_registry
+from voltronic_wifi_bridge import voltronic_events
+
+logger = logging.getLogger(__name__)
 
 class InvalidResponseException(Exception):
     "Used to indicate when a response doesn't seem to parse right"
 
+
+class SessionListener():
+    # registered on a server to see every parsed record from every inverter session.
+    # records are reused for the next poll, so copy anything that needs to outlive the call
+    def handle_connect(self, serial):
+        # the inverter on a session has told us its serial number
+        return
+
+    def handle_record(self, serial, record, timestamp):
+        return
+
+    def handle_disconnect(self, serial):
+        return
+
 class Query():
     
-    _output_source_priority_map = {
-        "0": "utility_solar_battery", # only use battery + solar when utility not available
-        "1": "solar_utility_battery", # use solar and supplement from utility without touching battery (ish?)
-        "2": "solar_battery_utility", # use solar and battery power, only touch utility when battery is too low
-        "3": "unknown 3"
-    }
-    _charger_source_priority_map = {
-        "0": "utility_first", # charge from utility when exists, solar when not
-        "1": "solar_first", # charge from solar when exists, utility when not
-        "2": "solar_and_utility", # charge from solar and utility at the same time
-        "3": "only_solar", # only charge from solar
-    }
+    _output_source_priority_map = voltronic_schemas.OUTPUT_SOURCE_PRIORITY
+    _charger_source_priority_map = voltronic_schemas.CHARGER_SOURCE_PRIORITY
     _message_preamble_bytes = b'\xFF\x04'
 
     def __init__(self, message, connection):
@@ -33,40 +49,54 @@ class Query():
         self._connection = connection
         self._counter = self._connection._query_counter
         self._connection._query_counter += 1
-        self._connection._queries[self.get_key()] = self
         self._created_time = time.time()
         self._message_generated_time = None
 
         return
 
-    def should_give_up(self):
-        # we should give up on this if it's been 10 seconds since the message generation was last called (probably when sent to network)
-        return self._message_generated_time is not None and time.time() - self._message_generated_time > 10
-
     def get_packaged_message(self):
         # this takes a byte string message and packages it to be ready to go out the socket
-        msg = self._msg
-        packaged_msg = b''
-        crc = voltronic_tools.cal_crc_half(msg)
-        counter = self._counter & 0xFFFF
-        packaged_msg = counter.to_bytes(2)
-        packaged_msg += b'\x00\x01'
-        packaged_msg += (len(msg)+5).to_bytes(2)
-        packaged_msg += self._message_preamble_bytes
-        packaged_msg += msg
-        packaged_msg += crc
-        packaged_msg += b"\x0d"
+        packaged_msg = voltronic_tools.package_frame(self._counter, self._message_preamble_bytes, self._msg)
 
         self._message_generated_time = time.time()
         return packaged_msg
     
     def _check_nak(self, msg):
-        return msg == b'(NAK'
+        if msg == b'(NAK':
+            self._connection._metrics.nak.inc()
+            return True
+        return False
 
     def process_response(self, msg):
-        print("Got a response for message {} ({}) it was: {}".format(self.get_key(),self._msg, msg))
+        logger.debug("Got a response for message %s (%s) it was: %s", self.get_key(),self._msg, msg)
+        return
+
+    def process_frame(self, frame):
+        # called with the whole response frame (a view into the receive buffer); most queries only want the payload
+        self.process_response(bytes(frame[8:-3]))
+        return
+
+    def handle_timeout(self):
         return
     
+    def _parse_schema_response(self, msg):
+        # parse into this connection's reusable record using the layout registered for its protocol version
+        schema = voltronic_schemas.get_schema(self._msg, self._connection._protocol_version)
+        record = self._connection._records.get(schema)
+        if record is None:
+            record = schema.new_record()
+            self._connection._records[schema] = record
+        try:
+            schema.parse_into(msg, record)
+        except voltronic_schemas.SchemaMismatch as e:
+            raise InvalidResponseException(str(e))
+        self._connection._notify_record(record)
+        return record
+
+    def _publish_mqtt_from_record(self, record):
+        self._connection.publish_fields(record.schema.command.decode('ascii'), record.published_items())
+        return
+
     def _publish_mqtt_from_dict(self, dictionary, keylist=None):
         if keylist is None:
             keylist = dictionary.keys()
@@ -78,35 +108,74 @@ class Query():
         # this key is used for the dictionary of sent queries
         return (self._counter & 0xFFFF).to_bytes(2)
 
+class ProxiedQuery(Query):
+    # a frame from the upstream server, sent on to the inverter under one of our counters.
+    # the frame is copied once out of the upstream's receive buffer since it may have to wait its turn
+    def __init__(self, frame, upstream, connection):
+        Query.__init__(self, bytes(frame[8:-3]), connection)
+        self._frame = bytearray(frame)
+        self._upstream = upstream
+        self._upstream_counter = bytes(frame[0:2])
+        self._upstream_generation = upstream.generation
+        return
+
+    def get_packaged_message(self):
+        self._frame[0:2] = self.get_key()
+        self._message_generated_time = time.time()
+        return self._frame
+
+    def process_frame(self, frame):
+        logger.debug("relaying response to upstream %s (%s)", self._upstream_counter, self._msg)
+        self._upstream.send_response(self._upstream_counter, frame, self._upstream_generation)
+        return
+
 class SetQuery(Query):
     _message_preamble_bytes = b'\x01\x04'
+    # the command topic this write came from, for the ones that go through the session's CommandQueue
+    _command = None
+    _mapping_mode = None
 
     def process_response(self, msg):
-        print("Got a response for message {} ({}) it was: {}".format(self.get_key(),self._msg, msg))
+        logger.debug("Got a response for message %s (%s) it was: %s", self.get_key(),self._msg, msg)
+        accepted = True
         if self._check_nak(msg):
-            print("Got a NAK, setting {} failed".format(self._msg))
+            logger.warning("Got a NAK, setting %s failed", self._msg)
+            accepted = False
+        if self._command is not None:
+            self._connection._commands.write_finished(self._command, self._mapping_mode, accepted)
+            if accepted:
+                # confirm it took rather than waiting for the next scheduled QPIRI
+                self._connection._scheduler.request_now("QPIRI", time.time())
+        return
+
+    def handle_timeout(self):
+        if self._command is not None:
+            self._connection._commands.write_finished(self._command, self._mapping_mode, False)
         return
 
+    @staticmethod
+    def _code_for(mapping, mapping_mode):
+        for key, value in mapping.items():
+            if mapping_mode == value:
+                return int(key)
+        raise ValueError("unknown setting {}, expected one of {}".format(mapping_mode, ", ".join(mapping.values())))
+
 class SetChargePriority(SetQuery):
+    _command = "set_charge_priority"
+
     def __init__(self, mapping_mode, connection):
-        code = None
-        for key, value in self._charger_source_priority_map.items():
-            if mapping_mode == value:
-                code = key
-                break
-        msg = b'PCP%02i' % (int(code))
+        self._mapping_mode = mapping_mode
+        msg = b'PCP%02i' % self._code_for(self._charger_source_priority_map, mapping_mode)
 
         Query.__init__(self, msg, connection)
         return
 
 class SetOutputPriority(SetQuery):
+    _command = "set_output_priority"
+
     def __init__(self, mapping_mode, connection):
-        code = None
-        for key, value in self._output_source_priority_map.items():
-            if mapping_mode == value:
-                code = key
-                break
-        msg = b'POP%02i' % (int(code))
+        self._mapping_mode = mapping_mode
+        msg = b'POP%02i' % self._code_for(self._output_source_priority_map, mapping_mode)
 
         Query.__init__(self, msg, connection)
         return
@@ -117,12 +186,12 @@ class QueryProtocolID(Query):
         return
     
     def process_response(self, msg):
-        print("Got a response for QPI message {} it was: {}".format(self.get_key(), msg))
+        logger.debug("Got a response for QPI message %s it was: %s", self.get_key(), msg)
         if self._check_nak(msg):
-            print("Got a NAK, skipping processing of {}".format(self._msg))
+            logger.info("Got a NAK, skipping processing of %s", self._msg)
         elif len(msg) == 5 and msg[0:3] == b'(PI':
             self._connection._protocol_version = int(msg[3:5].decode('ascii'))
-            print("Protocol version is: {}".format(self._connection._protocol_version))
+            logger.info("Protocol version is: %s", self._connection._protocol_version)
         else:
             raise InvalidResponseException("Invalid response to QPI query received: {}".format(msg))
         return
@@ -133,16 +202,34 @@ class QuerySerial(Query):
         return
     
     def process_response(self, msg):
-        print("Got a response for QID message {} it was: {}".format(self.get_key(), msg))
+        logger.debug("Got a response for QID message %s it was: %s", self.get_key(), msg)
         if self._check_nak(msg):
-            print("Got a NAK, skipping processing of {}".format(self._msg))
+            logger.info("Got a NAK, skipping processing of %s", self._msg)
         elif  len(msg) >= 2 and msg[0].to_bytes(1) == b'(':
             self._connection.register_serial_number(msg[1:].decode('ascii'))
-            print("Serial is: {}".format(self._connection._inverter_serial_number))
+            logger.info("Serial is: %s", self._connection._inverter_serial_number)
+        else:
+            raise InvalidResponseException("Invalid response to QID query received: {}".format(msg))
+        return
+
+class QueryCachedSerial(QuerySerial):
+    # the one QID that checks an identity taken from the identity cache
+    def process_response(self, msg):
+        logger.debug("Got a response for QID message %s it was: %s", self.get_key(), msg)
+        if self._check_nak(msg):
+            logger.info("Got a NAK checking the cached identity, asking again later")
+            self._connection._identity_check_failed()
+        elif len(msg) >= 2 and msg[0:1] == b'(':
+            self._connection._identity_checked(msg[1:].decode('ascii'))
         else:
+            self._connection._identity_check_failed()
             raise InvalidResponseException("Invalid response to QID query received: {}".format(msg))
         return
 
+    def handle_timeout(self):
+        self._connection._identity_check_failed()
+        return
+
 class QueryFirmware(Query):
     def __init__(self, connection, fwnumber=b''):
         self._fwnumber = fwnumber
@@ -150,16 +237,18 @@ class QueryFirmware(Query):
         return
     
     def process_response(self, msg):
-        print("Got a response for QFW message {} it was: {}".format(self.get_key(), msg))
+        logger.debug("Got a response for QFW message %s it was: %s", self.get_key(), msg)
         if self._check_nak(msg):
-            print("Got a NAK, skipping processing of {}".format(self._msg))
+            logger.info("Got a NAK, skipping processing of %s", self._msg)
         elif msg.startswith(b'(VERFW' + self._fwnumber + b':'):
             self._connection._firmware_versions[self._fwnumber] = msg.split(b':')[1].decode('ascii')
-            print("firmware {} is: {}".format(self._fwnumber, self._connection._firmware_versions[self._fwnumber]))
+            self._connection._identity_stored = False
+            logger.info("firmware %s is: %s", self._fwnumber, self._connection._firmware_versions[self._fwnumber])
             self._connection.publish_message("firmware_version" + self._fwnumber.decode('ascii'), self._connection._firmware_versions[self._fwnumber])
         elif msg.startswith(b'(VERFW:'):
             self._connection._firmware_versions[self._fwnumber] = msg.split(b':')[1].decode('ascii')
-            print("firmware {} is: {} WARNING: the response was a bare VERFW:".format(self._fwnumber, self._connection._firmware_versions[self._fwnumber]))
+            self._connection._identity_stored = False
+            logger.warning("firmware %s is: %s WARNING: the response was a bare VERFW:", self._fwnumber, self._connection._firmware_versions[self._fwnumber])
             self._connection.publish_message("firmware_version" + self._fwnumber.decode('ascii'), self._connection._firmware_versions[self._fwnumber])
         else:
             raise InvalidResponseException("Invalid response to {} query received: {}".format(self._msg, msg))
@@ -173,48 +262,9 @@ class QueryPIRI(Query):
 
     def process_response(self, msg):
         Query.process_response(self, msg)
-        # TODO: update this to make it easier to add different device versions
-        if len(msg) >= 70 and msg[0].to_bytes(1) == b'(':
-            values_array = msg[1:].decode('ascii').split(" ")
-            # 0     1    2     3    4    5    6    7    8    9    10   11   12 13  14  15 16 17 18 19 20 21 22   23 24 25  26 27
-            # 120.0 54.1 120.0 60.0 54.1 6500 6500 48.0 51.0 44.0 56.0 56.0 3  020 020 1  1  2  9  01 0  7  53.0 0  1  480 0  000'
-            # 120.0 54.1 120.0 60.0 54.1 6500 6500 48.0 51.0 44.0 56.0 56.0 3  020 020 1  1  2  9  01 0  7  53.0 0  1  480 0  000
-            values = {
-                "grid_rating_voltage": values_array[0],  # 120.0 
-                "grid_rating_current_maybe": values_array[1],  # 54.1
-                "output_rating_voltage": values_array[2],  # 120.0
-                "output_rating_frequency": values_array[3],  # 60.0
-                "output_rating_current_maybe": values_array[4],  # 54.1
-                "output_rating_va": values_array[5],  # 6500
-                "output_rating_w": values_array[6],  # 6500
-                "battery_rating_voltage": values_array[7],  # 48.0
-                "battery_recharge_voltage": float(values_array[8]),  # 51.0  # this might be the switch to grid voltage
-                "battery_under_voltage": float(values_array[9]),  # 44.0
-                "battery_bulk_voltage": float(values_array[10]),  # 56.0
-                "battery_float_voltage": float(values_array[11]),  # 56.0
-                "battery_type": values_array[12],  # 3  # from docs: 0: AGM 1: Flooded 2: User
-                "max_ac_charging_current": float(values_array[13]),  # 020
-                "current_max_charging_current": float(values_array[14]),  # 020
-                "input_voltage_range": values_array[15],  # 1  # from docs: 0: appliance 1: UPS
-                "output_source_priority": self._output_source_priority_map[values_array[16]], # from docs: 0: utility first 1: solar first 2: sbu first should check this on my unit  
-                "charger_source_priority": self._charger_source_priority_map[values_array[17]], # from docs: 0: utility first 1: solar first 2: solar + utility 3: only solar charging first should check this on my unit  
-                "parrallel_max_num": values_array[18], # from docs: 0: utility first 1: solar first 2: solar + utility 3: only solar charging first should check this on my unit  
-                "machine_type": values_array[19], # from docs: 00: grid_tie 01: off_grid 10: hybrid  
-                "topology": values_array[20], # from docs: 0: transformerless 1: transformer
-                "output_mode": values_array[21], # from docs: 00: single 01: parallel 02: Phase 1 of 3 03: Phase 2 of 3 04: Phase 3 of 3  5 would be phase 1 of 2 7 would be phase 2 of 2 180* 
-                "battery_redischarge_voltage": values_array[22],  # 53.0
-                "pv_ok_condition_for_parallel": values_array[23],  # 0: pv is ok if any inverter has solar  1: all inverters must have PV for solar
-                "pv_power_balance": values_array[24],  # 0: pv max input is charge current  1: pv input is the max charge power + current load
-                "25": values_array[25],  # 480   # not in docs
-                "26": values_array[26],  # 0   # not in docs
-                "27": values_array[27],  # 000   # not in docs
-            }
-            pprint.pprint(values)
-            keys_to_send =  ["battery_recharge_voltage", "max_ac_charging_current", "current_max_charging_current", "output_source_priority", "charger_source_priority", "output_mode"]
-            # keys_to_send.extend ([ "25", "26", "27"])
-            self._publish_mqtt_from_dict(values, keys_to_send)
-        else:
-            raise InvalidResponseException("Invalid response to QMOD query received: {}".format(msg))
+        record = self._parse_schema_response(msg)
+        self._connection._commands.observe(record)
+        self._publish_mqtt_from_record(record)
         return
 
 class QueryFlags(Query):
@@ -226,29 +276,10 @@ class QueryFlags(Query):
 
     def process_response(self, msg):
         Query.process_response(self, msg)
-
-        mapping = {
-            'a' : "buzzer_enabled",
-            'b' : "overload_bypass_enabled",
-            'j' : "power_saving_enabled",
-            'k' : "lcd_menu_timeout_enabled",
-            'u' : "overload_restart_enabled",
-            'v' : "overtemp_restart_enabled",
-            'x' : "backlight_enabled",
-            'y' : "alarm_on_primary_source_interrupt_enabled",
-            'z' : "fault_code_record_enabled",
-        }
-        mqtt_outputs = {}
-        if len(msg) >= 5 and msg[0].to_bytes(1) == b'(':
-            enabled = msg[1:].decode('ascii').split("E", 1)[1].split("D", 1)[0]
-            disabled = msg[1:].decode('ascii').split("E", 1)[1].split("D", 1)[1]
-            for code, topic in mapping.items():
-                if code in enabled:
-                    mqtt_outputs[topic] = True
-                elif code in disabled:
-                    mqtt_outputs[topic] = False
-            # self._publish_mqtt_from_dict(mqtt_outputs)
-            self._connection.publish_message("flags", json.dumps(mqtt_outputs))
+        record = self._parse_schema_response(msg)
+        mqtt_outputs = {key: value for key, value in record.items() if value is not None}
+        self._connection.publish_message("flags", json.dumps(mqtt_outputs))
+        return
 
 class QueryPIGS(Query):
     def __init__(self, connection):
@@ -257,47 +288,11 @@ class QueryPIGS(Query):
 
     def process_response(self, msg):
         Query.process_response(self, msg)
-        # TODO: update this to make it easier to add different device versions
-        if len(msg) >= 70 and msg[0].to_bytes(1) == b'(':
-            values_array = msg[1:].decode('ascii').split(" ")
-            # 0     1    2     3    4    5    6   7   8     9   10  11   12   13    14    15    16       17 18 19    20
-            # 120.4 59.9 120.4 59.9 1575 1481 024 232 53.70 000 100 0041 00.0 000.0 00.00 00000 00010000 00 00 00000 010
-            # 118.9 60.0 118.9 60.0 1545 1424 023 232 53.60 000 099 0040 00.0 000.0 00.00 00000 00010000 00 00 00000 010
-            values = {
-                "grid_voltage": float(values_array[0]),  
-                "grid_frequency": float(values_array[1]),
-                "output_voltage": float(values_array[2]),
-                "output_frequency": float(values_array[3]),
-                "output_va": float(values_array[4]),
-                "output_w": float(values_array[5]),
-                "output_load_percent": float(values_array[6]),
-                "bus_voltage": float(values_array[7]),
-                "battery_voltage": float(values_array[8]),
-                "battery_charging_current": float(values_array[9]),
-                "battery_SOC": float(values_array[10]),
-                "inverter_heatsink_temp": float(values_array[11]),
-                "pv1_input_current": float(values_array[12]),
-                "pv1_input_voltage": float(values_array[13]),
-                "battery_voltage_scc_1": values_array[14],
-                "battery_discharging_current": float(values_array[15]),
-                # process bitmat to get grid failure etc
-                "qpigs_device_status_bitmap": values_array[16],
-                "17": values_array[17],
-                "18": values_array[18],
-                "pv1_input_power": float(values_array[19]),
-                "qpigs_device_status_bitmap_2": values_array[20],
-            }
-            pprint.pprint(values)
-            keys_to_send =  ["grid_voltage", "grid_frequency", "output_voltage", "output_frequency", "output_va", 
-                             "output_w", "output_load_percent", "bus_voltage", "battery_voltage", "battery_charging_current", 
-                             "battery_SOC", "inverter_heatsink_temp", "pv1_input_current", "pv1_input_voltage", 
-                             "battery_voltage_scc_1", "battery_discharging_current", "qpigs_device_status_bitmap", "pv1_input_power", 
-                             "qpigs_device_status_bitmap_2" ]
-            # keys_to_send.extend ([  "17", "18",])
-            self._publish_mqtt_from_dict(values, keys_to_send)
-            
-        else:
-            raise InvalidResponseException("Invalid response to QMOD query received: {}".format(msg))
+        record = self._parse_schema_response(msg)
+        self._publish_mqtt_from_record(record)
+        bits = voltronic_events.status_bits(record)
+        if bits is not None:
+            self._connection.publish_bitfield(voltronic_events.STATUS, bits, lambda: voltronic_events.STATUS.state(bits))
         return
 
 class QueryPIGS2(Query):
@@ -307,20 +302,8 @@ class QueryPIGS2(Query):
 
     def process_response(self, msg):
         Query.process_response(self, msg)
-        # TODO: update this to make it easier to add different device versions
-        if len(msg) >= 15 and msg[0].to_bytes(1) == b'(':
-            values_array = msg[1:].decode('ascii').split(" ")
-            values = {
-                "pv2_input_current": float(values_array[0]),  
-                "pv2_input_voltage": float(values_array[1]),
-                "pv2_input_power": float(values_array[2])
-            }
-            pprint.pprint(values)
-            keys_to_send =  ["pv2_input_current", "pv2_input_voltage", "pv2_input_power"]
-            self._publish_mqtt_from_dict(values, keys_to_send)
-            
-        else:
-            raise InvalidResponseException("Invalid response to QMOD query received: {}".format(msg))
+        record = self._parse_schema_response(msg)
+        self._publish_mqtt_from_record(record)
         return
 
 class QueryMode(Query):
@@ -329,7 +312,7 @@ class QueryMode(Query):
         return
 
     def process_response(self, msg):
-        print("Got a response for QMOD message {} it was: {}".format(self.get_key(), msg))
+        logger.debug("Got a response for QMOD message %s it was: %s", self.get_key(), msg)
         if len(msg) == 2 and msg[0].to_bytes(1) == b'(':
             mode = msg[1].to_bytes(1).decode('ascii')
             modes = {
@@ -342,7 +325,7 @@ class QueryMode(Query):
             }
             if mode in modes.keys():
                 mode = modes[mode]
-            print("Mode is: {}".format(mode))
+            logger.debug("Mode is: %s", mode)
             self._connection.publish_message("mode", mode)
         else:
             raise InvalidResponseException("Invalid response to QMOD query received: {}".format(msg))
@@ -355,7 +338,7 @@ class QueryTesting(Query):
         return
     
     def process_response(self, msg):
-        print("Got a response for {} message {} it was: {}".format(self._query, self.get_key(), msg))
+        logger.debug("Got a response for %s message %s it was: %s", self._query, self.get_key(), msg)
         query = self._query.decode('ascii')
         
         # for space deliniated:
@@ -388,143 +371,546 @@ class QueryWarnings(Query):
 
     def process_response(self, msg):
         Query.process_response(self, msg)
+        record = self._parse_schema_response(msg)
+        bitfield = voltronic_events.schema_bitfield(record.schema, "warnings")
+        self._connection.publish_bitfield(bitfield, record.bits, lambda: dict(record.items()))
+        return
 
-        if len(msg) >= 5 and msg[0].to_bytes(1) == b'(':
-            bits = ["1" == val for val in msg[1:].decode('ascii')]
-            # offset the list to match the docs
-            bits.insert(0, None)
-            warnings = {
-                "inverter_fault" : bits[2],
-                "bus_over" : bits[3],
-                "bus_under" : bits[4],
-                "bus_soft_fail" : bits[5],
-                "line_fail" : bits[6],
-                "opv_short" : bits[7],
-                "inverter_voltage_low" : bits[8],
-                "inverter_voltage_high" : bits[9],
-                "over_temperature" : bits[10],
-                "fan_locked" : bits[11],
-                "battery_voltage_high" : bits[12],
-                "battery_low_alarm" : bits[13],
-                "battery_under_shutdown" : bits[15],
-                "over_load" : bits[17],
-                "eeprom_fault" : bits[18],
-                "inverter_over_current" : bits[19],
-                "inverter_soft_fail" : bits[20],
-                "self_test_fail" : bits[21],
-                "op_dc_voltage_over" : bits[22],
-                "bat_open" : bits[23],
-                "current_sensor_fail" : bits[24],
-                "battery_short" : bits[25],
-                "power_limit" : bits[26],
-                "pv_voltage_high_1" : bits[27],
-                "mptt_overload_fault_1" : bits[28],
-                "mppt_overload_warning_1" : bits[29],
-                "batter_too_low_to_charge_1" : bits[30],
-                "pv_voltage_high_2" : bits[31],
-                "mptt_overload_fault_2" : bits[32],
-                "mppt_overload_warning_2" : bits[33],
-                "batter_too_low_to_charge_2" : bits[34],
-            }
-            self._connection.publish_message("warnings", json.dumps(warnings))
-
-class VoltronicConnection(threading.Thread):
-    def __init__(self, connection, address, mqtt_client=None):
-        threading.Thread.__init__(self)
-
-        self._connection = connection
+# the set commands, by the command topic they're requested on
+SET_QUERIES = {
+    "set_output_priority": SetOutputPriority,
+    "set_charge_priority": SetChargePriority,
+}
+
+# the queries the poll scheduler can run, by command name
+POLL_QUERIES = {
+    "QPIRI": QueryPIRI,
+    "QFLAG": QueryFlags,
+    "QPIGS": QueryPIGS,
+    "QPIGS2": QueryPIGS2,
+    "QMOD": QueryMode,
+    "QPIWS": QueryWarnings,
+}
+
+class VoltronicSession():
+    # protocol state and query handling for one inverter, independent of how the socket is driven
+    def __init__(self, address, mqtt_client=None, publisher=None, poll_intervals=None, inflight_window=1, inflight_windows=None,
+                 capture_directory=None, capture_max_bytes=16 * 1024 * 1024, capture_backups=5, listeners=None, upstream=None,
+                 upstream_reconnect_delay=10, min_write_interval=30, identity_cache=None, registry=None, idle_timeout=180):
         self._address = address
         self._exit_request = False
+        # the server's voltronic_registry.SessionRegistry, and why this session ended for its metrics
+        self._registry = registry
+        self._close_reason = "closed"
+        self._evicted = False
+        # a connection that sends nothing for idle_timeout seconds after being sent a query is closed;
+        # _waiting_since is when the first query went out since anything was last received
+        self._idle_timeout = idle_timeout
+        self._waiting_since = None
+        # the serial whose command topic this session has a callback on
+        self._subscribed_serial = None
         self._to_send = []
-        self._recv_buffer = bytearray()
+        self._frames = voltronic_tools.FrameBuffer()
         self._query_counter = random.randint(100, 90000) & 0xFFFF
         self._queries_lock = threading.Lock()
-        self._queries = {}
+        # queries that have been sent and not yet answered or timed out
+        self._queries = voltronic_pipeline.PendingQueries()
+        self._rtt = voltronic_pipeline.RTTEstimator()
+        # how many queries may be waiting for an answer at once, by protocol version once that's known
+        self._inflight_window = inflight_window
+        self._inflight_windows = dict(inflight_windows or {})
 
         self._last_sent_time = time.time()
+        self._scheduler = voltronic_scheduler.PollScheduler(poll_intervals)
+        # set commands from mqtt waiting to be written, see voltronic_commands
+        self._commands = voltronic_commands.CommandQueue(min_interval=min_write_interval)
         self._invalidresponse_count = 0
 
         self._wifi_serial_number = None
         self._inverter_serial_number = None
         self._protocol_version = None
         self._firmware_versions = {}
+        # optional voltronic_identity.IdentityCache; with a cached identity the session skips the
+        # handshake and _unconfirmed_serial holds the cached serial until a single QID has confirmed
+        # it.  Nothing is polled or published under it before then: the cache is keyed by address,
+        # and dongles behind one NAT address share an entry
+        self._identity_cache = identity_cache
+        self._identity_stored = False
+        self._unconfirmed_serial = None
+        self._identity_checking = False
+        self._identity_check_at = 0
+        # reusable parse targets, one per response layout
+        self._records = {}
+        # last value of the warning and status bitfields, see voltronic_events
+        self._edges = voltronic_events.EdgeDetector()
 
         self._mqtt_client = mqtt_client
+        if publisher is None and mqtt_client is not None:
+            publisher = voltronic_publisher.Publisher(mqtt_client)
+        self._publisher = publisher
+        # series are labelled with the address until the inverter tells us its serial number
+        self._metrics = voltronic_metrics.InverterMetrics(self._address_label(), self)
+        # SessionListeners, usually the server's list so ones registered later are seen too
+        self._listeners = listeners if listeners is not None else []
+        # optional raw capture of the session, see voltronic_capture and voltronic_replay
+        self._capture = None
+        if capture_directory is not None:
+            self._capture = voltronic_capture.CaptureWriter(capture_directory, self._address_label(), max_bytes=capture_max_bytes,
+                                                            backups=capture_backups, provisional=True)
+        # optional voltronic_proxy.UpstreamResolver for the vendor server to pass the inverter through to
+        self._upstream = None
+        if upstream is not None:
+            self._upstream = voltronic_proxy.UpstreamLink(upstream, reconnect_delay=upstream_reconnect_delay)
+        if self._identity_cache is not None:
+            self._use_cached_identity()
+        return
+
+    def _address_label(self):
+        if isinstance(self._address, tuple) and len(self._address) >= 2:
+            return "{}:{}".format(self._address[0], self._address[1])
+        return str(self._address)
+
+    def _identity_key(self):
+        # the dongle's address; its port changes on every connection
+        if isinstance(self._address, tuple) and len(self._address) >= 1:
+            return str(self._address[0])
+        return str(self._address)
+
+    def _use_cached_identity(self):
+        cached = self._identity_cache.get(self._identity_key())
+        if cached is None:
+            return
+        protocol_version, serial, firmware = cached
+        logger.info("%s was %s last time, checking with QID before polling", self._address_label(), serial)
+        self._protocol_version = protocol_version
+        self._firmware_versions = {number.encode('ascii'): version for number, version in firmware.items()}
+        self._unconfirmed_serial = serial
+        self._identity_stored = True
+        return
+
+    def _identity_checked(self, serial):
+        # the answer to the QID checking a cached identity
+        self._identity_checking = False
+        if serial == self._unconfirmed_serial:
+            logger.info("cached identity of %s confirmed", serial)
+            self._identity_cache.record_check(True)
+            self._unconfirmed_serial = None
+            self.register_serial_number(serial)
+            for number, version in self._firmware_versions.items():
+                self.publish_message("firmware_version" + number.decode('ascii'), version)
+            return
+        # a different inverter behind the same address: forget everything the cache said and start
+        # the handshake over, keeping the serial we now know
+        logger.warning("%s is %s, not %s as cached, redoing the handshake", self._address_label(), serial, self._unconfirmed_serial)
+        self._identity_cache.record_check(False)
+        self._unconfirmed_serial = None
+        self._protocol_version = None
+        self._firmware_versions = {}
+        self._identity_stored = False
+        self.register_serial_number(serial)
+        self._last_sent_time = 0
+        return
+
+    def _identity_check_failed(self):
+        # NAK, garbage or no answer; the cached identity stays in use and is checked again shortly
+        self._identity_checking = False
+        self._identity_check_at = time.time() + 5
+        return
+
+    def _store_identity(self):
+        firmware = {number.decode('ascii'): version for number, version in self._firmware_versions.items()}
+        self._identity_cache.store(self._identity_key(), self._protocol_version, self._inverter_serial_number, firmware)
+        self._identity_stored = True
         return
     
     def register_serial_number(self, serial_number):
         # set serial number and register with mqtt
-
+        if self._registry is not None:
+            self._registry.claim(self, serial_number)
+        self._release_serial()
         if self._mqtt_client is not None:
-            if self._inverter_serial_number is not None:
-                self._mqtt_client.unregister_message_callback(self.handle_mqtt_message, "{}/command".format(self._inverter_serial_number))
-            self._mqtt_client.register_message_callback(self.handle_mqtt_message, "{}/command".format(serial_number))
+            self._mqtt_client.register_message_callback(self.handle_mqtt_message, "{}/command/#".format(serial_number))
+            self._subscribed_serial = serial_number
         
         self._inverter_serial_number = serial_number
+        if self._capture is not None:
+            self._capture.rename(serial_number)
+        if self._metrics.inverter != serial_number:
+            metrics = voltronic_metrics.InverterMetrics(serial_number, self)
+            metrics.carry_over(self._metrics)
+            self._metrics = metrics
+        for listener in list(self._listeners):
+            try:
+                listener.handle_connect(serial_number)
+            except Exception:
+                logger.exception("listener %s failed handling connect of %s", listener, serial_number)
         return
-    
-    def _cleanup_old_queries(self):
-        # clean up any messages that didn't get a response
-        keys_to_remove = []
-        for key in self._queries.keys():
-            if self._queries[key].should_give_up():
-                keys_to_remove.append(key)
-        for key in keys_to_remove:
-            self._queries.pop(key)
+
+    def _release_serial(self):
+        if self._subscribed_serial is not None:
+            self._mqtt_client.unregister_message_callback(self.handle_mqtt_message, "{}/command/#".format(self._subscribed_serial))
+            self._subscribed_serial = None
+        return
+
+    def evict(self):
+        # another session has claimed this one's serial: stop taking its commands now and close
+        # without telling the listeners, the inverter is still online on the other session
+        self._evicted = True
+        self._close_reason = "replaced"
+        self._release_serial()
+        self.exit()
+        return
+
+    def _idle_expired(self):
+        if self._idle_timeout is None or self._waiting_since is None or time.time() - self._waiting_since < self._idle_timeout:
+            return False
+        logger.info("no answer from %s for %s seconds, closing", self._address, self._idle_timeout)
+        self._close_reason = "idle"
+        return True
+
+    def _session_closed(self):
+        # called once the socket is closed, whichever way the session is driven
+        if self._invalidresponse_count >= 10:
+            self._metrics.invalid_reset.inc()
+            self._close_reason = "invalid"
+        # series still labelled with the address would otherwise pile up with every reconnect
+        self._metrics.close(remove_all=self._inverter_serial_number is None)
+        if self._capture is not None:
+            self._capture.close()
+        if self._upstream is not None:
+            self._upstream.close()
+        self._release_serial()
+        # the inverter is still online if another session holds its serial (this one was evicted)
+        holder = self._registry.get(self._inverter_serial_number) if self._registry is not None else None
+        if not self._evicted and holder in (None, self):
+            self._notify_disconnect()
+        if self._registry is not None:
+            self._registry.remove(self, self._close_reason)
+        return
+
+    def _notify_disconnect(self):
+        if self._inverter_serial_number is None:
+            return
+        for listener in list(self._listeners):
+            try:
+                listener.handle_disconnect(self._inverter_serial_number)
+            except Exception:
+                logger.exception("listener %s failed handling disconnect of %s", listener, self._inverter_serial_number)
+        return
+
+    def _notify_record(self, record):
+        # a listener that breaks shouldn't take the session down with it
+        if self._inverter_serial_number is None or len(self._listeners) == 0:
+            return
+        now = time.time()
+        for listener in list(self._listeners):
+            try:
+                listener.handle_record(self._inverter_serial_number, record, now)
+            except Exception:
+                logger.exception("listener %s failed handling %s", listener, record.schema.command)
+        return
+
+    def _count_invalid_response(self):
+        self._invalidresponse_count += 1
+        self._metrics.invalid_response.inc()
         return
     
-    def publish_message(self, topicpart, message):
-        # publish a message inside the base topic area
-        if self._mqtt_client is None:
+    def _expire_queries(self):
+        # give up on queries that didn't get a response within the timeout
+        with self._queries_lock:
+            expired = self._queries.expire(time.time())
+        for query in expired:
+            logger.info("no response to %s (%s), giving up", query.get_key(), query._msg)
+            query.handle_timeout()
+        if len(expired) > 0:
+            self._metrics.timeout.inc(len(expired))
+            self._scheduler.record_timeout()
+        return
+
+    def _get_inflight_window(self):
+        return self._inflight_windows.get(self._protocol_version, self._inflight_window)
+
+    def _can_send(self):
+        # most inverters get confused by more than one command at once, so by default the window is 1
+        return len(self._to_send) > 0 and len(self._queries) < self._get_inflight_window()
+
+    def _next_message_to_send(self):
+        # take the next queued query, start its response timer and return the frame to send
+        with self._queries_lock:
+            query = self._to_send.pop(0)
+            msg = query.get_packaged_message()
+            if self._waiting_since is None:
+                self._waiting_since = query._message_generated_time
+            self._queries.add(query, query._message_generated_time + self._rtt.timeout())
+        if self._capture is not None:
+            self._capture.write(voltronic_capture.OUT, msg)
+        self._metrics.frames_out.inc()
+        self._metrics.bytes_out.inc(len(msg))
+        return msg
+
+    def _queue_upstream_frames(self):
+        # queue everything the upstream has sent ahead of our own polls, so the cloud waits at most
+        # for what's already in flight; returns how many were queued
+        frames = []
+        frame = self._upstream.next_frame()
+        while frame is not None:
+            frames.append(ProxiedQuery(frame, self._upstream, self))
+            frame = self._upstream.next_frame()
+        if len(frames) > 0:
+            with self._queries_lock:
+                position = 0
+                while position < len(self._to_send) and isinstance(self._to_send[position], ProxiedQuery):
+                    position += 1
+                self._to_send[position:position] = frames
+            logger.debug("queued %s frames from upstream", len(frames))
+        return len(frames)
+
+    def _wake(self):
+        # called whenever something is queued from outside the connection's own loop
+        return
+
+    def _check_can_publish(self):
+        if self._publisher is None:
             raise Exception("Can't publish mqtt message, this connection has no mqtt client registered")
         if self._inverter_serial_number is None:
             raise Exception("Can't publish mqtt message, this connection hasn't discovered it's serial number yet")
-        self._mqtt_client.publish_message("{}/{}".format(self._inverter_serial_number, topicpart), message)
+        return
+
+    def publish_message(self, topicpart, message, retain=False):
+        # publish a message inside the base topic area
+        self._check_can_publish()
+        self._publisher.publish_message("{}/{}".format(self._inverter_serial_number, topicpart), message, retain=retain)
+        return
+
+    def publish_bitfield(self, bitfield, bits, state):
+        # an event for each bit that moved since the last poll and, if anything did, the retained
+        # state; state() builds it only when it's needed
+        moved = self._edges.update(bitfield, bits)
+        if moved is None:
+            return
+        timestamp = round(time.time(), 3)
+        for name, active in moved:
+            logger.info("%s %s %s", self._inverter_serial_number, name, "on" if active else "off")
+            self.publish_message("events/{}".format(name), json.dumps({"event": name, "active": active, "timestamp": timestamp}))
+        self.publish_message(bitfield.state_topic, json.dumps(state()), retain=True)
+        return
+
+    def publish_fields(self, command, items):
+        # publish the (field, value) pairs from one poll, the publisher decides how they go out
+        self._check_can_publish()
+        self._publisher.publish_fields(self._inverter_serial_number, command, items)
         return
     
     def handle_mqtt_message(self, msg):
-        print("got message in voltronic, topic: {}, message: {}".format(msg.topic, msg.payload))
+        logger.debug("got message in voltronic, topic: %s, message: %s", msg.topic, msg.payload)
+        command = msg.topic.rsplit("/", 1)[-1]
+        if command not in SET_QUERIES:
+            return
+        if self._registry is not None and not self._registry.holds(self._inverter_serial_number):
+            # the inverter has reconnected to another worker, which takes the command
+            logger.info("ignoring %s for %s, another worker has its session now", command, self._inverter_serial_number)
+            return
+        payload = msg.payload.decode('ascii', 'replace').strip()
+        logger.info("Requesting %s to be: %s", command, payload)
+        # the session's loop writes it when it's due, see _queue_messages_to_send
+        with self._queries_lock:
+            queued = self._commands.submit(command, payload, time.time())
+        if queued:
+            self._wake()
+
+        return
+
+    def _feed(self, data):
+        # add freshly received bytes to the buffer and handle every complete message in it
+        if self._capture is not None:
+            self._capture.write(voltronic_capture.IN, data)
+        self._frames.feed(data)
+        self._waiting_since = None
+        self._metrics.bytes_in.inc(len(data))
+        self._recv_messages()
+        return
+
+    def _recv_messages(self):
+        # handle every complete frame sitting in the buffer; a bad frame has already been consumed
+        # so it only counts against the connection rather than blocking the frames behind it
+        frame = self._frames.next_frame()
+        while frame is not None:
+            self._metrics.frames_in.inc()
+            try:
+                self._handle_message(frame)
+            except InvalidResponseException:
+                logger.warning("Invalid response from %s", self._address, exc_info=True)
+                self._count_invalid_response()
+            frame = self._frames.next_frame()
+        return
+
+    def _handle_message(self, msg):
+        # confirm the CRC on the message and parse
+        crc = voltronic_tools.cal_crc_half(msg[8:-3])
+        if crc != msg[-3:-1]:
+            self._metrics.crc_failure.inc()
+            logger.warning("Failed CRC buffer contained: %s", bytes(msg))
+            raise InvalidResponseException("CRC of received message doesn't match")
+
+        key = bytes(msg[0:2])
+        with self._queries_lock:
+            query = self._queries.pop(key)
+        if query is None:
+            logger.info("got a message we don't have a query for (%s); ignoring", key)
+        else:
+            latency = time.time() - query._message_generated_time
+            self._rtt.update(latency)
+            self._metrics.observe_latency(query._msg.decode('ascii', 'replace'), latency)
+            self._scheduler.record_success()
+            logger.debug("Size of queries is: %s", len(self._queries))
+            query.process_frame(msg)
+
+        return
+
+    def _identity_complete(self):
+        # a cached identity counts, _queue_messages_to_send holds the polls back until it's confirmed
+        return (self._protocol_version is not None and (self._inverter_serial_number is not None or self._unconfirmed_serial is not None)
+                and len(self._firmware_versions) >= 2)
+
+    def _seconds_until_next_poll(self):
+        # how long the loop can sleep before a poll is due or an outstanding query times out
+        if not self._identity_complete() or not self._scheduler.is_started():
+            wake_at = self._last_sent_time + 5
+        else:
+            wake_at = self._scheduler.next_due()
+        deadline = self._queries.next_deadline()
+        if deadline is not None and (wake_at is None or deadline < wake_at):
+            wake_at = deadline
         with self._queries_lock:
-            payload = msg.payload.decode('ascii')
-            if msg.topic.endswith("command/set_output_priority"):
-                print("Reqesting Output Priority to be: {}".format(payload))
-                self._to_send.append(SetOutputPriority(payload, self))
-            elif msg.topic.endswith("command/set_charge_priority"):
-                print("Reqesting Charging Priority to be: {}".format(payload))
-                self._to_send.append(SetChargePriority(payload, self))
+            write_at = self._commands.next_due() if self._unconfirmed_serial is None else None
+        if write_at is not None and (wake_at is None or write_at < wake_at):
+            wake_at = write_at
+        if self._idle_timeout is not None and self._waiting_since is not None:
+            idle_at = self._waiting_since + self._idle_timeout
+            if wake_at is None or idle_at < wake_at:
+                wake_at = idle_at
+        if self._upstream is not None and not self._upstream.is_open():
+            retry_at = time.time() + self._upstream.seconds_until_retry()
+            if wake_at is None or retry_at < wake_at:
+                wake_at = retry_at
+        if wake_at is None:
+            return None
+        return max(0, wake_at - time.time())
+
+    def _queue_messages_to_send(self):
+        # walk through the identity handshake every 5 seconds, then hand over to the poll scheduler
+        now = time.time()
+        if not self._identity_complete():
+            if (now - self._last_sent_time) > 5:
+                with self._queries_lock:
+                    if self._protocol_version is None:
+                        self._to_send.append(QueryProtocolID(self))
+                    elif self._inverter_serial_number is None:
+                        self._to_send.append(QuerySerial(self))
+                    else:
+                        self._to_send.append(QueryFirmware(self))
+                        self._to_send.append(QueryFirmware(self, b'2'))
+                        self._to_send.append(QueryFirmware(self, b'3'))
+
+                    self._last_sent_time = now
+                    logger.debug("queued messages")
+            return
+
+        if self._unconfirmed_serial is not None:
+            # check the cached identity before the first polls, which start once it's confirmed
+            if not self._identity_checking and now >= self._identity_check_at:
+                with self._queries_lock:
+                    self._to_send.insert(0, QueryCachedSerial(self))
+                self._identity_checking = True
+                self._last_sent_time = now
+            return
+        if not self._identity_stored and self._identity_cache is not None:
+            self._store_identity()
+
+        if len(self._commands) > 0:
+            with self._queries_lock:
+                for command, mapping_mode in self._commands.take(now):
+                    self._to_send.append(SET_QUERIES[command](mapping_mode, self))
+
+        self._scheduler.start(now)
+        due = self._scheduler.due(now)
+        if len(due) > 0:
+            with self._queries_lock:
+                # don't stack up another copy of a poll that's still queued or waiting for its answer
+                # (the upstream's queries don't count, their answers go to the upstream)
+                outstanding = set(query._msg for query in self._to_send if not isinstance(query, ProxiedQuery))
+                outstanding.update(query._msg for query in self._queries.values() if not isinstance(query, ProxiedQuery))
+                for command in due:
+                    if command.encode('ascii') in outstanding:
+                        continue
+                    self._to_send.append(POLL_QUERIES[command](self))
+                self._last_sent_time = now
+                logger.debug("queued messages")
+
+        return
+
+    def exit(self):
+        if self._close_reason == "closed":
+            self._close_reason = "shutdown"
+        self._exit_request = True
+        self._wake()
+        return
+
+
+class VoltronicConnection(VoltronicSession, threading.Thread):
+    # one inverter session on its own thread, asleep in a selector on the inverter's socket, the
+    # upstream's (with --upstream) and a wakeup that _wake() sets whenever something is queued from
+    # another thread, so a command goes out as soon as it arrives and an idle session costs nothing
+    def __init__(self, connection, address, mqtt_client=None, publisher=None, **session_options):
+        threading.Thread.__init__(self)
+        self._wakeup = voltronic_tools.Wakeup()
+        VoltronicSession.__init__(self, address, mqtt_client=mqtt_client, publisher=publisher, **session_options)
+
+        self._connection = connection
+        self._selector = selectors.DefaultSelector()
+        if self._upstream is not None:
+            self._upstream.on_close = self._upstream_closing
+        return
 
+    def _wake(self):
+        self._wakeup.set()
         return
 
     def run(self):
-        print("New connection from address {}".format(pprint.pformat(self._address)))
-        self._connection.settimeout(0.1)
+        logger.info("New connection from address %s", self._address)
+        # reads only happen once the selector says there's data; the timeout only bounds sendall
+        self._connection.settimeout(10)
+        self._selector.register(self._connection, selectors.EVENT_READ)
+        self._selector.register(self._wakeup, selectors.EVENT_READ)
         try:
-            while not self._exit_request and self._invalidresponse_count < 10:
+            while not self._exit_request and self._invalidresponse_count < 10 and not self._idle_expired():
                 try:
+                    self._expire_queries()
                     self._queue_messages_to_send()
-                    if len(self._to_send) > 0:
-                        if (len(self._queries) - len(self._to_send)) < 1:
-                            # inverter appears to be sensitive to getting more than one or two command at once, so limit the send
-                            query = self._to_send.pop(0)
-                            msg = query.get_packaged_message()
-                            self._connection.sendall(msg)
-                            print("sent: {}".format(msg))
-                        else:
-                            self._cleanup_old_queries()
-
-                    data = self._connection.recv(2000)
-                    self._recv_buffer.extend(data)
-
-                    while self._recv_message():
-                        print("received a message")
-                except socket.timeout:
+                    while self._can_send():
+                        msg = self._next_message_to_send()
+                        self._connection.sendall(msg)
+                        logger.debug("sent: %s", msg)
+                    if self._upstream is not None:
+                        self._watch_upstream()
+
+                    for key, mask in self._selector.select(self._seconds_until_next_poll()):
+                        if key.fileobj is self._wakeup:
+                            self._wakeup.clear()
+                        elif key.fileobj is self._upstream:
+                            self._upstream_ready(mask)
+                        elif not self._receive():
+                            # an orderly shutdown from the other end; recv would keep returning nothing
+                            logger.info("Connection from address %s has closed", self._address)
+                            self._exit_request = True
+                except (socket.timeout, BlockingIOError):
                     pass
-                except BrokenPipeError:
-                    print("Connection from address {} has dropped".format(pprint.pformat(self._address)))
+                except (BrokenPipeError, ConnectionResetError):
+                    logger.info("Connection from address %s has dropped", self._address)
                     break
                 except InvalidResponseException:
-                    print(traceback.format_exc())
-                    self._invalidresponse_count += 1
+                    logger.warning("Invalid response from %s", self._address, exc_info=True)
+                    self._count_invalid_response()
                 except:
                     raise
             if self._invalidresponse_count > 10:
@@ -536,126 +922,151 @@ class VoltronicConnection(threading.Thread):
             except:
                 pass        
         finally:
-            print("closing connection for address {}".format(pprint.pformat(self._address)))
-            self._connection.close()        
+            logger.info("closing connection for address %s", self._address)
+            self._connection.close()
+            self._session_closed()
+            self._selector.close()
+            self._wakeup.close()
         return
-    
-    def _recv_message(self):
-        # return true if we popped a message successfully
-        successful_message = False
-        # check if the buffer contains the signature of a message
-        if len(self._recv_buffer) > 10:
-            if self._recv_buffer[2:4] == b'\x00\x01' and (self._recv_buffer[6:8] == b'\xff\x04' or self._recv_buffer[6:8] == b'\x01\x04'):
-                # this looks like a valid header, check length
-                expected_length = (int.from_bytes(self._recv_buffer[4:6], "big") + 6)
-                if len(self._recv_buffer) >= expected_length:
-                    self._handle_message(self._recv_buffer[0:expected_length])
-                    self._recv_buffer = self._recv_buffer[expected_length:]
-                    successful_message = True
-            else:
-                #TODO: throw away data until we match the signature of a message start
-                print("message signature not met, will probably loop forever")
-
-        return successful_message
-
-    def _handle_message(self, msg):
-        # confirm the CRC on the message and parse
-        crc = voltronic_tools.cal_crc_half(msg[8:-3])
-        if crc != msg[-3:-1]:
-            print("Failed CRC buffer contained: {}".format(msg))
-            raise InvalidResponseException("CRC of received message doesn't match")
-
-        if bytes(msg[0:2]) not in self._queries.keys():
-            print("got a message we don't have a query for ({}); ignoring".format(msg[0:2]))
-        else:
-            query = self._queries.pop(bytes(msg[0:2]))
-            print("Size of queries is: {}".format(len(self._queries)))
-            query.process_response(msg[8:-3])
 
+    def _receive(self):
+        # False once the inverter has closed its end
+        buffer = self._frames.writable()
+        received = self._connection.recv_into(buffer)
+        if received == 0:
+            return False
+        if self._capture is not None:
+            self._capture.write(voltronic_capture.IN, buffer[:received])
+        self._frames.commit(received)
+        self._waiting_since = None
+        self._metrics.bytes_in.inc(received)
+        self._recv_messages()
+        return True
+
+    def _watch_upstream(self):
+        # start connecting when it's time and keep the selector's interest in line with the link's state
+        upstream = self._upstream
+        upstream.poll()
+        if not upstream.is_open():
+            return
+        events = selectors.EVENT_READ | (selectors.EVENT_WRITE if upstream.wants_write() else 0)
+        try:
+            key = self._selector.get_key(upstream)
+        except KeyError:
+            self._selector.register(upstream, events)
+            return
+        if key.events != events:
+            self._selector.modify(upstream, events)
         return
 
-    def _queue_messages_to_send(self):
-        # check the timer and queue of ready
-        if (time.time() - self._last_sent_time) > 5:
-            with self._queries_lock:
-                if self._protocol_version is None:
-                    self._to_send.append(QueryProtocolID(self))
-                elif self._inverter_serial_number is None:
-                    self._to_send.append(QuerySerial(self))
-                elif len(self._firmware_versions) < 2:
-                    self._to_send.append(QueryFirmware(self))
-                    self._to_send.append(QueryFirmware(self, b'2'))
-                    self._to_send.append(QueryFirmware(self, b'3'))
-                else:
-                    for theclass in [QueryPIRI, QueryFlags, QueryPIGS, QueryPIGS2, QueryMode, QueryWarnings]:
-                        self._to_send.append(theclass(self))
-
-                self._last_sent_time = time.time()
-                print("queued messages")
-
+    def _upstream_ready(self, mask):
+        if mask & selectors.EVENT_WRITE:
+            self._upstream.handle_writable()
+        if mask & selectors.EVENT_READ and self._upstream.is_open():
+            self._upstream.handle_readable()
+            self._queue_upstream_frames()
         return
 
-    def exit(self):
-        self._exit_request = True
+    def _upstream_closing(self, upstream):
+        # stop watching the socket before it's closed; the loop reconnects after the retry delay
+        try:
+            self._selector.unregister(upstream)
+        except (KeyError, ValueError):
+            pass
         return
 
 
 class VoltronicServer(threading.Thread):
-    def __init__(self, portnumber):
+    def __init__(self, portnumber, reuse_port=False, claims=None, **session_options):
+        # session_options (poll_intervals, inflight_window, ...) are passed on to every VoltronicSession.
+        # reuse_port lets several worker processes listen on the same port, the kernel spreads connections between them
         threading.Thread.__init__(self)
 
         self._portnumber = portnumber
+        self._reuse_port = reuse_port
+        self._session_options = session_options
         self._exit_request = False
-        self._inverter_connections = []
+        # claims is a voltronic_registry.SerialClaims shared with the other workers, under --workers
+        self._registry = voltronic_registry.SessionRegistry(claims)
+        # set by exit() so the accept loop doesn't have to poll
+        self._wakeup = voltronic_tools.Wakeup()
 
         self._mqtt_client = None
+        self._publisher = None
+        self._listeners = []
         return
     
-    def register_mqtt(self, mqtt_client):
+    def register_mqtt(self, mqtt_client, publisher=None):
+        # publisher defaults to one message per field, as the connections always did
         self._mqtt_client = mqtt_client
+        if publisher is None:
+            publisher = voltronic_publisher.Publisher(mqtt_client)
+        self._publisher = publisher
+        return
+
+    def register_listener(self, listener):
+        self._listeners.append(listener)
         return
 
     def run(self):
         # create and start listening on the socket
         try:
             self._sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            # a restart shouldn't have to wait for the last run's connections to leave TIME_WAIT
+            self._sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            if self._reuse_port:
+                self._sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
             self._sock.bind(("0.0.0.0", self._portnumber))
-            self._sock.settimeout(1) 
+            self._sock.setblocking(False)
             self._sock.listen()
+            selector = selectors.DefaultSelector()
+            selector.register(self._sock, selectors.EVENT_READ)
+            selector.register(self._wakeup, selectors.EVENT_READ)
 
             while not self._exit_request:
                 try:
+                    if len(selector.select()) == 0 or self._exit_request:
+                        continue
                     connection, addr = self._sock.accept()
-                    inverter_connection = VoltronicConnection(connection, addr, mqtt_client=self._mqtt_client)
-                    self._inverter_connections.append(inverter_connection)
+                    connection.setblocking(True)
+                    inverter_connection = VoltronicConnection(connection, addr, mqtt_client=self._mqtt_client, publisher=self._publisher,
+                                                              listeners=self._listeners, registry=self._registry, **self._session_options)
+                    self._registry.add(inverter_connection)
                     inverter_connection.start()
-                except socket.timeout:
+                except BlockingIOError:
+                    # woken by exit(), or the connection went away before we took it
                     pass
                 except:
                     raise
 
-                print("waiting")
+                logger.debug("waiting")
             try:
                 self.shutdown_inverter_connections()
             except:
                 pass
             self._sock.shutdown(socket.SHUT_RDWR)
+            selector.close()
 
         finally:
-            print("closing socket connection")
+            logger.info("closing socket connection")
             self._sock.close()
         return
 
+    def session_counts(self):
+        return self._registry.counts()
+
     def shutdown_inverter_connections(self):
-        # TODO: add ability to remove from connection list
-        for inverter_connection in self._inverter_connections:
+        # sessions take themselves out of the registry as they close
+        inverter_connections = self._registry.sessions()
+        for inverter_connection in inverter_connections:
             inverter_connection.exit()
-        for inverter_connection in self._inverter_connections:
+        for inverter_connection in inverter_connections:
             inverter_connection.join()
         return
 
     def exit(self):
         self._exit_request = True
+        self._wakeup.set()
         return
 
 
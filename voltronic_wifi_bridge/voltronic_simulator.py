@@ -0,0 +1,245 @@
+#!/bin/python
+# A simulated inverter + wifi dongle for exercising the bridge without hardware.
+#
+# Like the real dongle it connects out to the bridge and then only answers queries.  Responses
+# are framed and CRC'd the same way as the hardware and are based on captures from a 6500EX-48.
+# Latency, jitter, NAKs, corruption and how many commands the inverter copes with at once can
+# all be dialled in, and many inverters can run from one event loop:
+#
+#   python -m voltronic_wifi_bridge.voltronic_simulator 127.0.0.1 502 --count 50 --latency 0.2
+import argparse
+import asyncio
+import logging
+import random
+import time
+from voltronic_wifi_bridge import voltronic_tools
+
+logger = logging.getLogger(__name__)
+
+# QPIGS fields in order, starting values from a real inverter; the numeric ones wander a little
+QPIGS_FIELDS = [
+    ("grid_voltage", "{:05.1f}", 120.4), ("grid_frequency", "{:04.1f}", 59.9), ("output_voltage", "{:05.1f}", 120.4),
+    ("output_frequency", "{:04.1f}", 59.9), ("output_va", "{:04.0f}", 1575), ("output_w", "{:04.0f}", 1481),
+    ("output_load_percent", "{:03.0f}", 24), ("bus_voltage", "{:03.0f}", 232), ("battery_voltage", "{:05.2f}", 53.7),
+    ("battery_charging_current", "{:03.0f}", 0), ("battery_SOC", "{:03.0f}", 100), ("inverter_heatsink_temp", "{:04.0f}", 41),
+    ("pv1_input_current", "{:04.1f}", 0), ("pv1_input_voltage", "{:05.1f}", 0), ("battery_voltage_scc_1", "{:05.2f}", 0),
+    ("battery_discharging_current", "{:05.0f}", 0), ("qpigs_device_status_bitmap", "{}", "00010000"), ("17", "{}", "00"),
+    ("18", "{}", "00"), ("pv1_input_power", "{:05.0f}", 0), ("qpigs_device_status_bitmap_2", "{}", "010"),
+]
+QPIGS_INDEX = {name: index for index, (name, _, _) in enumerate(QPIGS_FIELDS)}
+# how far each numeric field may move per poll
+QPIGS_WANDER = {"grid_voltage": 0.5, "output_w": 40, "output_va": 40, "battery_voltage": 0.05, "inverter_heatsink_temp": 1,
+                "pv1_input_current": 0.2, "pv1_input_voltage": 2, "pv1_input_power": 30}
+
+QPIRI_TEMPLATE = "(120.0 54.1 120.0 60.0 54.1 6500 6500 48.0 51.0 44.0 56.0 56.0 3 020 020 1 {output} {charger} 9 01 0 7 53.0 0 1 480 0 000"
+
+
+class SimulatedInverter():
+    # one inverter; clock and rng can be shared between many of them
+    def __init__(self, host, port, serial, latency=0.05, jitter=0.0, nak_rate=0.0, corrupt_rate=0.0, max_concurrent=1,
+                 reconnect_delay=5, sequence_field=None, on_sample=None, on_command=None, rng=None):
+        self._host = host
+        self._port = port
+        self.serial = serial
+        self._latency = latency
+        self._jitter = jitter
+        self._nak_rate = nak_rate
+        self._corrupt_rate = corrupt_rate
+        # commands arriving while this many are already being worked on are dropped, which is what
+        # the hardware appears to do when it's sent too much at once
+        self._max_concurrent = max_concurrent
+        self._reconnect_delay = reconnect_delay
+        # optionally put a running sample number in one QPIGS field so a harness can time each
+        # sample from here to mqtt; on_sample(serial, sequence) is called as each one is sent
+        self._sequence_field = QPIGS_INDEX[sequence_field] if sequence_field is not None else None
+        self._on_sample = on_sample
+        # on_command(serial, command) is called when a set command arrives
+        self._on_command = on_command
+        self._rng = rng if rng is not None else random.Random()
+
+        self.output_source_priority = "2"
+        self.charger_source_priority = "2"
+        self.mode = "L"
+        self.warnings = "100000000000000001000000000000000000"
+        self._qpigs = [default for _, _, default in QPIGS_FIELDS]
+        self._sequence = 0
+        self._in_progress = 0
+        self._stop = False
+
+        self.counters = {"connections": 0, "received": 0, "answered": 0, "dropped": 0, "naks": 0, "corrupted": 0}
+        return
+
+    async def run(self):
+        # keep a connection to the bridge open until stop() is called, reconnecting like a dongle does
+        while not self._stop:
+            try:
+                reader, writer = await asyncio.open_connection(self._host, self._port)
+            except OSError as e:
+                logger.info("inverter %s could not connect: %s", self.serial, e)
+                await asyncio.sleep(self._reconnect_delay)
+                continue
+            self.counters["connections"] += 1
+            try:
+                await self._serve(reader, writer)
+            except ConnectionError:
+                pass
+            finally:
+                writer.close()
+            if not self._stop:
+                await asyncio.sleep(self._reconnect_delay)
+        return
+
+    def stop(self):
+        self._stop = True
+        return
+
+    async def _serve(self, reader, writer):
+        frames = voltronic_tools.FrameBuffer()
+        pending = set()
+        try:
+            while not self._stop:
+                data = await reader.read(2000)
+                if not data:
+                    break
+                frames.feed(data)
+                frame = frames.next_frame()
+                while frame is not None:
+                    self.counters["received"] += 1
+                    if self._in_progress >= self._max_concurrent:
+                        self.counters["dropped"] += 1
+                    else:
+                        self._in_progress += 1
+                        task = asyncio.ensure_future(self._answer(writer, bytes(frame)))
+                        pending.add(task)
+                        task.add_done_callback(pending.discard)
+                    frame = frames.next_frame()
+        finally:
+            for task in list(pending):
+                task.cancel()
+        return
+
+    async def _answer(self, writer, frame):
+        try:
+            delay = self._latency + self._rng.uniform(-self._jitter, self._jitter)
+            if delay > 0:
+                await asyncio.sleep(delay)
+            command = frame[8:-3]
+            payload = None
+            if voltronic_tools.cal_crc_half(command) != frame[-3:-1] or self._rng.random() < self._nak_rate:
+                payload = b"(NAK"
+            else:
+                payload = self.respond(command)
+            if payload == b"(NAK":
+                self.counters["naks"] += 1
+            response = voltronic_tools.package_frame(int.from_bytes(frame[0:2], "big"), frame[6:8], payload)
+            if self._rng.random() < self._corrupt_rate:
+                # flip a bit in the payload, leaving the CRC to catch it
+                response = bytearray(response)
+                response[8 + self._rng.randrange(len(payload))] ^= 0x01
+                response = bytes(response)
+                self.counters["corrupted"] += 1
+            # noted before the write so a bridge in this process can't publish the sample first
+            if command == b"QPIGS" and self._sequence_field is not None and self._on_sample is not None:
+                self._on_sample(self.serial, self._sequence)
+            writer.write(response)
+            self.counters["answered"] += 1
+        finally:
+            self._in_progress -= 1
+        return
+
+    def respond(self, command):
+        # the payload (including the leading '(') this inverter answers command with
+        if command == b"QPI":
+            return b"(PI30"
+        if command == b"QID":
+            return b"(" + self.serial.encode('ascii')
+        if command == b"QVFW":
+            return b"(VERFW:00069.05"
+        if command.startswith(b"QVFW"):
+            return b"(VERFW" + command[4:] + b":00012.21"
+        if command == b"QPIGS":
+            return self._qpigs_response()
+        if command == b"QPIGS2":
+            return b"(00.0 000.0 00000 "
+        if command == b"QPIRI":
+            return QPIRI_TEMPLATE.format(output=self.output_source_priority, charger=self.charger_source_priority).encode('ascii')
+        if command == b"QFLAG":
+            return b"(EkxyzDabjuv"
+        if command == b"QMOD":
+            return b"(" + self.mode.encode('ascii')
+        if command == b"QPIWS":
+            return b"(" + self.warnings.encode('ascii')
+        if command.startswith(b"POP") or command.startswith(b"PCP"):
+            return self._set_priority(command)
+        return b"(NAK"
+
+    def _set_priority(self, command):
+        if self._on_command is not None:
+            self._on_command(self.serial, command)
+        code = command[3:]
+        if len(code) != 2 or not code.isdigit():
+            return b"(NAK"
+        value = str(int(code))
+        if command.startswith(b"POP") and value in ("0", "1", "2"):
+            self.output_source_priority = value
+        elif command.startswith(b"PCP") and value in ("0", "1", "2", "3"):
+            self.charger_source_priority = value
+        else:
+            return b"(NAK"
+        return b"(ACK"
+
+    def _qpigs_response(self):
+        values = self._qpigs
+        for name, step in QPIGS_WANDER.items():
+            index = QPIGS_INDEX[name]
+            values[index] = max(0, values[index] + self._rng.uniform(-step, step))
+        if self._sequence_field is not None:
+            self._sequence = (self._sequence + 1) % 100000
+            values[self._sequence_field] = self._sequence
+        return ("(" + " ".join(template.format(value) for (_, template, _), value in zip(QPIGS_FIELDS, values))).encode('ascii')
+
+
+async def run_fleet(host, port, count, first_serial=10000000000000, stagger=0.01, **options):
+    # run count inverters until cancelled; serials count up from first_serial
+    inverters = [SimulatedInverter(host, port, "{:014d}".format(first_serial + index), **options) for index in range(count)]
+    tasks = []
+    for inverter in inverters:
+        tasks.append(asyncio.ensure_future(inverter.run()))
+        await asyncio.sleep(stagger)
+    try:
+        await asyncio.gather(*tasks)
+    finally:
+        for inverter in inverters:
+            inverter.stop()
+        for task in tasks:
+            task.cancel()
+    return inverters
+
+
+def main():
+    parser = argparse.ArgumentParser(description="simulate inverters connecting to a voltronic-wifi-bridge")
+    parser.add_argument("host", help="address of the bridge")
+    parser.add_argument("port", type=int, help="port of the bridge")
+    parser.add_argument("-n", "--count", type=int, default=1, help="number of inverters")
+    parser.add_argument("--first-serial", type=int, default=10000000000000)
+    parser.add_argument("--latency", type=float, default=0.05, help="seconds before each answer")
+    parser.add_argument("--jitter", type=float, default=0.0, help="answers are up to this many seconds either side of --latency")
+    parser.add_argument("--nak-rate", type=float, default=0.0, help="fraction of queries answered with NAK")
+    parser.add_argument("--corrupt-rate", type=float, default=0.0, help="fraction of answers sent with a bad CRC")
+    parser.add_argument("--max-concurrent", type=int, default=1, help="commands handled at once, the rest are ignored")
+    parser.add_argument("--reconnect-delay", type=float, default=5)
+    parser.add_argument("--log-level", choices=["DEBUG", "INFO", "WARNING", "ERROR"], default="INFO")
+    args = parser.parse_args()
+    logging.basicConfig(level=getattr(logging, args.log_level), format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+
+    try:
+        asyncio.run(run_fleet(args.host, args.port, args.count, first_serial=args.first_serial, latency=args.latency, jitter=args.jitter,
+                              nak_rate=args.nak_rate, corrupt_rate=args.corrupt_rate, max_concurrent=args.max_concurrent,
+                              reconnect_delay=args.reconnect_delay))
+    except KeyboardInterrupt:
+        pass
+    return
+
+
+if __name__ == "__main__":
+    main()
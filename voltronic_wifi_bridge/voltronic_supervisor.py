@@ -0,0 +1,135 @@
+#!/bin/python
+# Run the bridge as several forked worker processes so parsing, CRC checks and mqtt encoding
+# aren't all behind one GIL.
+#
+# Every worker listens on the inverter port with SO_REUSEPORT and the kernel spreads inverter
+# connections across them.  Each has its own mqtt connection subscribed to the command topics, but
+# only the worker holding an inverter's session has a callback registered for its serial, so a
+# command is acted on by whichever worker owns that inverter and ignored by the others.  A worker
+# whose inverter has reconnected to another one may not have noticed yet, so the workers share
+# their serial claims through files in claims_directory (see voltronic_registry.SerialClaims),
+# which the supervisor creates before starting them and removes once they've stopped.
+#
+# The supervisor itself does no bridge work.  It restarts a worker that exits (with a growing
+# delay if it keeps dying straight away) and passes SIGINT/SIGTERM on to the workers, which shut
+# down through their normal signal handling.
+import logging
+import os
+import shutil
+import signal
+import tempfile
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class WorkerSupervisor():
+    def __init__(self, count, target, restart_delay=1, max_restart_delay=30, shutdown_timeout=20):
+        # target(index) runs one worker and returns when it's done
+        self._count = count
+        self._target = target
+        self._restart_delay = restart_delay
+        self._max_restart_delay = max_restart_delay
+        self._shutdown_timeout = shutdown_timeout
+        self._exit_request = False
+        # index -> pid, when it was started and the delay before its next restart
+        self._workers = {}
+        self._started = {}
+        self._delays = {}
+        # index -> when to start it again
+        self._restarts = {}
+        self.claims_directory = None
+        return
+
+    def run(self):
+        signal.signal(signal.SIGINT, self._handle_signal)
+        signal.signal(signal.SIGTERM, self._handle_signal)
+        self.claims_directory = tempfile.mkdtemp(prefix="voltronic-claims-")
+        for index in range(self._count):
+            self._delays[index] = self._restart_delay
+            self._spawn(index)
+        while not self._exit_request:
+            self._reap()
+            now = time.monotonic()
+            for index, start_at in list(self._restarts.items()):
+                if now >= start_at and not self._exit_request:
+                    del self._restarts[index]
+                    self._spawn(index)
+            time.sleep(0.2)
+        self._shut_down()
+        return
+
+    def _spawn(self, index):
+        pid = os.fork()
+        if pid == 0:
+            # the worker installs its own handlers once it's built
+            signal.signal(signal.SIGINT, signal.SIG_DFL)
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            code = 0
+            try:
+                self._target(index)
+            except SystemExit as e:
+                code = e.code if isinstance(e.code, int) else 1
+            except BaseException:
+                logger.exception("worker %s failed", index)
+                code = 1
+            finally:
+                logging.shutdown()
+                os._exit(code)
+        self._workers[index] = pid
+        self._started[index] = time.monotonic()
+        logger.info("started worker %s as pid %s", index, pid)
+        return
+
+    def _reap(self):
+        while len(self._workers) > 0:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                return
+            if pid == 0:
+                return
+            for index, worker_pid in list(self._workers.items()):
+                if worker_pid == pid:
+                    del self._workers[index]
+                    self._worker_exited(index, pid, status)
+        return
+
+    def _worker_exited(self, index, pid, status):
+        if self._exit_request:
+            return
+        # one that dies soon after starting is probably going to again, so back off
+        if time.monotonic() - self._started[index] < 10:
+            delay = self._delays[index]
+            self._delays[index] = min(delay * 2, self._max_restart_delay)
+        else:
+            delay = self._restart_delay
+            self._delays[index] = self._restart_delay
+        logger.warning("worker %s (pid %s) exited with status %s, restarting in %s seconds", index, pid, os.waitstatus_to_exitcode(status), delay)
+        self._restarts[index] = time.monotonic() + delay
+        return
+
+    def _handle_signal(self, signum, frame):
+        self._exit_request = True
+        return
+
+    def _shut_down(self):
+        logger.info("stopping %s workers", len(self._workers))
+        for pid in self._workers.values():
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+        deadline = time.monotonic() + self._shutdown_timeout
+        while len(self._workers) > 0 and time.monotonic() < deadline:
+            self._reap()
+            time.sleep(0.1)
+        for index, pid in self._workers.items():
+            logger.warning("worker %s (pid %s) didn't stop, killing it", index, pid)
+            try:
+                os.kill(pid, signal.SIGKILL)
+                os.waitpid(pid, 0)
+            except (ProcessLookupError, ChildProcessError):
+                pass
+        shutil.rmtree(self.claims_directory, ignore_errors=True)
+        return
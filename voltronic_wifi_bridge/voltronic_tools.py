@@ -1,33 +1,232 @@
 #!/bin/python
+import os
+import socket
+import struct
+import threading
+
+def _build_crc_table():
+    # byte-at-a-time table for the CRC-CCITT (0x1021, xmodem) polynomial used by the inverter
+    table = []
+    for value in range(256):
+        crc = value << 8
+        for _ in range(8):
+            if crc & 0x8000:
+                crc = ((crc << 1) ^ 0x1021) & 0xFFFF
+            else:
+                crc = (crc << 1) & 0xFFFF
+        table.append(crc)
+    return tuple(table)
+
+_crc_table = _build_crc_table()
+
+# aviod special characters in the protocol (, CR, LF by bumping that byte of the crc by one
+_crc_escape = tuple(1 if value in (0x28, 0x0d, 0x0a) else 0 for value in range(256))
 
-def cal_crc_half(message, length=None, string_is_hex=False):
-    # translated to python from inverter.cpp from 
-    crc_ta= [
-        0x0000,0x1021,0x2042,0x3063,0x4084,0x50a5,0x60c6,0x70e7,
-        0x8108,0x9129,0xa14a,0xb16b,0xc18c,0xd1ad,0xe1ce,0xf1ef
-    ]
 
+def cal_crc_half(message, length=None, string_is_hex=False):
+    # originally translated to python from inverter.cpp from https://github.com/manio/skymax-demo
+    # which works a nibble at a time; this is the same crc computed a whole byte per table lookup
+    table = _crc_table
     crc = 0
+    for b in message:
+        crc = ((crc << 8) & 0xFFFF) ^ table[(crc >> 8) ^ b]
+
+    crc += (_crc_escape[crc >> 8] << 8) | _crc_escape[crc & 0xFF]
+    return crc.to_bytes(2, "big")
+
+
+# everything in a frame after the 2 byte counter, keyed by (preamble, message); the polls are constant
+# so after the first time a frame only costs the counter bytes and one concatenation
+_frame_tails = {}
+_frame_tails_max = 256
+
+
+def package_frame(counter, preamble, message):
+    # counter(2) 00 01 length(2) preamble(2) message crc(2) CR
+    key = (preamble, message)
+    tail = _frame_tails.get(key)
+    if tail is None:
+        tail = b'\x00\x01' + (len(message) + 5).to_bytes(2, "big") + preamble + message + cal_crc_half(message) + b'\x0d'
+        if len(_frame_tails) >= _frame_tails_max:
+            _frame_tails.clear()
+        _frame_tails[key] = tail
+    return (counter & 0xFFFF).to_bytes(2, "big") + tail
+
+
+class FrameBuffer():
+    # receive side framing for ?? ?? 00 01 LL LL (ff|01) 04 <message> <crc(2)> CR
+    # frames are handed out as memoryviews into a fixed size buffer, so nothing is copied per frame;
+    # a view is only valid until the next feed()/writable() call
+    _header_length = 8
+    _min_frame_length = 11
+    # skip the counter, then 00 01, length, (ff|01), 04
+    _header = struct.Struct(">2xHHBB")
+
+    def __init__(self, capacity=8192, max_frame_length=1024):
+        self._capacity = capacity
+        self._max_frame_length = min(max_frame_length, capacity)
+        self._buffer = bytearray(capacity)
+        self._view = memoryview(self._buffer)
+        self._start = 0
+        self._end = 0
+
+        self.bytes_discarded = 0
+        self.resync_events = 0
+        return
+
+    def __len__(self):
+        return self._end - self._start
+
+    def _discard(self, count):
+        self._start += count
+        self.bytes_discarded += count
+        return
+
+    def _make_room(self, count):
+        # move the unparsed tail (normally part of one frame) to the front; if that still isn't enough
+        # room the buffer is full of junk that never framed, so drop the oldest bytes
+        pending = self._end - self._start
+        if self._end + count <= self._capacity:
+            return
+        if pending + count > self._capacity:
+            drop = min(pending, pending + count - self._capacity)
+            self._discard(drop)
+            self.resync_events += 1
+            pending -= drop
+        if self._start > 0:
+            self._buffer[0:pending] = bytes(self._view[self._start:self._end])
+            self._start = 0
+            self._end = pending
+        return
+
+    def writable(self, count=2048):
+        # free space to recv_into() directly, follow with commit()
+        count = min(count, self._capacity)
+        self._make_room(count)
+        return self._view[self._end:self._capacity]
+
+    def commit(self, count):
+        self._end += count
+        return
+
+    def feed(self, data):
+        if len(data) > self._capacity:
+            self._discard(self._end - self._start)
+            self.bytes_discarded += len(data) - self._capacity
+            self.resync_events += 1
+            data = memoryview(data)[-self._capacity:]
+        count = len(data)
+        self._make_room(count)
+        self._buffer[self._end:self._end + count] = data
+        self._end += count
+        return
+
+    def _header_at(self, index):
+        # returns the frame length if a plausible header starts at index, 0 if not, None if we can't tell yet
+        if self._end - index < self._header_length:
+            return None
+        marker, length, kind, function = self._header.unpack_from(self._buffer, index)
+        length += 6
+        if marker != 0x0001 or function != 0x04 or (kind != 0xff and kind != 0x01):
+            return 0
+        if length < self._min_frame_length or length > self._max_frame_length:
+            return 0
+        return length
+
+    def _resync(self):
+        # skip forward to the next position that could be the start of a header
+        buf = self._buffer
+        index = self._start + 1
+        while True:
+            marker = buf.find(b'\x00\x01', index + 2, self._end)
+            if marker < 0:
+                # keep a possible partial header at the end of the buffer
+                index = max(index, self._end - (self._header_length - 1))
+                break
+            index = marker - 2
+            if self._header_at(index) != 0:
+                break
+            index += 1
+        self.resync_events += 1
+        self._discard(index - self._start)
+        return
+
+    def next_frame(self):
+        # return a memoryview of the next complete frame, or None if we need more data
+        while True:
+            length = self._header_at(self._start)
+            if length is None:
+                return None
+            if length == 0:
+                self._resync()
+                continue
+            if self._end - self._start < length:
+                return None
+            if self._buffer[self._start + length - 1] != 0x0d:
+                # the header looked right but the frame doesn't end where it says; corrupt length
+                self._resync()
+                continue
+            start = self._start
+            frame = self._view[start:start + length]
+            self._start = start + length
+            if self._start == self._end:
+                self._start = 0
+                self._end = 0
+            return frame
+
+
+class Wakeup():
+    # something a selector can wait on that any thread can set: an eventfd where there is one,
+    # otherwise a socketpair.  Setting it while it's already set costs nothing more.
+    def __init__(self):
+        self._pair = None
+        # set() and close() can race from different threads, and a closed fd number may be reused
+        self._lock = threading.Lock()
+        if hasattr(os, "eventfd"):
+            self._fd = os.eventfd(0, os.EFD_NONBLOCK | os.EFD_CLOEXEC)
+        else:
+            self._pair = socket.socketpair()
+            for sock in self._pair:
+                sock.setblocking(False)
+            self._fd = self._pair[0].fileno()
+        return
+
+    def fileno(self):
+        return self._fd
+
+    def set(self):
+        with self._lock:
+            if self._fd < 0:
+                return
+            try:
+                if self._pair is None:
+                    os.eventfd_write(self._fd, 1)
+                else:
+                    self._pair[1].send(b"\x00")
+            except BlockingIOError:
+                # already set, the socket buffer is full
+                pass
+        return
+
+    def clear(self):
+        try:
+            if self._pair is None:
+                os.eventfd_read(self._fd)
+            else:
+                while self._pair[0].recv(4096):
+                    pass
+        except BlockingIOError:
+            pass
+        return
 
-    for b in bytearray(message):
-        # highest 4 bits of CRC
-        da = crc.to_bytes(2)[0] >> 4
-        crc = crc << 4
-        crc = crc ^ crc_ta[da^(b>>4)]
-
-        crc = crc & 0xFFFF
-        da = crc.to_bytes(2)[0] >> 4
-        crc = crc << 4
-        crc = crc ^ crc_ta[da^(b & 0x0f)]
-
-        # cut off anything about the two bytes
-        crc = crc & 0xFFFF
-
-    # aviod special characters in the protocol (, CR, LF
-    # I'm sure this could be cleaner
-    crcbytes = crc.to_bytes(2)
-    for index in [0, 1]:
-        if crcbytes[index] in [0x28, 0x0d, 0x0a]:
-            crc += (0x100 ** (1-index))
-    crcbytes = crc.to_bytes(2)
-    return crcbytes
+    def close(self):
+        with self._lock:
+            if self._fd < 0:
+                return
+            if self._pair is None:
+                os.close(self._fd)
+            else:
+                for sock in self._pair:
+                    sock.close()
+            self._fd = -1
+        return